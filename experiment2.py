@@ -1,31 +1,86 @@
 # encoding: cp1251
 
-from pyqtgraph.Qt import QtGui, QtCore
-import pyqtgraph as pg
 import numpy as np
 
 import cfms.MSS_Control as MSS
 
-import pyqtgraph.console
-import pyqtgraph.dockarea
-
 import pyvisa
 import pyvisa.resources
 import pyvisa.constants
 
+import abc
+import argparse
+import bisect
+import collections
 import datetime
 import sys
 import os
 import logging
 import logging.handlers
 import enum
+import math
+import queue
 import contextlib
+import dataclasses
+import concurrent.futures
+import re
+import reprlib
 import xmlrpc.server
 import threading
+import signal
 import time
 
 from typing import Optional
 
+from storage.channels import ChannelStore
+from storage.writer import DataWriter
+from storage.binary import BinaryDataWriter
+from storage.stats import RunningStats, linear_fit
+from storage.pyramid import MinMaxPyramid
+from storage.history import HistoryRun
+
+import instruments.keithley6221 as keithley6221
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Experiment2: transport measurements at low temperatures")
+    parser.add_argument("--headless", action="store_true",
+                        help="run the program without the GUI (no Qt, no display), also EXPERIMENT2_HEADLESS=1")
+    parser.add_argument("--program", metavar="FILE", help="program file, '-' for stdin")
+    parser.add_argument("-c", "--commands", help="program given inline, the commands separated by ';'")
+    parser.add_argument("--open", nargs="+", default=[], metavar="FILE",
+                        help="data files to show in the history browser of the GUI")
+    parser.add_argument("--monitoring-host", default="localhost",
+                        help="address of the monitoring server in the headless mode (default: localhost)")
+    arguments = parser.parse_args(argv)
+    if arguments.headless and arguments.program is None and arguments.commands is None:
+        parser.error("--headless needs a program: --program FILE or --commands")
+    return arguments
+
+
+def read_program(arguments) -> Optional[str]:
+    """ The program given on the command line, if any """
+    if arguments.commands is not None:
+        return "\n".join(command.strip() for command in arguments.commands.split(";"))
+    if arguments.program == "-":
+        return sys.stdin.read()
+    if arguments.program is not None:
+        with open(arguments.program, "rt") as f:
+            return f.read()
+    return None
+
+
+# Imported as a module, the GUI is created too unless EXPERIMENT2_HEADLESS=1
+ARGUMENTS = parse_arguments(sys.argv[1:] if __name__ == "__main__" else [])
+HEADLESS = ARGUMENTS.headless or os.environ.get("EXPERIMENT2_HEADLESS") == "1"
+PROGRAM_TEXT = read_program(ARGUMENTS)
+
+if not HEADLESS:
+    from pyqtgraph.Qt import QtGui, QtCore
+    import pyqtgraph as pg
+    import pyqtgraph.console
+    import pyqtgraph.dockarea
+
 
 class Facility(enum.Enum):
     BLUEFORS = 0
@@ -46,7 +101,7 @@ MONITORING_OBJECT = None
 # COMMANDS =============================================================================================================
 
 
-def start():
+def start(text: Optional[str] = None):
     logging.info("USER COMMAND: start")
 
     global PROGRAM_OBJECT, I
@@ -54,7 +109,7 @@ def start():
         logging.error("Program thread is already started! Stop it")
         return
 
-    PROGRAM_OBJECT = Program()
+    PROGRAM_OBJECT = Program(text)
 
     if not PROGRAM_OBJECT.check():
         logging.info("Syntax error in program!")
@@ -89,7 +144,7 @@ def stop():
         MEASURER_OBJECT = None
 
 
-def check():
+def check(text: Optional[str] = None):
     logging.info("USER COMMAND: check")
 
     global PROGRAM_OBJECT
@@ -97,7 +152,7 @@ def check():
         logging.error("Program thread is already started! Stop it")
         return
 
-    PROGRAM_OBJECT = Program()
+    PROGRAM_OBJECT = Program(text)
     result = PROGRAM_OBJECT.check()
     PROGRAM_OBJECT = None
 
@@ -115,244 +170,621 @@ def status(all_thermometers=False):
 
 # LOCKS ================================================================================================================
 
-DEVICELOCK = threading.Lock()
-CONSOLELOCK = threading.Lock()
+class DeviceLocks:
+    """
+    Locks for the instruments: DEVICELOCK(resource) guards a single VISA resource.
+
+    Every resource name gets its own lock, so the SR830s on separate serial ports can be queried at the same time.
+    Resources on the same GPIB board (GPIB0::12, GPIB0::14, ...) additionally share the lock of the board.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}
+
+    def _lock(self, key) -> threading.RLock:
+        with self._guard:
+            if key not in self._locks:
+                self._locks[key] = threading.RLock()
+            return self._locks[key]
+
+    @staticmethod
+    def key(resource) -> str:
+        # Two resource objects opened on the same address (LT1 and LT2) must share the lock
+        name = getattr(resource, "resource_name", None)
+        if name is None:
+            name = getattr(resource, "__name__", None) or repr(resource)
+        return name.upper()
+
+    @contextlib.contextmanager
+    def __call__(self, resource):
+        key = self.key(resource)
+        if key.startswith("GPIB"):
+            # Always the bus first, then the device
+            with self._lock(key.split("::")[0]), self._lock(key):
+                yield
+        else:
+            with self._lock(key):
+                yield
+
+
+DEVICELOCK = DeviceLocks()
 
 # WINDOW SETTINGS ======================================================================================================
 
-app = QtGui.QApplication([])
-win = QtGui.QMainWindow()
-area = pyqtgraph.dockarea.DockArea()
-win.setCentralWidget(area)
-win.setWindowTitle('Experiment2')
-win.resize(1024, 768)
-
-dock_prg = pyqtgraph.dockarea.Dock("Program")
-dock_console = pyqtgraph.dockarea.Dock("Console")
-dock_plot = pyqtgraph.dockarea.Dock("Graph")
-
-area.addDock(dock_prg, "left")
-area.addDock(dock_console, "bottom")
-area.addDock(dock_plot, "right")
-
-app.setStyleSheet("QTextEdit {font-family: Consolas}")
-
-program_widget = QtGui.QTextEdit()
-program_widget.setText("start-simple Test")
-
-dock_prg.addWidget(program_widget)
-
-console_widget = pyqtgraph.console.ConsoleWidget(
-    namespace={"start": start, "stop": stop, "check": check, "status": status,
-               "M": lambda: MEASURER_OBJECT, "I": lambda: I,
-               "np": np})
-dock_console.addWidget(console_widget)
-layout = pg.GraphicsLayoutWidget()
-dock_plot.addWidget(layout)
-
-plotR = layout.addPlot(name="R", row=1, col=1)
-plotPh = layout.addPlot(name="Ph", row=2, col=1)
-plotPh.setXLink("R")
-plotH = layout.addPlot(name="H", row=3, col=1)
-plotH.setXLink("R")
-plotT = layout.addPlot(name="T", row=4, col=1)
-plotT.setXLink("R")
-
-curveR1 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
-curveR2 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 255, 0))
-curveR3 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 0, 255))
-curveR4 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 255, 255))
-curveR5 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(127, 127, 127))
-curveR6 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 255, 255))
-curveRK = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
-# curveRUx = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(127, 127, 127))
-# curveRUy = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 255, 0))
-curveRUr = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 0, 255))
-curvePh1 = plotPh.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
-curvePh2 = plotPh.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 255, 0))
-curvePh3 = plotPh.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 0, 255))
-curvePh4 = plotPh.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 255, 255))
-curveH = plotH.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
-curveHall = plotH.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 255, 0))
-curveTsample1 = plotT.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
-curveTsample2 = plotT.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 0, 128))
-curveT1 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush=pg.mkBrush(0, 0, 128))
-curveT2 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush=pg.mkBrush(0, 0, 255))
-curveT3 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush="g")
-curveT5 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush=pg.mkBrush(128, 0, 0))
-curveT6 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush=pg.mkBrush(255, 0, 0))
-curveT7 = plotT.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
-curveT8 = plotT.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
-
-win.show()
+# Headless: no QApplication, no window, the program comes from the command line (see parse_arguments)
+if not HEADLESS:
+    app = QtGui.QApplication([])
+    win = QtGui.QMainWindow()
+    area = pyqtgraph.dockarea.DockArea()
+    win.setCentralWidget(area)
+    win.setWindowTitle('Experiment2')
+    win.resize(1024, 768)
+
+    dock_prg = pyqtgraph.dockarea.Dock("Program")
+    dock_console = pyqtgraph.dockarea.Dock("Console")
+    dock_plot = pyqtgraph.dockarea.Dock("Graph")
+    dock_history = pyqtgraph.dockarea.Dock("History")
+
+    area.addDock(dock_prg, "left")
+    area.addDock(dock_console, "bottom")
+    area.addDock(dock_plot, "right")
+    area.addDock(dock_history, "below", dock_plot)
+    dock_plot.raiseDock()
+
+    app.setStyleSheet("QTextEdit {font-family: Consolas}")
+
+    program_widget = QtGui.QTextEdit()
+    program_widget.setText(PROGRAM_TEXT if PROGRAM_TEXT is not None else "start-simple Test")
+
+    dock_prg.addWidget(program_widget)
+
+    console_widget = pyqtgraph.console.ConsoleWidget(
+        namespace={"start": start, "stop": stop, "check": check, "status": status,
+                   "M": lambda: MEASURER_OBJECT, "I": lambda: I,
+                   "annotations": lambda channel=None: ANNOTATIONS.events(channel),
+                   "history": lambda: HISTORY,
+                   "np": np})
+    dock_console.addWidget(console_widget)
+    layout = pg.GraphicsLayoutWidget()
+    dock_plot.addWidget(layout)
+
+    plotR = layout.addPlot(name="R", row=1, col=1)
+    plotPh = layout.addPlot(name="Ph", row=2, col=1)
+    plotPh.setXLink("R")
+    plotH = layout.addPlot(name="H", row=3, col=1)
+    plotH.setXLink("R")
+    plotT = layout.addPlot(name="T", row=4, col=1)
+    plotT.setXLink("R")
+
+    curveR1 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
+    curveR2 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 255, 0))
+    curveR3 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 0, 255))
+    curveR4 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 255, 255))
+    curveR5 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(127, 127, 127))
+    curveR6 = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 255, 255))
+    curveRK = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
+    # curveRUx = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(127, 127, 127))
+    # curveRUy = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 255, 0))
+    curveRUr = plotR.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 0, 255))
+    curvePh1 = plotPh.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
+    curvePh2 = plotPh.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 255, 0))
+    curvePh3 = plotPh.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 0, 255))
+    curvePh4 = plotPh.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 255, 255))
+    curveH = plotH.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
+    curveHall = plotH.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 255, 0))
+    curveTsample1 = plotT.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
+    curveTsample2 = plotT.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(0, 0, 128))
+    curveT1 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush=pg.mkBrush(0, 0, 128))
+    curveT2 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush=pg.mkBrush(0, 0, 255))
+    curveT3 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush="g")
+    curveT5 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush=pg.mkBrush(128, 0, 0))
+    curveT6 = plotT.plot(symbol="o", pen=None, symbolPen=None, symbolSize=3, symbolBrush=pg.mkBrush(255, 0, 0))
+    curveT7 = plotT.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
+    curveT8 = plotT.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=1, symbolPen=pg.mkPen(255, 0, 0))
+
+    win.show()
 
 
 class ConsoleHandler(logging.Handler):
+    """
+    Log lines for the console widget. Writing to the widget from another thread crashes Python, so emit() (called by
+    the log listener thread) only keeps the text, and the Qt thread writes it in batches with drain().
+    """
+
+    MAX_LINES = 10000
+    BATCH_LINES = 500
+
+    def __init__(self):
+        super().__init__()
+        # Bounded: if the console is not drained (e.g. the GUI hangs) the oldest lines are lost, not the memory
+        self.lines = collections.deque(maxlen=self.MAX_LINES)
+
     def emit(self, record):
-        str = self.format(record)
-        # THIS SHIT CRASHES PYTHON SOMETIMES!
-        # console_widget.write(str + "\n")
+        self.lines.append(self.format(record))
+
+    def drain(self, widget):
+        batch = []
+        while self.lines and len(batch) < self.BATCH_LINES:
+            batch.append(self.lines.popleft())
+        if batch:
+            widget.write("\n".join(batch) + "\n")
 
 
 os.makedirs("log/", exist_ok=True)
 
-logging.basicConfig(format="%(asctime)s - %(message)s",
-                    level=logging.INFO,
-                    handlers=[ConsoleHandler(),
-                              logging.FileHandler(
-                                  os.path.join("log", "log-{:%Y-%m-%d---%H-%M}.txt".format(datetime.datetime.today()))),
-                              logging.StreamHandler(sys.stdout)])
+# All the threads only put the records into LOG_QUEUE: the file, stdout and the console are written by the listener
+# thread, so a burst of warnings or tracebacks never stalls the acquisition on I/O
+LOG_QUEUE = queue.Queue()
+CONSOLE_HANDLER = None if HEADLESS else ConsoleHandler()
+LOG_HANDLERS = ([] if CONSOLE_HANDLER is None else [CONSOLE_HANDLER]) + [
+    logging.FileHandler(os.path.join("log", "log-{:%Y-%m-%d---%H-%M}.txt".format(datetime.datetime.today()))),
+    logging.StreamHandler(sys.stdout)]
+for log_handler in LOG_HANDLERS:
+    log_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, *LOG_HANDLERS)
+LOG_LISTENER.start()
+
+log_handler = logging.handlers.QueueHandler(LOG_QUEUE)
+# The queued record gets the message with the traceback, the time is added by the handlers of the listener
+log_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
+
+
+class AnnotationLayer:
+    """
+    Status events of the lock-ins (Measurer.R1annotations..R4annotations) drawn on a plot.
+
+    Every event is kept and available with events(), but only the visible ones are drawn. Events of one channel
+    closer than MERGE_FRACTION of the visible time span are merged into one label, and there are never more than
+    MAX_ITEMS labels: if needed, the events are merged further. The text items are reused, not added per event.
+    """
+
+    MERGE_FRACTION = 0.02
+    MAX_ITEMS = 40
+    CHANNELS = ["R1", "R2", "R3", "R4"]
+
+    def __init__(self, plot):
+        self.plot = plot
+        self.items = []
+        self.clear()
+
+    def clear(self):
+        self.source = None
+        # Channel -> times of the events (for the range queries), (time, u, status) of the events
+        self.times = {channel: [] for channel in self.CHANNELS}
+        self.points = {channel: [] for channel in self.CHANNELS}
+        self.count = 0
+        self.drawn = None
+
+    def sync(self, measurer):
+        """ Takes the new events of the measurer (of a new measurer: starts over) """
+        if measurer is not self.source:
+            self.clear()
+            self.source = measurer
+        for channel in self.CHANNELS:
+            annotations = getattr(measurer, channel + "annotations")
+            points = self.points[channel]
+            for time, u, status in annotations[len(points):]:
+                # The events come in the time order, but keep the lists sorted anyway
+                index = bisect.bisect_right(self.times[channel], time)
+                self.times[channel].insert(index, time)
+                points.insert(index, (time, u, status))
+                self.count += 1
+
+    def events(self, channel=None) -> list:
+        """ (channel, time, u, status) of all the events, in the time order """
+        channels = self.CHANNELS if channel is None else [channel]
+        result = [(name, time, u, status) for name in channels for time, u, status in self.points[name]]
+        return sorted(result, key=lambda event: event[1])
+
+    def clusters(self, t0, t1) -> list:
+        """ (time, u, text) of the labels for the time range [t0, t1] """
+        gap = (t1 - t0) * self.MERGE_FRACTION
+        while True:
+            result = []
+            for channel in self.CHANNELS:
+                times = self.times[channel]
+                first, last = bisect.bisect_left(times, t0), bisect.bisect_right(times, t1)
+                cluster = None
+                for time, u, status in self.points[channel][first:last]:
+                    if cluster is not None and time - cluster[1] <= gap:
+                        cluster[1], cluster[2], cluster[3] = time, max(cluster[2], u), cluster[3] | set(status)
+                        cluster[4] += 1
+                    else:
+                        # [first time, last time, max u, statuses, count]
+                        cluster = [time, time, u, set(status), 1]
+                        result.append((channel, cluster))
+            if len(result) <= self.MAX_ITEMS:
+                break
+            gap = max(2 * gap, 1e-3)
 
-R1_ANNOTATIONS_INDEX = 0
-R2_ANNOTATIONS_INDEX = 0
-R3_ANNOTATIONS_INDEX = 0
-R4_ANNOTATIONS_INDEX = 0
+        labels = []
+        for channel, (first, last, u, status, count) in result:
+            title = channel if count == 1 else f"{channel} x{count}"
+            labels.append((first, u, "\n".join([title] + sorted(status))))
+        return labels
+
+    def render(self, t0, t1):
+        state = (t0, t1, self.count)
+        if state == self.drawn:
+            return
+        self.drawn = state
+
+        labels = self.clusters(t0, t1)
+        while len(self.items) < len(labels):
+            item = pg.TextItem(border="r")
+            self.plot.addItem(item)
+            self.items.append(item)
+        for item, (time, u, text) in zip(self.items, labels):
+            item.setText(text)
+            item.setPos(time, u)
+            item.show()
+        for item in self.items[len(labels):]:
+            item.hide()
+
+
+class HistoryBrowser:
+    """
+    Viewer of finished runs: data files of Measurer and DiDvMeasurer (TSV or binary) are loaded in the background
+    (storage.history.HistoryRun) and drawn with the same level of detail as the live plots. The open runs are overlaid
+    (e.g. several cooldowns), Y against X, both chosen among the channels of the runs.
+    """
+
+    def __init__(self, dock):
+        self.runs = []
+        self.curves = []
+        self.state = None
+
+        self.open_button = QtGui.QPushButton("Open...")
+        self.open_button.clicked.connect(self.open_dialog)
+        self.close_button = QtGui.QPushButton("Close")
+        self.close_button.clicked.connect(self.close_selected)
+        self.list = QtGui.QListWidget()
+        self.x_box = QtGui.QComboBox()
+        self.y_box = QtGui.QComboBox()
+        layout = pg.GraphicsLayoutWidget()
+        self.plot = layout.addPlot(name="History")
+        self.plot.addLegend()
+
+        dock.addWidget(self.open_button, row=0, col=0)
+        dock.addWidget(self.close_button, row=0, col=1)
+        dock.addWidget(QtGui.QLabel("X"), row=0, col=2)
+        dock.addWidget(self.x_box, row=0, col=3)
+        dock.addWidget(QtGui.QLabel("Y"), row=0, col=4)
+        dock.addWidget(self.y_box, row=0, col=5)
+        dock.addWidget(self.list, row=1, col=0, colspan=2)
+        dock.addWidget(layout, row=1, col=2, colspan=4)
+
+        self.x_box.currentIndexChanged.connect(lambda *args: self.update())
+        self.y_box.currentIndexChanged.connect(lambda *args: self.update())
+
+        # While the runs are loading the curves grow, afterwards nothing is redrawn (see update)
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.update)
+        self.timer.setInterval(500)
+        self.timer.start()
+        self.view_timer = QtCore.QTimer()
+        self.view_timer.setSingleShot(True)
+        self.view_timer.setInterval(100)
+        self.view_timer.timeout.connect(self.update)
+        self.plot.sigXRangeChanged.connect(lambda *args: self.view_timer.start())
+
+    def open_dialog(self):
+        filenames = QtGui.QFileDialog.getOpenFileNames(None, "Open data files", "data", "Data files (*.txt *.bin)")
+        # PyQt5 also returns the selected filter
+        if isinstance(filenames, tuple):
+            filenames = filenames[0]
+        for filename in filenames:
+            self.open(filename)
+
+    def open(self, filename: str):
+        try:
+            run = HistoryRun(filename)
+        except Exception as exc:
+            logging.warning(f"Cannot open {filename}!")
+            logging.exception(exc)
+            return
+        logging.info(f"History: opened {run.filename}, {run.total_rows} rows")
+
+        self.runs.append(run)
+        self.curves.append(self.plot.plot(symbol="o", pen=None, symbolBrush=None, symbolSize=2,
+                                          symbolPen=pg.intColor(len(self.curves), hues=9),
+                                          name=os.path.basename(run.filename)))
+        self.list.addItem(os.path.basename(run.filename))
+        self.update_channels()
+
+    def close_selected(self):
+        row = self.list.currentRow()
+        if row < 0:
+            return
+        self.runs.pop(row).requestInterruption()
+        self.plot.removeItem(self.curves.pop(row))
+        self.list.takeItem(row)
+        self.state = None
+        self.update_channels()
+
+    def update_channels(self):
+        """ The channels of all the open runs in the X and Y boxes, the choice is kept if possible """
+        names = []
+        for run in self.runs:
+            names += [name for name in run.names if name not in names]
+
+        for box, default in [(self.x_box, 0), (self.y_box, 1)]:
+            current = box.currentText()
+            box.blockSignals(True)
+            box.clear()
+            box.addItems(names)
+            if current in names:
+                box.setCurrentIndex(names.index(current))
+            elif names:
+                box.setCurrentIndex(min(default, len(names) - 1))
+            box.blockSignals(False)
+        self.update()
+
+    def update(self):
+        x, y = self.x_box.currentText(), self.y_box.currentText()
+        for run in self.runs:
+            if x in run.names:
+                run.set_x(x)
+
+        (x0, x1), _ = self.plot.getViewBox().viewRange()
+        max_points = 2 * max(int(self.plot.getViewBox().width()), 500)
+        state = (x, y, x0, x1, max_points, [(id(run), run.x, run.rows(), run.error) for run in self.runs])
+        if state == self.state:
+            return
+        self.state = state
+
+        for i, (run, curve) in enumerate(zip(self.runs, self.curves)):
+            loaded, total = run.progress()
+            text = os.path.basename(run.filename)
+            if run.error is not None:
+                text += " - error!"
+            elif loaded < total:
+                text += f" - {100 * loaded // total}%"
+            self.list.item(i).setText(text)
+
+            if run.x == x and y in run.names:
+                curve.setData(*run.query(y, x0, x1, max_points, max_points // 4))
+            else:
+                curve.setData([], [])
+
+
+class AdaptiveRefresh:
+    """
+    Keeps the plots within TARGET_SHARE of the GUI thread. The time of every update is measured and the refresh
+    interval follows its average (between MIN_INTERVAL and MAX_INTERVAL). If even MAX_INTERVAL is not enough, the point
+    budget of the curves is reduced, and it is increased back when the updates get cheap again.
+    A frame is counted as dropped when the GUI thread was too busy to start the update in time.
+    """
+
+    TARGET_SHARE = 0.2
+    MIN_INTERVAL = 0.25
+    MAX_INTERVAL = 5.0
+    MIN_BUDGET = 0.1
+    # Weight of the last update in the average update time
+    SMOOTHING = 0.3
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.interval = timer.interval() / 1000
+        self.budget = 1.0
+        self.render_time = None
+        self.frames = 0
+        self.dropped = 0
+        self.last_start = None
+
+    def frame(self, start: float, stop: float):
+        """ Takes the start and the end (time.perf_counter) of one update """
+        if self.last_start is not None:
+            late = (start - self.last_start) / self.interval
+            if late >= 2:
+                self.dropped += int(late) - 1
+        self.last_start = start
+        self.frames += 1
+
+        duration = stop - start
+        if self.render_time is None:
+            self.render_time = duration
+        self.render_time += self.SMOOTHING * (duration - self.render_time)
+
+        interval = min(max(self.render_time / self.TARGET_SHARE, self.MIN_INTERVAL), self.MAX_INTERVAL)
+        if self.render_time / interval > self.TARGET_SHARE:
+            self.budget = max(self.budget * 0.8, self.MIN_BUDGET)
+        elif interval < self.MAX_INTERVAL / 2:
+            self.budget = min(self.budget * 1.25, 1.0)
+
+        if abs(interval - self.interval) > 0.1 * self.interval:
+            self.interval = interval
+            self.timer.setInterval(int(interval * 1000))
+
+    def points(self, points: int) -> int:
+        return max(int(points * self.budget), 100)
+
+    def status(self) -> str:
+        render = 0.0 if self.render_time is None else self.render_time
+        return "render {:.0f} ms every {:.2f} s, {:.0%} points, {} dropped".format(
+            1000 * render, self.interval, self.budget, self.dropped)
+
+
+# Min/max decimation of the data of MEASURER_OBJECT for the plots: (store, pyramid)
+PLOT_PYRAMID = (None, None)
+# What the curves show now: (store, sequence of the snapshot, visible rows, number of points)
+PLOT_STATE = None
+# Seconds of the measurement over which the acquisition rate is shown
+RATE_WINDOW = 10.0
+
+
+def plot_curves(plot, experiment):
+    """ Calls plot(curve, channel name) for every curve shown in the experiment """
+    plot(curveR1, "R_Sample")
+    plot(curveR2, "R2")
+    plot(curveR3, "R3")
+    plot(curveR4, "R4")
+    plot(curveRK, "RK")
+    # plot(curveRUx, "Ux")
+    # plot(curveRUy, "Uy")
+    plot(curveRUr, "Ur")
+
+    plot(curvePh1, "PHASE1")
+    plot(curvePh2, "PHASE2")
+    plot(curvePh3, "PHASE3")
+    plot(curvePh4, "PHASE4")
+    plot(curvePh4, "Theta")
+    plot(curveH, "H")
+    plot(curveHall, "HALL")
+    #
+    if experiment == "cooldown":
+        plot(curveT1, "T1")
+        plot(curveT2, "T2")
+        plot(curveT3, "T3")
+        plot(curveT5, "T5")
+        plot(curveT6, "T6")
+        plot(curveT7, "T7")
+        plot(curveT8, "T8")
+    else:
+        plot(curveTsample1, "Tsample1")
+        plot(curveTsample2, "Tsample2")
+        # plot(curveT7, "T7")
+        # plot(curveT8, "T8")
+
+
+def refresh_plots():
+    start = time.perf_counter()
+    update_plots()
+    REFRESH.frame(start, time.perf_counter())
 
 
 def update_plots():
     global previous_time
     global MEASURER_OBJECT
-    global R1_ANNOTATIONS_INDEX, R2_ANNOTATIONS_INDEX, R3_ANNOTATIONS_INDEX, R4_ANNOTATIONS_INDEX
+    global PLOT_PYRAMID, PLOT_STATE
 
-    with CONSOLELOCK:
-        if MEASURER_OBJECT is None:
-            return
-        try:
-            MEASURER_OBJECT.TIME
-        except AttributeError:
-            return
+    # MEASURER_OBJECT is replaced by the program thread, keep one reference for the whole update
+    measurer = MEASURER_OBJECT
+    if measurer is None or getattr(measurer, "data", None) is None:
+        return
 
-        # The TIME array is always the largest
-        number_of_points = len(MEASURER_OBJECT.TIME) - 1
+    # Lock-free: a consistent, length-aligned view of the published rows (see ChannelStore)
+    data = measurer.data.snapshot()
 
-        if number_of_points < 0:
-            return
+    if "TIME" not in data:
+        return
 
-        # The maximum number of points per graph. Subsampling is used to decrease
-        MAX_NUMBER_OF_POINTS = 1000
-        SLICE_FACTOR = int(number_of_points / MAX_NUMBER_OF_POINTS) + 1
-
-        if number_of_points > 10:
-            deltat = MEASURER_OBJECT.TIME[-1] - MEASURER_OBJECT.TIME[-10]
-            pps = 10 / deltat
-            win.setWindowTitle(
-                "Experiment2 - {} points (slice factor {}) - {:.1f} points per second".format(number_of_points,
-                                                                                              SLICE_FACTOR, pps))
-
-        if len(MEASURER_OBJECT.R_Sample) > 0:
-            curveR1.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.R_Sample[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.R2) > 0:
-            curveR2.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.R2[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.R3) > 0:
-            curveR3.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.R3[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.R4) > 0:
-            curveR4.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.R4[:number_of_points:SLICE_FACTOR])
-
-        if len(MEASURER_OBJECT.RK) > 0:
-            curveRK.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.RK[:number_of_points:SLICE_FACTOR])
-        # if len(MEASURER_OBJECT.Ux) > 0:
-        #     curveRUx.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-        #                     MEASURER_OBJECT.Ux[:number_of_points:SLICE_FACTOR])
-        # if len(MEASURER_OBJECT.Uy) > 0:
-        #     curveRUy.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-        #                     MEASURER_OBJECT.Uy[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.Ur) > 0:
-            curveRUr.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.Ur[:number_of_points:SLICE_FACTOR])
-
-
-        if len(MEASURER_OBJECT.PHASE1) > 0:
-            curvePh1.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                             MEASURER_OBJECT.PHASE1[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.PHASE2) > 0:
-            curvePh2.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                             MEASURER_OBJECT.PHASE2[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.PHASE3) > 0:
-            curvePh3.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                             MEASURER_OBJECT.PHASE3[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.PHASE4) > 0:
-            curvePh4.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                             MEASURER_OBJECT.PHASE4[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.Theta) > 0:
-            curvePh4.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                             MEASURER_OBJECT.Theta[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.H) > 0:
-            curveH.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                           MEASURER_OBJECT.H[:number_of_points:SLICE_FACTOR])
-        if len(MEASURER_OBJECT.HALL) > 0:
-            curveHall.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                              MEASURER_OBJECT.HALL[:number_of_points:SLICE_FACTOR])
-        #
-        if MEASURER_OBJECT.EXPERIMENT == "cooldown":
-            curveT1.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.T1[:number_of_points:SLICE_FACTOR])
-            curveT2.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.T2[:number_of_points:SLICE_FACTOR])
-            curveT3.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.T3[:number_of_points:SLICE_FACTOR])
-            curveT5.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.T5[:number_of_points:SLICE_FACTOR])
-            curveT6.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.T6[:number_of_points:SLICE_FACTOR])
-            curveT7.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.T7[:number_of_points:SLICE_FACTOR])
-            curveT8.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                            MEASURER_OBJECT.T8[:number_of_points:SLICE_FACTOR])
-        else:
-            if len(MEASURER_OBJECT.Tsample1) > 0:
-                curveTsample1.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                               MEASURER_OBJECT.Tsample1[:number_of_points:SLICE_FACTOR])
-            if len(MEASURER_OBJECT.Tsample2) > 0:
-                curveTsample2.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],
-                               MEASURER_OBJECT.Tsample2[:number_of_points:SLICE_FACTOR])
-            # Lots or errors if None in array!
-            # if len(MEASURER_OBJECT.T7) > 0:
-            #    curveT7.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],MEASURER_OBJECT.T7[:number_of_points:SLICE_FACTOR])
-            # if len(MEASURER_OBJECT.T8) > 0:
-            #    curveT8.setData(MEASURER_OBJECT.TIME[:number_of_points:SLICE_FACTOR],MEASURER_OBJECT.T8[:number_of_points:SLICE_FACTOR])
-
-        while len(MEASURER_OBJECT.R1annotations) > R1_ANNOTATIONS_INDEX:
-            x, y, status = MEASURER_OBJECT.R1annotations[R1_ANNOTATIONS_INDEX]
-            annotate_u_plot(x, y, status)
-            R1_ANNOTATIONS_INDEX += 1
-
-        while len(MEASURER_OBJECT.R2annotations) > R2_ANNOTATIONS_INDEX:
-            x, y, status = MEASURER_OBJECT.R2annotations[R2_ANNOTATIONS_INDEX]
-            annotate_u_plot(x, y, status)
-            R2_ANNOTATIONS_INDEX += 1
-
-        while len(MEASURER_OBJECT.R3annotations) > R3_ANNOTATIONS_INDEX:
-            x, y, status = MEASURER_OBJECT.R3annotations[R3_ANNOTATIONS_INDEX]
-            annotate_u_plot(x, y, status)
-            R3_ANNOTATIONS_INDEX += 1
-
-        while len(MEASURER_OBJECT.R4annotations) > R4_ANNOTATIONS_INDEX:
-            x, y, status = MEASURER_OBJECT.R4annotations[R4_ANNOTATIONS_INDEX]
-            annotate_u_plot(x, y, status)
-            R4_ANNOTATIONS_INDEX += 1
-
-
-def annotate_u_plot(time, u, status):
-    text = "\n".join(status)
-    textitem = pg.TextItem(text, border="r")
-    textitem.setPos(time, u)
-    plotR.addItem(textitem)
-
-
-update_timer = QtCore.QTimer()
-update_timer.timeout.connect(update_plots)
-update_timer.setInterval(1000)
-update_timer.start()
+    # All the channels of the snapshot have the same length
+    number_of_points = len(data)
+
+    if number_of_points == 0:
+        return
+
+    # Only the rows added since the previous update are decimated
+    store, pyramid = PLOT_PYRAMID
+    if store is not measurer.data:
+        pyramid = MinMaxPyramid(data.names)
+        PLOT_PYRAMID = (measurer.data, pyramid)
+    pyramid.update(data)
+
+    # The maximum number of points per graph: the minimum and the maximum for every pixel column
+    # (reduced by REFRESH when the updates take too much of the GUI thread)
+    MAX_NUMBER_OF_POINTS = REFRESH.points(2 * max(int(plotR.getViewBox().width()), 500))
+    # Out of the view the curves are kept coarse, just enough to pan and to autorange
+    CONTEXT_NUMBER_OF_POINTS = MAX_NUMBER_OF_POINTS // 4
+
+    # The plots are X-linked, the visible time range is the same for all of them
+    (view_start, view_stop), _ = plotR.getViewBox().viewRange()
+    start, stop = pyramid.rows_between(view_start, view_stop)
+    level = pyramid.level_for(stop - start, MAX_NUMBER_OF_POINTS)
+
+    # The acquisition rate: the rows of the last RATE_WINDOW seconds of the measurement
+    now = data["TIME"][number_of_points - 1]
+    window = min(RATE_WINDOW, now - data["TIME"][0])
+    first, last = pyramid.rows_between(now - window, now)
+    pps = (last - first - 1) / window if window > 0 else 0.0
+    win.setWindowTitle("Experiment2 - {} points (level {}) - {:.1f} points per second - {}".format(
+        number_of_points, level, pps, REFRESH.status()))
+
+    def plot(curve, name):
+        # Missing (NaN) values of sparse channels are dropped by the pyramid
+        curve.setData(*pyramid.query_view(name, start, stop, MAX_NUMBER_OF_POINTS, CONTEXT_NUMBER_OF_POINTS))
+
+    state = (measurer.data, data.sequence, start, stop, MAX_NUMBER_OF_POINTS)
+    if state != PLOT_STATE:
+        # Otherwise there is nothing new to draw
+        PLOT_STATE = state
+        plot_curves(plot, measurer.EXPERIMENT)
+
+    ANNOTATIONS.sync(measurer)
+    ANNOTATIONS.render(view_start, view_stop)
+
+
+if not HEADLESS:
+    ANNOTATIONS = AnnotationLayer(plotR)
+
+    HISTORY = HistoryBrowser(dock_history)
+    for history_filename in ARGUMENTS.open:
+        HISTORY.open(history_filename)
+
+    update_timer = QtCore.QTimer()
+    update_timer.timeout.connect(refresh_plots)
+    update_timer.setInterval(1000)
+    update_timer.start()
+    # Adapts the interval of update_timer and the number of points to the measured update time
+    REFRESH = AdaptiveRefresh(update_timer)
+
+    # Zoom and pan: redraw with the level of detail of the new view, once the view has stopped changing
+    view_timer = QtCore.QTimer()
+    view_timer.setSingleShot(True)
+    view_timer.setInterval(100)
+    view_timer.timeout.connect(refresh_plots)
+    plotR.sigXRangeChanged.connect(lambda *args: view_timer.start())
+
+    console_timer = QtCore.QTimer()
+    console_timer.timeout.connect(lambda: CONSOLE_HANDLER.drain(console_widget))
+    console_timer.setInterval(200)
+    console_timer.start()
 
 
 # MEASUREMENTS =========================================================================================================
 
 
+class SR830State:
+    """
+    Cached settings of the SR830 lock-ins: sensitivity (SENS), time constant (OFLT), reserve (RMOD), input source
+    (ISRC) and offset/expand of R (OEXP 3).
+
+    A setting is queried once and then kept up to date by the writes of Instruments, so reading it costs no bus
+    traffic. Changes made on the front panel are not seen until invalidate().
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._values = {}
+
+    def get(self, SR830, setting, query):
+        """ The cached value, query() is called (and its result cached) only if there is none """
+        key = (DeviceLocks.key(SR830), setting)
+        with self._guard:
+            if key in self._values:
+                return self._values[key]
+        value = query()
+        with self._guard:
+            self._values[key] = value
+        return value
+
+    def set(self, SR830, setting, value):
+        with self._guard:
+            self._values[(DeviceLocks.key(SR830), setting)] = value
+
+    def invalidate(self, SR830=None):
+        with self._guard:
+            if SR830 is None:
+                self._values.clear()
+            else:
+                name = DeviceLocks.key(SR830)
+                for key in [key for key in self._values if key[0] == name]:
+                    del self._values[key]
+
+
 class Instruments:
     TC_CURRENT_EXC_LABELS = {
         1: "1 pA", 2: "3.16 pA", 3: "10 pA", 4: "31.6 pA", 5: "100 pA", 6: "316 pA",
@@ -385,7 +817,26 @@ class Instruments:
         0: 1e-9, 1: 10e-9, 2: 100e-9, 3: 1e-6, 4: 10e-6, 5: 100e-6, 6: 1e-3, 7: 10e-3, 8: 50e-3
     }
 
+    # SENS index -> full scale in volts (multiply by 1e-6 or 1e-8 for the current inputs), the only table of the ranges:
+    # get_range, set_range and SR830Autorange index it
+    SR830_SENSITIVITIES = [2e-9, 5e-9, 10e-9, 20e-9, 50e-9, 100e-9, 200e-9, 500e-9, 1e-6, 2e-6, 5e-6, 10e-6, 20e-6,
+                           50e-6, 100e-6, 200e-6, 500e-6, 1e-3, 2e-3, 5e-3, 10e-3, 20e-3, 50e-3, 100e-3, 200e-3, 500e-3,
+                           1.0]
+    # ISRC index -> the multiplier of the full scale
+    SR830_INPUT_SCALE = [1.0, 1.0, 1e-6, 1e-8]
+    # OFLT index -> time constant in seconds
+    SR830_TIME_CONSTANTS = [10e-6, 30e-6, 100e-6, 300e-6, 1e-3, 3e-3, 10e-3, 30e-3, 100e-3, 300e-3, 1, 3, 10, 30, 100,
+                            300, 1e3, 3e3, 10e3, 30e3]
+
+    # SRAT index -> sample rate in Hz (index 14 is the external trigger)
+    SR830_SAMPLE_RATES = [0.0625, 0.125, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+    # Points per trace of the internal buffer
+    SR830_BUFFER_SIZE = 16383
+
     def __init__(self):
+        # Cached lock-in settings, see SR830State
+        self.sr830_state = SR830State()
+
         # If true, we consider the current source switched on and we can communicate with it
         self.CONFIG_MEASURE_FIELD = False
         # If false, the MXC temperature is measured. PT lower flange otherwise
@@ -693,7 +1144,7 @@ class Instruments:
             syncflt = self.get_sync_filter(sr830)[1]
             reserve = self.get_reserve(sr830)[1]
 
-            offset, expand = sr830.query_ascii_values("OEXP? 3")
+            offset, expand = self.get_offset_expand(sr830)
             expandstr = {0: "1x", 1: "10x", 2: "100x"}[int(expand)]
 
             result = "SRC(" + ref + "; " + str(amp) + "V; " + str(freq) + "Hz) "
@@ -767,7 +1218,7 @@ class Instruments:
                 else:
                     logging.info("Temperature ramp is OFF")
 
-                with DEVICELOCK:
+                with DEVICELOCK(self.T):
                     channel, filter, units, delay, curpow, htrlim, htrres = [x.strip() for x in
                                                                              self.T.query("CSET?").split(",")]
 
@@ -776,7 +1227,7 @@ class Instruments:
                 else:
                     htrres = float(htrres)  # Ohm
 
-                    with DEVICELOCK:
+                    with DEVICELOCK(self.T):
                         # Get the heater value (unit is Watt)
                         htr = float(self.T.query("HTR?").strip())
                     htrrange, rangestr, maxcurrent = self.tc_get_heater_range()
@@ -789,12 +1240,12 @@ class Instruments:
                 logging.info("TC in open loop mode!")
                 logging.info(f"Heater output is {I.tc_heater(log=False) * 1000000} uW")
 
-            with DEVICELOCK:
+            with DEVICELOCK(I.T):
                 curchannel, autoscan = I.T.query_ascii_values("SCAN?")
 
             for channel in [1, 2, 3, 5, 6, 7, 8]:
                 onoff, dwell, pause, curvenumber, tempcoeff = self.tc_get_channel_info(channel, log=False)
-                with DEVICELOCK:
+                with DEVICELOCK(I.T):
                     mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {channel}")
                     ohms, = I.T.query_ascii_values(f"RDGR? {channel}")
                     kelvins, = I.T.query_ascii_values(f"RDGK? {channel}")
@@ -802,7 +1253,7 @@ class Instruments:
                     f"{channel}: {' ON' if onoff else 'OFF'}: DT {dwell:.1f} PT {pause:.1f} CN{curvenumber:02d} TC{tempcoeff}: {kelvins} K ({ohms} Ohm / {Instruments.TC_CURRENT_RANGE_LABELS[rng]}). Exc = {Instruments.TC_CURRENT_EXC_LABELS[excitation]} {'<====' if channel == curchannel else ''}")
 
             if all_thermometers:
-                with DEVICELOCK:
+                with DEVICELOCK(self.T):
                     curchannel, autoscan = [int(X) for X in self.T.query_ascii_values("SCAN?")]
                 if autoscan:
                     logging.info("LakeShore: AUTOSCAN is ON")
@@ -823,21 +1274,21 @@ class Instruments:
         if not self.CONFIG_GATE_AVAILABLE:
             logging.warning("Gate handling is DISABLED")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             return self.Vg.query(":OUTP?").strip().lower()
 
     def set_gate_state(self, on):
         if not self.CONFIG_GATE_AVAILABLE:
             logging.warning("Gate handling is DISABLED")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             self.Vg.write(f":OUTP {1 if on else 0}")
 
     def get_gate_function(self):
         if not self.CONFIG_GATE_AVAILABLE:
             logging.warning("Gate handling is DISABLED")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             return self.Vg.query(":SOUR:FUNC?").strip().lower()
 
     def set_gate_function(self, function):
@@ -847,28 +1298,28 @@ class Instruments:
         if not function in ["curr", "volt"]:
             logging.warning("Gate function can be only 'curr' or 'volt'")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             self.Vg.write(f":SOUR:FUNC {function}")
 
     def get_gate_protection_voltage(self):
         if not self.CONFIG_GATE_AVAILABLE:
             logging.warning("Gate handling is DISABLED")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             return self.Vg.query_ascii_values(":SOUR:PROT:VOLT?")[0]
 
     def get_gate_protection_current(self):
         if not self.CONFIG_GATE_AVAILABLE:
             logging.warning("Gate handling is DISABLED")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             return self.Vg.query_ascii_values(":SOUR:PROT:CURR?")[0]
 
     def get_gate_range(self):
         if not self.CONFIG_GATE_AVAILABLE:
             logging.warning("Gate handling is DISABLED")
             return None
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             # Returns voltage or current depending in function
             return self.Vg.query_ascii_values(":SOUR:RANG?")[0]
 
@@ -878,7 +1329,7 @@ class Instruments:
             return None
             logging.warning("Gate is functioning in current mode!")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             return self.Vg.query_ascii_values(":SOURCE:LEVEL?")
 
     def set_gate_voltage(self, voltage):
@@ -888,7 +1339,7 @@ class Instruments:
         if self.get_gate_function() != "volt":
             logging.warning("Gate is functioning in current mode!")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             self.Vg.write(f":SOURCE:LEVEL {voltage}")
 
     def get_gate_current(self):
@@ -898,7 +1349,7 @@ class Instruments:
         if self.get_gate_function() != "curr":
             logging.warning("Gate is functioning in voltage mode!")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             return self.Vg.query_ascii_values(":SOURCE:LEVEL?")[0]
 
     def set_gate_current(self, current):
@@ -908,7 +1359,7 @@ class Instruments:
         if self.get_gate_function() != "curr":
             logging.warning("Gate is functioning in voltage mode!")
             return
-        with DEVICELOCK:
+        with DEVICELOCK(self.Vg):
             self.Vg.write(f":SOURCE:LEVEL {current}")
 
     def get_amplitude_and_theta(self, SR830) -> (float, float):
@@ -916,22 +1367,25 @@ class Instruments:
         # 2: Y
         # 3: R
         # 4: theta
-        with DEVICELOCK:
+        with DEVICELOCK(SR830):
             return SR830.query_ascii_values("SNAP? 3,4")
 
     def get_reference_source(self, SR830) -> (int, str):
         try:
-            with DEVICELOCK:
+            with DEVICELOCK(SR830):
                 index = int(SR830.query("FMOD?").strip())
         except ValueError:
             logging.info("Error parsing index from FMOD?")
             return None, None
         return (index, ["external", "internal"][index])
 
+    def query_index(self, SR830, query) -> int:
+        with DEVICELOCK(SR830):
+            return int(SR830.query(query).strip())
+
     def get_input_source(self, SR830) -> (int, str):
         try:
-            with DEVICELOCK:
-                index = int(SR830.query("ISRC?").strip())
+            index = self.sr830_state.get(SR830, "ISRC", lambda: self.query_index(SR830, "ISRC?"))
         except ValueError:
             logging.info("Error parsing index from ISRC?")
             return None, None
@@ -939,7 +1393,7 @@ class Instruments:
 
     def get_input_ground(self, SR830) -> (int, str):
         try:
-            with DEVICELOCK:
+            with DEVICELOCK(SR830):
                 index = int(SR830.query("IGND?").strip())
         except ValueError:
             logging.info("Error parsing index from IGND?")
@@ -948,7 +1402,7 @@ class Instruments:
 
     def get_input_coupling(self, SR830) -> (int, str):
         try:
-            with DEVICELOCK:
+            with DEVICELOCK(SR830):
                 index = int(SR830.query("ICPL?").strip())
         except ValueError:
             logging.info("Error parsing index from ICPL?")
@@ -957,7 +1411,7 @@ class Instruments:
 
     def get_input_filters(self, SR830) -> (int, str):
         try:
-            with DEVICELOCK:
+            with DEVICELOCK(SR830):
                 index = int(SR830.query("ILIN?").strip())
         except ValueError:
             logging.info("Error parsing index from ILIN?")
@@ -966,7 +1420,7 @@ class Instruments:
 
     def get_sync_filter(self, SR830) -> (int, str):
         try:
-            with DEVICELOCK:
+            with DEVICELOCK(SR830):
                 index = int(SR830.query("SYNC?").strip())
         except ValueError:
             logging.info("Error parsing index from SYNC?")
@@ -975,7 +1429,7 @@ class Instruments:
 
     def get_status(self, SR830):
         try:
-            with DEVICELOCK:
+            with DEVICELOCK(SR830):
                 b = SR830.query_ascii_values("LIAS?", converter="d")[0]
         except ValueError:
             logging.info("Error parsing status from LIAS? for {}".format(SR830))
@@ -991,8 +1445,7 @@ class Instruments:
 
     def get_reserve(self, SR830) -> (int, str):
         try:
-            with DEVICELOCK:
-                index = int(SR830.query("RMOD?").strip())
+            index = self.sr830_state.get(SR830, "RMOD", lambda: self.query_index(SR830, "RMOD?"))
         except ValueError:
             logging.info("Error parsing index from RMOD?")
             return None, None
@@ -1000,53 +1453,59 @@ class Instruments:
 
     def get_range(self, SR830) -> (int, str, float):
         try:
-            with DEVICELOCK:
-                index = int(SR830.query("SENS?").strip())
+            index = self.sr830_state.get(SR830, "SENS", lambda: self.query_index(SR830, "SENS?"))
         except ValueError:
             logging.info("Error parsing index from SENS?")
             return None, None, None
-        ranges = [("2 nV", 2e-9), ("5 nV", 5e-9), ("10 nV", 10e-9),
-                  ("20 nV", 20e-9), ("50 nV", 50e-9), ("100 nV", 100e-9),
-                  ("200 nV", 200e-9), ("500 nV", 500e-9), ("1 uV", 1e-6),
-                  ("2 uV", 2e-6), ("5 uV", 5e-6), ("10 uV", 10e-6),
-                  ("20 uV", 20e-6), ("50 uV", 50e-6), ("100 uV", 100e-6),
-                  ("200 uV", 200e-6), ("500 uV", 500e-6),
-                  ("1 mV", 1e-3), ("2 mV", 2e-3), ("5 mV", 5e-3),
-                  ("10 mV", 10e-3), ("20 mV", 20e-3), ("50 mV", 50e-3),
-                  ("100 mV", 100e-3), ("200 mV", 200e-3), ("500 mV", 500e-3),
-                  ("1 V", 1.0)]
-        return index, ranges[index][0], ranges[index][1]
+        value = self.SR830_SENSITIVITIES[index]
+        return index, self.sensitivity_label(value), value
+
+    @staticmethod
+    def sensitivity_label(volts: float) -> str:
+        """ "2 nV", "500 uV", "1 V"... of a full scale of SR830_SENSITIVITIES """
+        for unit, factor in [("V", 1.0), ("mV", 1e-3), ("uV", 1e-6), ("nV", 1e-9)]:
+            if volts >= factor * (1 - 1e-9):
+                break
+        return f"{volts / factor:.0f} {unit}"
+
+    def get_full_scale(self, SR830) -> (int, float):
+        """ (SENS index, full scale in the units of the input: volts or amperes), None if a query has failed """
+        index, label, value = self.get_range(SR830)
+        source, source_label = self.get_input_source(SR830)
+        if index is None or source is None:
+            return index, None
+        return index, value * self.SR830_INPUT_SCALE[source]
+
+    def set_sensitivity(self, SR830, index):
+        with DEVICELOCK(SR830):
+            SR830.write("SENS {}".format(index))
+        self.sr830_state.set(SR830, "SENS", index)
 
     def set_range(self, SR830, range_txt, dryrun=False):
         try:
-            range_index = ["2nV", "5nV", "10nV", "20nV", "50nV", "100nV", "200nV", "500nV", "1uV", "2uV", "5uV", "10uV",
-                           "20uV", "50uV", "100uV", "200uV", "500uV", "1mV", "2mV", "5mV", "10mV", "20mV", "50mV",
-                           "100mV", "200mV", "500mV", "1V"].index(range_txt)
+            range_index = [self.sensitivity_label(value).replace(" ", "")
+                           for value in self.SR830_SENSITIVITIES].index(range_txt)
         except ValueError:
             logging.info("Cannot find {} in list".format(range_txt))
             return False
 
         if not dryrun:
-            with DEVICELOCK:
-                SR830.write("SENS {}".format(range_index))
+            self.set_sensitivity(SR830, range_index)
         return True
 
     def range_up(self, SR830):
         index, str, value = self.get_range(SR830)
         if index < 26:
-            with DEVICELOCK:
-                SR830.write("SENS {}".format(index + 1))
+            self.set_sensitivity(SR830, index + 1)
 
     def range_down(self, SR830):
         index, str, value = self.get_range(SR830)
         if index > 0:
-            with DEVICELOCK:
-                SR830.write("SENS {}".format(index - 1))
+            self.set_sensitivity(SR830, index - 1)
 
     def get_rc(self, SR830) -> (int, str):
         try:
-            with DEVICELOCK:
-                index = int(SR830.query("OFLT?").strip())
+            index = self.sr830_state.get(SR830, "OFLT", lambda: self.query_index(SR830, "OFLT?"))
         except ValueError:
             logging.info("Error parsing index from OFLT?")
             return None, None
@@ -1054,34 +1513,41 @@ class Instruments:
                "1 s", "3 s", "10 s", "30 s", "100 s", "300 s", "1 ks", "3 ks", "10 ks", "30 ks"]
         return index, rcs[index]
 
+    def get_rc_seconds(self, SR830) -> float:
+        index, label = self.get_rc(SR830)
+        return self.SR830_TIME_CONSTANTS[index]
+
+    def set_time_constant(self, SR830, index):
+        with DEVICELOCK(SR830):
+            SR830.write("OFLT {}".format(index))
+        self.sr830_state.set(SR830, "OFLT", index)
+
     def rc_up(self, SR830):
         index, str = self.get_rc(SR830)
         if index < 19:
-            with DEVICELOCK:
-                SR830.write("OFLT {}".format(index + 1))
+            self.set_time_constant(SR830, index + 1)
 
     def rc_down(self, SR830):
         index, str = self.get_rc(SR830)
         if index > 0:
-            with DEVICELOCK:
-                SR830.write("OFLT {}".format(index - 1))
+            self.set_time_constant(SR830, index - 1)
 
     def get_amplitude(self, SR830):
-        with DEVICELOCK:
+        with DEVICELOCK(SR830):
             current_amp, = SR830.query_ascii_values("SLVL?")
         return current_amp
 
     def set_amplitude(self, SR830, amplitude):
-        with DEVICELOCK:
+        with DEVICELOCK(SR830):
             SR830.write("SLVL {}".format(amplitude))
 
     def get_frequency(self, SR830):
-        with DEVICELOCK:
+        with DEVICELOCK(SR830):
             current_freq, = SR830.query_ascii_values("FREQ?")
         return current_freq
 
     def set_frequency(self, SR830, frequency):
-        with DEVICELOCK:
+        with DEVICELOCK(SR830):
             SR830.write("FREQ {}".format(frequency))
 
     def set_offset_expand_on(self, SR830, mult):
@@ -1089,7 +1555,7 @@ class Instruments:
             logging.warning("Only 1x or 10x or 100x mult is allowed!")
             return
 
-        with DEVICELOCK:
+        with DEVICELOCK(SR830):
             SR830.write("AOFF 3")
             offset, expand = SR830.query_ascii_values("OEXP? 3")
             # Arg1: 1 - X, 2 - Y, 3 - R
@@ -1097,26 +1563,78 @@ class Instruments:
             # Arg3: 0 - 0, 1 - 10, 2 - 100
             multstr = {"1x": 0, "10x": 1, "100x": 2}[mult]
             SR830.write(f"OEXP 3,{offset},{multstr}")
-            return offset
+        self.sr830_state.set(SR830, "OEXP", (offset, multstr))
+        return offset
 
     def set_offset_expand_off(self, SR830):
-        with DEVICELOCK:
+        with DEVICELOCK(SR830):
             SR830.write("OEXP 3,0,0")
+        self.sr830_state.set(SR830, "OEXP", (0.0, 0))
+
+    def get_offset_expand(self, SR830) -> (float, int):
+        """ (offset of R in percent, expand: 0 - 1x, 1 - 10x, 2 - 100x) """
+        def query():
+            with DEVICELOCK(SR830):
+                offset, expand = SR830.query_ascii_values("OEXP? 3")
+            return offset, int(expand)
+
+        return self.sr830_state.get(SR830, "OEXP", query)
+
+    def buffer_start(self, SR830, rate_hz) -> float:
+        """
+        Clears the internal buffer and starts storing R (trace 1) and theta (trace 2) at rate_hz.
+        Returns the perf_counter() time of the start, i.e. the time of the first sample.
+        """
+        index = self.SR830_SAMPLE_RATES.index(rate_hz)
+        with DEVICELOCK(SR830):
+            # CH1 display: R, CH2 display: theta. The buffer stores the displays
+            SR830.write("DDEF 1,1,0")
+            SR830.write("DDEF 2,1,0")
+            SR830.write(f"SRAT {index}")
+            # One shot: stop at the end of the buffer instead of overwriting the points not yet read
+            SR830.write("SEND 0")
+            SR830.write("REST")
+            SR830.write("STRT")
+            return time.perf_counter()
+
+    def buffer_pause(self, SR830):
+        with DEVICELOCK(SR830):
+            SR830.write("PAUS")
+
+    def buffer_stop(self, SR830):
+        with DEVICELOCK(SR830):
+            SR830.write("PAUS")
+            SR830.write("REST")
+
+    def buffer_points(self, SR830) -> int:
+        with DEVICELOCK(SR830):
+            return int(SR830.query("SPTS?").strip())
+
+    def buffer_read(self, SR830, start, count) -> (np.ndarray, np.ndarray):
+        # TRCB? transfers IEEE floats (little endian) without any header or terminator
+        with DEVICELOCK(SR830):
+            u = SR830.query_binary_values(f"TRCB? 1,{start},{count}", datatype="f", is_big_endian=False,
+                                          header_fmt="empty", data_points=count, expect_termination=False,
+                                          container=np.array)
+            phase = SR830.query_binary_values(f"TRCB? 2,{start},{count}", datatype="f", is_big_endian=False,
+                                              header_fmt="empty", data_points=count, expect_termination=False,
+                                              container=np.array)
+        return u, phase
 
     def get_current_field(self):
         if FACILITY == Facility.BLUEFORS:
             # FIELD:MAGNET?
-            with DEVICELOCK:
+            with DEVICELOCK(self.H):
                 field, = self.H.query_ascii_values("FIELD:MAG?")
         elif FACILITY == Facility.CFMS:
-            with DEVICELOCK:
+            with DEVICELOCK(MSS):
                 field = MSS.get_platform_signal()[0]
         return field
 
     def get_target_field(self):
         if FACILITY == Facility.BLUEFORS:
             # FIELD:TARGET?
-            with DEVICELOCK:
+            with DEVICELOCK(self.H):
                 field, = self.H.query_ascii_values("FIELD:TARG?")
         elif FACILITY == Facility.CFMS:
             logging.warning("NOT IMPLEMENTED")
@@ -1125,19 +1643,19 @@ class Instruments:
 
     def set_target_field(self, field_in_T, rate_in_Tpermin):
         if FACILITY == Facility.BLUEFORS:
-            with DEVICELOCK:
+            with DEVICELOCK(self.H):
                 self.H.write("CONFIGURE:RAMP:RATE:FIELD 1,{},1;".format(rate_in_Tpermin))
                 self.H.write("CONFIGURE:FIELD:TARGET {};".format(field_in_T))
         elif FACILITY == Facility.CFMS:
-            with DEVICELOCK:
+            with DEVICELOCK(MSS):
                 MSS.set_field(field_in_T, rate_in_Tpermin)
 
     def get_field_rate(self) -> float:
         if FACILITY == Facility.BLUEFORS:
-            with DEVICELOCK:
+            with DEVICELOCK(self.H):
                 rate, limit = self.H.query_ascii_values("RAMP:RATE:FIELD:1?")
         elif FACILITY == Facility.CFMS:
-            with DEVICELOCK:
+            with DEVICELOCK(MSS):
                 rate = MSS.get_ramp_rate()[0]  # Tesla per minute
             return rate
         return rate
@@ -1145,7 +1663,7 @@ class Instruments:
     def get_magnet_state(self):
         if FACILITY == Facility.BLUEFORS:
             try:
-                with DEVICELOCK:
+                with DEVICELOCK(self.H):
                     state = int(self.H.query("STATE?").strip())
             except ValueError:
                 logging.info("Error parsing state!")
@@ -1170,7 +1688,7 @@ class Instruments:
                 return "UNKNOWN STATE (" + str(str) + ")"
 
         elif FACILITY == Facility.CFMS:
-            with DEVICELOCK:
+            with DEVICELOCK(MSS):
                 ramping = not MSS.get_SMS_ramp_status()
             if ramping:
                 return "RAMPING"
@@ -1186,21 +1704,21 @@ class Instruments:
             return (status == "RAMPING")
 
     def ramp(self):
-        with DEVICELOCK:
+        with DEVICELOCK(self.H):
             self.H.write("RAMP")
 
     def zero(self):
-        with DEVICELOCK:
+        with DEVICELOCK(self.H):
             self.H.write("ZERO")
 
     def quench_clear(self):
-        with DEVICELOCK:
+        with DEVICELOCK(self.H):
             self.H.write("QU 0")
 
     def tc_get_heater_range(self) -> (int, str, float):
         if FACILITY == Facility.BLUEFORS:
             try:
-                with DEVICELOCK:
+                with DEVICELOCK(self.T):
                     index = int(self.T.query("HTRRNG?").strip())
             except ValueError:
                 logging.info("Error parsing index from HTRRNG?")
@@ -1213,25 +1731,34 @@ class Instruments:
     def tc_heater_range_up(self):
         htrrange = self.tc_get_heater_range()[0]
         if htrrange < 8:
-            with DEVICELOCK:
+            with DEVICELOCK(self.T):
                 self.T.write("HTRRNG {}".format(htrrange + 1))
                 logging.info(f"TC heater range is set to {Instruments.TC_HEATER_RANGE_LABELS[htrrange + 1]}")
 
     def tc_heater_range_down(self):
         htrrange = self.tc_get_heater_range()[0]
         if htrrange > 0:
-            with DEVICELOCK:
+            with DEVICELOCK(self.T):
                 self.T.write("HTRRNG {}".format(htrrange - 1))
                 logging.info(f"TC heater range is set to {Instruments.TC_HEATER_RANGE_LABELS[htrrange - 1]}")
 
     def tc_heater_range_max(self):
-        with DEVICELOCK:
+        with DEVICELOCK(self.T):
             self.T.write("HTRRNG 8")
             logging.info(f"TC heater range is set to {Instruments.TC_HEATER_RANGE_LABELS[8]}")
 
+    def tc_resource(self):
+        # The resource answering temperature requests on the current facility (used for locking)
+        if FACILITY == Facility.BLUEFORS:
+            return self.T
+        elif FACILITY == Facility.CFMS:
+            return MSS
+        elif FACILITY == Facility.STUDENT_INSERT:
+            return self.LT1
+
     def get_target_temperature(self):
         if FACILITY == Facility.BLUEFORS:
-            with DEVICELOCK:
+            with DEVICELOCK(self.T):
                 temp_in_kelvin = float(self.T.query_ascii_values("SETP?")[0])
         elif FACILITY == Facility.CFMS:
             logging.warning("NOT IMPLEMENTED (AND WILL NEVER BE)")
@@ -1242,7 +1769,7 @@ class Instruments:
         return temp_in_kelvin
 
     def set_target_temperature(self, temp_in_kelvin, ramp_in_mK_per_min=None):
-        with DEVICELOCK:
+        with DEVICELOCK(self.tc_resource()):
             if FACILITY == Facility.BLUEFORS:
                 if ramp_in_mK_per_min is not None:
                     self.T.write(f"RAMP 1,{ramp_in_mK_per_min * 0.001}")
@@ -1257,7 +1784,7 @@ class Instruments:
                 MSS.set_temperature(temp_in_kelvin, ramp_in_mK_per_min * 0.001)
 
     def get_temperature(self, channel=None):
-        with DEVICELOCK:
+        with DEVICELOCK(self.tc_resource()):
             if FACILITY == Facility.BLUEFORS:
                 if channel is None:
                     if self.CONFIG_MEASURE_PT_FLANGE:
@@ -1275,7 +1802,7 @@ class Instruments:
                 return I.LT1.query_ascii_values("KRDG? A")[0]
 
     def get_temperature_ramp(self):
-        with DEVICELOCK:
+        with DEVICELOCK(self.tc_resource()):
             if FACILITY == Facility.BLUEFORS:
                 try:
                     Q = self.T.query_ascii_values("RAMP?")
@@ -1289,7 +1816,7 @@ class Instruments:
             return ramp, rate
 
     def get_temperature_ramping(self):
-        with DEVICELOCK:
+        with DEVICELOCK(self.tc_resource()):
             if FACILITY == Facility.BLUEFORS:
                 return bool(I.T.query_ascii_values("RAMPST?")[0])
             elif FACILITY == Facility.CFMS:
@@ -1298,24 +1825,24 @@ class Instruments:
             return ramping
 
     def select_channel(self, channel, autoscan):
-        with DEVICELOCK:
+        with DEVICELOCK(self.T):
             self.T.write("SCAN {},{}".format(channel, autoscan))
 
     def get_tc_channel(self):
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             # Returned:
             #     <channel>, <autoscan>[term]
             return int(I.T.query_ascii_values("SCAN?")[0])
 
     def tc_range(self):
         current_channel = self.get_tc_channel()
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {current_channel}")
             logging.info(f"TC range for channel {current_channel} is {self.TC_CURRENT_RANGE_LABELS[rng]}")
 
     def tc_range_up(self):
         current_channel = self.get_tc_channel()
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {current_channel}")
             if rng < 22:
                 I.T.write(f"RDGRNG {current_channel},{mode},{excitation},{rng + 1},{autorange},{cs}")
@@ -1323,7 +1850,7 @@ class Instruments:
 
     def tc_range_down(self):
         current_channel = self.get_tc_channel()
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {current_channel}")
             if rng > 1:
                 I.T.write(f"RDGRNG {current_channel},{mode},{excitation},{rng - 1},{autorange},{cs}")
@@ -1331,13 +1858,13 @@ class Instruments:
 
     def tc_current(self):
         current_channel = self.get_tc_channel()
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {current_channel}")
             logging.info(f"TC current for channel {current_channel} is {self.TC_CURRENT_EXC_LABELS[excitation]}")
 
     def tc_current_up(self):
         current_channel = self.get_tc_channel()
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {current_channel}")
             if excitation < 22:
                 I.T.write(f"RDGRNG {current_channel},{mode},{excitation + 1},{rng},{autorange},{cs}")
@@ -1345,14 +1872,14 @@ class Instruments:
 
     def tc_current_down(self):
         current_channel = self.get_tc_channel()
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {current_channel}")
             if excitation > 1:
                 I.T.write(f"RDGRNG {current_channel},{mode},{excitation - 1},{rng},{autorange},{cs}")
                 logging.info(f"Setting TC current to {self.TC_CURRENT_EXC_LABELS[excitation - 1]}")
 
     def tc_heater(self, heat_in_uwatt=None, log=True):
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             if heat_in_uwatt is None:
                 power = I.T.query_ascii_values("MOUT?")[0]
                 if log:
@@ -1362,7 +1889,7 @@ class Instruments:
                 I.T.write(f"MOUT {heat_in_uwatt * 1e-6}")
 
     def tc_mode(self, mode=None):
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             if mode is None:
                 mode = int(I.T.query_ascii_values("CMODE?")[0])
                 modestr = {1: "Closed loop PID", 2: "Zone Tuning", 3: "Open Loop", 4: "Off"}[mode]
@@ -1372,7 +1899,7 @@ class Instruments:
                 I.T.write(f"CMODE {mode}")
 
     def tc_get_channel_info(self, channel: int, log=True):
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             onoff, dwell, pause, curvenumber, tempcoeff = I.T.query_ascii_values(f"INSET? {channel}", converter="s")
             onoff, dwell, pause, curvenumber, tempcoeff = int(onoff), float(dwell), float(pause), int(curvenumber), int(
                 tempcoeff)
@@ -1383,47 +1910,354 @@ class Instruments:
 
     def tc_channel_off(self, channel: int):
         onoff, dwell, pause, curvenumber, tempcoeff = self.tc_get_channel_info(channel)
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             logging.info(f"TC: turning channel {channel} OFF")
             I.T.write(f"INSET {channel},0,{dwell},{pause},{curvenumber},{tempcoeff}")
 
     def tc_channel_on(self, channel: int):
         onoff, dwell, pause, curvenumber, tempcoeff = self.tc_get_channel_info(channel)
-        with DEVICELOCK:
+        with DEVICELOCK(I.T):
             logging.info(f"TC: turning channel {channel} ON")
             I.T.write(f"INSET {channel},1,{dwell},{pause},{curvenumber},{tempcoeff}")
 
     def get_current_angle(self):
-        with DEVICELOCK:
+        with DEVICELOCK(MSS):
             if FACILITY == Facility.BLUEFORS:
                 logging.warning("NOT IMPLEMENTED")
             elif FACILITY == Facility.CFMS:
                 return MSS.get_angle()[0]
 
     def set_target_angle(self, angle_deg, rate_deg_per_min):
-        with DEVICELOCK:
+        with DEVICELOCK(MSS):
             MSS.start_rotation(angle_deg, rate_deg_per_min)
 
     def get_rotator_state(self):
-        with DEVICELOCK:
+        with DEVICELOCK(MSS):
             return MSS.get_rotator_status()
 
 
+class ScheduledTask:
+    """
+    An acquisition task of the Measurer with its own sampling period (seconds, 0 - every point).
+
+    The task is due when its period has elapsed since the previous run. The values of the previous run are kept in
+    `last`, so a point where the task is not due can be stored sparsely (None) or forward-filled.
+    """
+
+    def __init__(self, name, function, period):
+        self.name = name
+        self.function = function
+        self.period = period
+        self.next_time = None
+        self.last = {}
+
+    def due(self, TIME) -> bool:
+        return self.next_time is None or TIME >= self.next_time
+
+    def __call__(self, TIME) -> dict:
+        result = self.function(TIME)
+        self.last = {key: value for key, value in result.items() if key != "buffer"}
+        self.next_time = TIME + self.period
+        return result
+
+
+class ErrorAggregator:
+    """
+    Failures of the acquisition, collapsed. A failure is identified by the task (the instrument), the place in this file
+    where it happened (the command that failed) and the exception. Only the first occurrence is logged with the
+    traceback: the repeats are counted and summarised every SUMMARY_PERIOD seconds. An instrument that has dropped out
+    does not flood the log, and the acquisition thread does not spend its time formatting tracebacks.
+    """
+
+    SUMMARY_PERIOD = 60.0
+
+    def __init__(self):
+        # key -> {"count", "first", "last", "reported"}, read by the monitoring thread
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.next_summary = None
+
+    @staticmethod
+    def key(task: str, exc: Exception) -> tuple:
+        # The innermost frame of this file, without formatting the traceback
+        place = None
+        tb = exc.__traceback__
+        while tb is not None:
+            if tb.tb_frame.f_code.co_filename == __file__:
+                place = f"{tb.tb_frame.f_code.co_name}:{tb.tb_lineno}"
+            tb = tb.tb_next
+        return task, place, type(exc).__name__, str(exc)
+
+    def report(self, task: str, exc: Exception):
+        key = self.key(task, exc)
+        now = time.time()
+        with self.lock:
+            entry = self.errors.get(key)
+            new = entry is None
+            if new:
+                entry = self.errors[key] = {"count": 0, "first": now, "last": now, "reported": 1}
+            entry["count"] += 1
+            entry["last"] = now
+
+        if new:
+            logging.warning(f"MEASURER: {task} failed in {key[1]}: {key[2]}: {key[3]}", exc_info=exc)
+        self.summarize()
+
+    def summarize(self, force=False):
+        """ Logs the repeats since the previous summary, at most every SUMMARY_PERIOD seconds unless forced """
+        now = time.time()
+        if not force and self.next_summary is not None and now < self.next_summary:
+            return
+        self.next_summary = now + self.SUMMARY_PERIOD
+
+        with self.lock:
+            for (task, place, error, message), entry in self.errors.items():
+                repeats = entry["count"] - entry["reported"]
+                if repeats:
+                    entry["reported"] = entry["count"]
+                    logging.warning(
+                        "MEASURER: {} failed {} more times in {} ({} in total, first {:%H:%M:%S}, last {:%H:%M:%S}): "
+                        "{}: {}".format(task, repeats, place, entry["count"],
+                                        datetime.datetime.fromtimestamp(entry["first"]),
+                                        datetime.datetime.fromtimestamp(entry["last"]), error, message))
+
+    def counters(self) -> list:
+        """ The failures for the monitoring: task, place, error, message, count, first and last (Unix time) """
+        with self.lock:
+            return [{"task": task, "place": place, "error": error, "message": message,
+                     "count": entry["count"], "first": entry["first"], "last": entry["last"]}
+                    for (task, place, error, message), entry in self.errors.items()]
+
+
+class SR830Autorange:
+    """
+    Bidirectional autorange of a SR830 driven by the measured R.
+
+    The sensitivity goes up when |R| is above UP of the full scale and down when it is below DOWN. The new range is
+    the lowest one where |R| is within TARGET of the full scale (at least one range up: an overloaded R is clipped),
+    so the hysteresis between TARGET and UP/DOWN keeps it from oscillating. A change needs SAMPLES samples in a row,
+    and after a change the lock-in is left to settle for HOLD time constants. The full scale comes from the cached
+    state (SR830State), so a change costs one write. Nothing is done while offset/expand of R is on.
+    """
+
+    UP = 0.9
+    DOWN = 0.2
+    TARGET = 0.5
+    SAMPLES = 3
+    HOLD = 3
+    MIN_HOLD = 0.3
+
+    def __init__(self, name, sr830):
+        self.name = name
+        self.sr830 = sr830
+        self.above = 0
+        self.below = 0
+        self.hold_until = -np.inf
+
+    def observe(self, TIME, u):
+        if TIME < self.hold_until or u is None or not np.isfinite(u):
+            return
+        offset, expand = I.get_offset_expand(self.sr830)
+        if offset or expand:
+            return
+
+        index, full_scale = I.get_full_scale(self.sr830)
+        if full_scale is None:
+            # Unknown range or input: no decision, the next sample asks again
+            return
+        if abs(u) > self.UP * full_scale:
+            self.above, self.below = self.above + 1, 0
+        elif abs(u) < self.DOWN * full_scale:
+            self.above, self.below = 0, self.below + 1
+        else:
+            self.above, self.below = 0, 0
+
+        if self.above >= self.SAMPLES and index < len(Instruments.SR830_SENSITIVITIES) - 1:
+            self.change(TIME, max(index + 1, self.target(u, full_scale / Instruments.SR830_SENSITIVITIES[index])))
+        elif self.below >= self.SAMPLES and index > 0:
+            self.change(TIME, self.target(u, full_scale / Instruments.SR830_SENSITIVITIES[index]))
+
+    def target(self, u, scale) -> int:
+        """ The lowest range with |u| within TARGET of the full scale (scale: the multiplier of the input) """
+        for index, sensitivity in enumerate(Instruments.SR830_SENSITIVITIES):
+            if abs(u) <= self.TARGET * sensitivity * scale:
+                return index
+        return len(Instruments.SR830_SENSITIVITIES) - 1
+
+    def overload(self, TIME):
+        """ The lock-in reports an overload: the cached range may be stale, read it again and go one range up """
+        I.sr830_state.invalidate(self.sr830)
+        index, full_scale = I.get_full_scale(self.sr830)
+        if index is not None and index < len(Instruments.SR830_SENSITIVITIES) - 1:
+            self.change(TIME, index + 1)
+
+    def change(self, TIME, index):
+        logging.info(f"{self.name}: autorange to {Instruments.SR830_SENSITIVITIES[index]:g} V (SENS {index})")
+        I.set_sensitivity(self.sr830, index)
+        self.above, self.below = 0, 0
+        self.hold_until = TIME + max(self.HOLD * I.get_rc_seconds(self.sr830), self.MIN_HOLD)
+
+
+class ScannerSampler:
+    """
+    Reads every channel of the LakeShore 370 scanner once per dwell, just before the scanner switches to the next
+    channel, when the reading has settled.
+
+    The time of the reading and of the next switch are predicted from the pause and dwell times of the channel
+    (INSET?). SCAN? is only queried to confirm the channel before the reading and, around the predicted switch, to
+    catch the actual switch time (at most every SYNC_PERIOD seconds). If the prediction turns out to be wrong, the
+    sampler waits for the next switch and starts over.
+    """
+
+    # Channel -> (key of the point, query)
+    CHANNELS = {1: ("t1", "RDGK?"), 2: ("t2", "RDGK?"), 3: ("t3", "RDGK?"), 5: ("t5", "RDGK?"), 6: ("t6", "RDGK?"),
+                7: ("t7", "RDGR?"), 8: ("t8", "RDGR?")}
+    # Read this long (seconds) before the predicted end of the dwell, at most half of the dwell
+    MARGIN = 1.0
+    SYNC_PERIOD = 0.25
+
+    def __init__(self):
+        self.timings = {}
+        self.channel = None
+        # perf_counter() time the scanner has switched to self.channel, None - unknown
+        self.switch_time = None
+        self.read_done = False
+        self.last_scan = 0
+
+    def start(self):
+        self.channel, autoscan = self.scan()
+        self.switch_time = None
+        self.read_done = False
+
+    def timing(self, channel) -> (float, float):
+        """ (pause, dwell) of the channel """
+        if channel not in self.timings:
+            onoff, dwell, pause, curvenumber, tempcoeff = I.tc_get_channel_info(channel)
+            self.timings[channel] = (pause, dwell)
+        return self.timings[channel]
+
+    def scan(self) -> (int, int):
+        self.last_scan = time.perf_counter()
+        with DEVICELOCK(I.T):
+            channel, autoscan = [int(X) for X in I.T.query_ascii_values("SCAN?")]
+        return channel, autoscan
+
+    def read(self, channel) -> dict:
+        if channel not in self.CHANNELS:
+            logging.info("UNKNOWN CHANNEL!")
+            return {}
+        key, query = self.CHANNELS[channel]
+        with DEVICELOCK(I.T):
+            return {key: float(I.T.query(f"{query} {channel}").strip())}
+
+    def poll(self) -> dict:
+        """ Returns the settled reading of the current channel ({"t5": ...}) once per dwell, otherwise {} """
+        now = time.perf_counter()
+
+        if self.switch_time is None or self.read_done:
+            # Waiting for the switch to the next channel
+            if self.switch_time is not None:
+                pause, dwell = self.timing(self.channel)
+                if now < self.switch_time + pause + dwell - self.SYNC_PERIOD:
+                    return {}
+            if now - self.last_scan < self.SYNC_PERIOD:
+                return {}
+
+            channel, autoscan = self.scan()
+            if channel != self.channel or not autoscan:
+                pause, dwell = self.timing(channel)
+                self.channel = channel
+                # Without autoscan the channel never switches: one reading per dwell, no pause
+                self.switch_time = now if autoscan else now - pause
+                self.read_done = False
+            return {}
+
+        pause, dwell = self.timing(self.channel)
+        if now < self.switch_time + pause + dwell - min(self.MARGIN, dwell / 2):
+            return {}
+
+        channel, autoscan = self.scan()
+        if channel != self.channel:
+            # Wrong prediction (e.g. the timings have been changed): wait for the next switch
+            self.channel = channel
+            self.switch_time = None
+            return {}
+
+        self.read_done = True
+        return self.read(channel)
+
+
+class SR830Buffer:
+    """
+    The internal buffer of a SR830 used as an evenly sampled source of R and theta (see Measurer.BUFFER_RATE).
+
+    drain() transfers the points stored since the previous call in binary form. Every point gets the time of its
+    sample number on one sample clock: t0 + number / rate, counted from the first start.
+
+    The buffer is one-shot and it is restarted when half full, so it never stops on overflow. (In the loop mode
+    SPTS? stays at the buffer size once the buffer has wrapped, so the number of new points would be unknown.)
+    The storage is paused before the restart and everything stored until then is read, so no stored point is lost.
+    The samples that are not taken while the buffer is restarted (a few ms: one or two samples at 512 Hz) are a gap
+    in the data: the sample number of the first point after the restart is found from the time of the restart,
+    rounded to the sample clock, so the points stay on the clock without a jump. The skipped samples are counted in
+    `skipped`.
+    """
+
+    # Default period of the drain task (see Measurer.PERIODS), a transfer has an overhead of two queries
+    DRAIN_PERIOD = 0.5
+
+    def __init__(self, sr830, rate_hz, start_time):
+        self.sr830 = sr830
+        self.rate = rate_hz
+        # Time origin of the Measurer (perf_counter() based)
+        self.start_time = start_time
+        self.t0 = None
+        # Sample number of the first point of the buffer, points of the buffer already read
+        self.offset = 0
+        self.read = 0
+        self.skipped = 0
+
+    def start(self):
+        self.t0 = I.buffer_start(self.sr830, self.rate) - self.start_time
+        self.offset = self.read = self.skipped = 0
+
+    def restart(self):
+        started = I.buffer_start(self.sr830, self.rate) - self.start_time
+        expected = self.offset + self.read
+        number = max(expected, int(round((started - self.t0) * self.rate)))
+        self.skipped += number - expected
+        self.offset, self.read = number, 0
+
+    def stop(self):
+        I.buffer_stop(self.sr830)
+
+    def read_points(self, stored) -> (np.ndarray, np.ndarray, np.ndarray):
+        if stored <= self.read:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        u, phase = I.buffer_read(self.sr830, self.read, stored - self.read)
+        times = self.t0 + (self.offset + self.read + np.arange(stored - self.read)) / self.rate
+        self.read = stored
+        return times, u, phase
+
+    def drain(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """ Returns (times, R, theta) of the new points """
+        stored = I.buffer_points(self.sr830)
+        if stored < Instruments.SR830_BUFFER_SIZE // 2:
+            return self.read_points(stored)
+
+        I.buffer_pause(self.sr830)
+        times, u, phase = self.read_points(I.buffer_points(self.sr830))
+        self.restart()
+        return times, u, phase
+
+
 class DiDvMeasurer(threading.Thread):
     def __init__(self):
         super().__init__()
 
-        self.TIME = []
-        self.R1, self.PHASE1, self.R1annotations = [], [], []
-        self.R2, self.PHASE2, self.R2annotations = [], [], []
-        self.R3, self.PHASE3, self.R3annotations = [], [], []
-        self.R4, self.PHASE4, self.R4annotations = [], [], []
-        self.RK = []
-        self.R5, self.R6 = [], []
-        self.H, self.HALL = [], []
-        self.T, self.Tsample = [], []
-        self.T1, self.T2, self.T3, self.T5, self.T6 = [], [], [], [], []
-        self.T7, self.T8 = [], []
+        # Current (A), time (s) and dV/dI (Ohm) of every point of the sweep
+        self.data = ChannelStore(["I", "time", "dVdI"])
+        self.R1annotations, self.R2annotations, self.R3annotations, self.R4annotations = [], [], [], []
 
         self.START_TIME = time.perf_counter()
 
@@ -1431,10 +2265,13 @@ class DiDvMeasurer(threading.Thread):
         self.current_finish = None
         self.numsteps = None
         self.current_delta = None
+        # Failures of the polling of the sweep, collapsed (see ErrorAggregator), read by the monitoring thread
+        self.errors = ErrorAggregator()
 
         self.stopped = False
         self.sample = None
         self.name = None
+        self.EXPERIMENT = "didv"
 
     def init_files(self, sample, name):
         dirname = "{:%Y-%m-%d}".format(datetime.datetime.today())
@@ -1444,19 +2281,17 @@ class DiDvMeasurer(threading.Thread):
         os.makedirs(os.path.join("data", dirname), exist_ok=True)
 
         self.data_filename = os.path.join("data", dirname, data_filename)
-        self.datafile = open(self.data_filename, "wt")
+        self.datafile = DataWriter(self.data_filename)
 
     def write_header(self):
         P = ["I", "time", "dV/dI"]
         U = ["A", "seconds", "Ohm"]
-        self.datafile.write("\t".join(P) + "\n")
-        self.datafile.write("\t".join(U) + "\n")
-        self.datafile.flush()
+        self.datafile.write_row(P)
+        self.datafile.write_row(U)
 
     def write_data(self, I_amps, time_seconds, dVdI_ohms):
         D = [I_amps, time_seconds, dVdI_ohms]
-        self.datafile.write("\t".join([str(x) for x in D]) + "\n")
-        self.datafile.flush()
+        self.datafile.write_row(D)
 
     def run(self):
         logging.info("DiDvMeasurer: Measurements started")
@@ -1466,6 +2301,8 @@ class DiDvMeasurer(threading.Thread):
         I.K6221.write("*RST")
         # Possible values: V, OHMS, W, SIEM
         I.K6221.write("UNIT OHMS")
+        # The trace is transferred as doubles instead of text
+        keithley6221.set_data_format(I.K6221, keithley6221.DATA_FORMATS.DREAL)
 
         I.K6221.write(f"SOUR:DCON:STAR {self.current_start}")
         I.K6221.write(f"SOUR:DCON:STOP {self.current_finish}")
@@ -1493,7 +2330,12 @@ class DiDvMeasurer(threading.Thread):
 
         while not self.stopped:
             time.sleep(1)
-            status = int(I.K6221.query("STAT:OPER:COND?"))
+            try:
+                status = int(I.K6221.query("STAT:OPER:COND?"))
+            except Exception as exc:
+                # The sweep goes on in the instrument, the next poll may succeed
+                self.errors.report("keithley", exc)
+                continue
             bit_calibrating = bool(status & 0b0001)
             bit_sweepdone = bool(status & 0b0010)
             bit_sweeping = bool(status & 0b1000)
@@ -1507,20 +2349,257 @@ class DiDvMeasurer(threading.Thread):
         logging.info(f"DiDvMeasurer: Zero voltage = {self.zero_voltage} V")
 
         self.write_header()
-        self.data = I.K6221.query_ascii_values("TRAC:DATA?")
-        for index, (ohm, t) in enumerate(zip(self.data[::2], self.data[1::2])):
-            self.write_data(index * self.current_step + self.current_start, t, ohm)
+        # Only the readings actually stored, not the whole TRAC:POIN buffer
+        count = int(I.K6221.query("TRAC:POIN:ACT?"))
+        if count == 0:
+            # Aborted or in compliance before the first reading: TRAC:DATA:SEL? 0,0 is an error
+            logging.warning("DiDvMeasurer: The buffer is empty, no data")
+            trace = np.zeros((0, 2))
+        else:
+            trace = keithley6221.query_trace(I.K6221, keithley6221.DATA_FORMATS.DREAL, start=0, count=count)
+        currents = np.arange(len(trace)) * self.current_step + self.current_start
+        for current, (ohm, t) in zip(currents, trace):
+            self.data.append(I=current, time=t, dVdI=ohm)
+            self.write_data(current, t, ohm)
 
         I.K6221.write(f"SOUR:SWE:ABOR")
+        self.datafile.close()
+        self.errors.summarize(force=True)
 
         logging.info("DiDvMeasurer: Measurements stopped")
         self.stopped = True
+        TELEMETRY.notify()
 
     def requestInterruption(self):
         self.stopped = True
 
 
+class Telemetry:
+    """
+    The latest values read by the acquisition loop (the keys of Measurer.read_point: "h", "t", ...), shared with the
+    waits of the Program. The Measurer calls update() with every reading, and the waits sleep on the condition until
+    their predicate holds: they need no instrument queries of their own and wake up with the first reading that
+    satisfies them, or at once on notify() (e.g. a stop request). The recent readings of every channel are kept for
+    the stability criteria (see WaitForStable).
+    """
+
+    HISTORY_POINTS = 100000
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # channel -> (value, time.monotonic() of the value)
+        self.values = {}
+        # channel -> (time.monotonic(), value) of the last HISTORY_POINTS readings
+        self.history = collections.defaultdict(lambda: collections.deque(maxlen=self.HISTORY_POINTS))
+
+    def update(self, values: dict):
+        now = time.monotonic()
+        with self.condition:
+            for name, value in values.items():
+                if value is not None:
+                    self.values[name] = (value, now)
+                    self.history[name].append((now, value))
+            self.condition.notify_all()
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def get(self, name: str, max_age: Optional[float] = None) -> Optional[float]:
+        """ The latest value of the channel, None if there is none (or it is older than max_age seconds) """
+        with self.condition:
+            value, timestamp = self.values.get(name, (None, None))
+        if value is None or (max_age is not None and time.monotonic() - timestamp > max_age):
+            return None
+        return value
+
+    def window(self, name: str, seconds: float) -> (np.ndarray, np.ndarray):
+        """ (times, values) of the readings of the last `seconds` seconds and the reading just before them """
+        with self.condition:
+            history = self.history[name]
+            start = time.monotonic() - seconds
+            first = len(history)
+            while first > 0 and history[first - 1][0] >= start:
+                first -= 1
+            points = [history[i] for i in range(max(first - 1, 0), len(history))]
+        times, values = np.array(points, dtype=float).reshape(-1, 2).T
+        return times, values
+
+    def wait_until(self, predicate, timeout: Optional[float] = None, stop=lambda: False) -> bool:
+        """ Waits for predicate() to become true. False on the timeout or if stop() becomes true. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if stop():
+                    return False
+                if predicate():
+                    return True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+
+
+TELEMETRY = Telemetry()
+
+
+# Channels of the Measurer data store. Every point is one row, missing values are NaN.
+# RELAX tags the rows of a step experiment: 1 - taken during the relaxation after a step, 0 - measured.
+MEASURER_CHANNELS = ["TIME",
+                     "R1", "PHASE1", "R2", "PHASE2", "R3", "PHASE3", "R4", "PHASE4",
+                     "RK", "R5", "R6", "H", "HALL",
+                     "T", "Tsample1", "Tsample2", "T1", "T2", "T3", "T5", "T6", "T7", "T8",
+                     "R_Sample", "Ux", "Uy", "Ur", "Theta", "RELAX"]
+
+
+class AdaptiveStep:
+    """
+    Adaptive relax and measure times of a step experiment, driven by the lock-in outputs and their time constants.
+
+    The relaxation after a step lasts at least TAUS time constants (the longest one of the lock-ins). It ends when
+    the outputs have settled: over the last WINDOW time constants (MIN_POINTS points at least) the drift of the
+    least-squares line is within TOLERANCE of the mean, or within the noise of the fit. The measurement ends when the
+    standard error of the mean of every output is within TARGET_SEM of the mean. Points closer than 2 time constants
+    are not independent, so there are at most (measured time) / 2tau of them. The configured relax and measure times
+    are the upper limits.
+    """
+
+    WINDOW = 3
+    MIN_POINTS = 5
+
+    def __init__(self, taus: float = 5, tolerance: float = 1e-3, target_sem: float = 1e-4):
+        self.TAUS = taus
+        self.TOLERANCE = tolerance
+        self.TARGET_SEM = target_sem
+        self.channels = []
+        self.tau = 0.0
+        self.first_row = 0
+        self.settled = None
+
+    def start(self, channels: list, tau: float, first_row: int):
+        """ A new step: the outputs are the store channels `channels`, its points start at first_row """
+        self.channels = channels
+        self.tau = tau
+        self.first_row = first_row
+        self.settled = None
+
+    def relaxing(self, TIME, step_time, relax_time, data: ChannelStore) -> bool:
+        if self.settled is None:
+            elapsed = TIME - step_time
+            if elapsed >= relax_time or (elapsed >= self.TAUS * self.tau and self.is_settled(TIME, data)):
+                self.settled = TIME
+                logging.info(f"MEASURER: Settled in {elapsed:.3g} s")
+        return self.settled is None or TIME < self.settled
+
+    def is_settled(self, TIME, data: ChannelStore) -> bool:
+        snapshot = data.snapshot()
+        times = snapshot["TIME"][self.first_row:]
+        first = min(int(np.searchsorted(times, TIME - self.WINDOW * self.tau)), len(times) - self.MIN_POINTS)
+        if first < 0 or not self.channels:
+            return False
+        for channel in self.channels:
+            values = snapshot[channel][self.first_row + first:]
+            n = np.count_nonzero(np.isfinite(values))
+            if n < self.MIN_POINTS:
+                return False
+            slope, scatter = linear_fit(times[first:], values)
+            # The drift of a line fitted to n points spread over the window is known to 2 scatter sqrt(12 / n)
+            noise = 2 * scatter * np.sqrt(12 / n)
+            if not abs(slope) * (times[-1] - times[first]) <= self.TOLERANCE * abs(np.nanmean(values)) + noise:
+                return False
+        return True
+
+    def finished(self, TIME, measure_time, stats: RunningStats) -> bool:
+        if self.settled is None or not self.channels:
+            return False
+        elapsed = TIME - self.settled
+        if elapsed >= measure_time:
+            return True
+        for channel in self.channels:
+            count = stats.count[stats.names.index(channel)]
+            if count < self.MIN_POINTS:
+                return False
+            independent = min(count, elapsed / (2 * self.tau)) if self.tau > 0 else count
+            if independent < 2:
+                return False
+            sem = stats.std(channel) / np.sqrt(independent)
+            if not sem <= self.TARGET_SEM * abs(stats.mean(channel)):
+                return False
+        logging.info(f"MEASURER: Measured in {elapsed:.3g} s")
+        return True
+
+
+class StepRefinement:
+    """
+    Adaptive grid of a step experiment: after the coarse grid, the steps are added where the curve changes most.
+
+    The loss of an interval between two measured steps is its length in the plane (step, signal), both scaled to
+    their range, plus the curvature at its ends (the distance of a point from the line through its neighbours). Every
+    round splits the BATCH part of the intervals with the largest loss in two, until `budget` steps are measured.
+    Intervals shorter than 2 min_spacing are not split. The loss of every signal (the lock-in outputs) is computed
+    separately and the largest one is taken, constant signals (the ones that are not measured) are skipped.
+    """
+
+    BATCH = 0.25
+
+    def __init__(self, budget: int, min_spacing: float, descending: bool = False):
+        self.budget = budget
+        self.min_spacing = min_spacing
+        self.descending = descending
+        # step -> {signal: mean}
+        self.points = {}
+
+    def add(self, step: float, means: dict):
+        self.points[step] = means
+
+    def losses(self) -> (np.ndarray, np.ndarray):
+        """ (sorted steps, loss of every interval between them) """
+        x = np.array(sorted(self.points))
+        dx = np.diff(x)
+        signals = sorted({name for means in self.points.values() for name in means})
+        loss = dx / (x[-1] - x[0])
+        for name in signals:
+            y = np.array([self.points[step].get(name, np.nan) for step in x], dtype=float)
+            span = np.nanmax(y) - np.nanmin(y) if np.any(np.isfinite(y)) else 0
+            if not span > 0:
+                continue
+            y = y / span
+            curvature = np.zeros(len(x))
+            curvature[1:-1] = np.abs(y[1:-1] - y[:-2] - (y[2:] - y[:-2]) * (x[1:-1] - x[:-2]) / (x[2:] - x[:-2]))
+            signal_loss = np.hypot(dx / (x[-1] - x[0]), np.diff(y)) + np.maximum(curvature[:-1], curvature[1:])
+            loss = np.maximum(loss, np.nan_to_num(signal_loss))
+        return x, loss
+
+    def next_steps(self) -> list:
+        """ The steps of the next round in the sweep direction, empty when the budget is spent or nothing is left """
+        remaining = self.budget - len(self.points)
+        if remaining <= 0 or len(self.points) < 2:
+            return []
+        x, loss = self.losses()
+        middles = (x[:-1] + x[1:]) / 2
+        candidates = [i for i in np.argsort(-loss, kind="stable")
+                      if x[i + 1] - x[i] >= 2 * self.min_spacing and x[i] < middles[i] < x[i + 1]]
+        count = min(remaining, max(1, math.ceil(self.BATCH * len(loss))))
+        steps = sorted(float(middles[i]) for i in candidates[:count])
+        logging.info(f"MEASURER: Refining {len(steps)} intervals, {remaining} steps left")
+        return steps[::-1] if self.descending else steps
+
+
 class Measurer(threading.Thread):
+    # If the program has a wait-for-stable (see STABLE_OUTPUT), every row of the data file ends with the last
+    # stability criterion met: the time it was met (the rows after it are valid), its tolerance (K for T, T for H), its
+    # window and how long the wait took, nan before the first one
+    STABLE_COLUMNS = ["Stable_since", "Stable_within", "Stable_for", "Settle"]
+    STABLE_UNITS = ["seconds", "K|T", "seconds", "seconds"]
+    # The channels of the store in the columns of the data file (write_data, write_data_cooldown)
+    DATA_COLUMNS = ["TIME", "R1", "PHASE1", "R2", "PHASE2", "R3", "PHASE3", "R4", "PHASE4", "H", "HALL", "T", "T7",
+                    "T8", "RK", "Tsample1", "Tsample2", "R_Sample", "Ux", "Uy", "Ur", "Theta"]
+    COOLDOWN_COLUMNS = ["TIME", "R1", "PHASE1", "R2", "PHASE2", "R3", "PHASE3", "R4", "PHASE4", "H", "HALL", "T1",
+                        "T2", "T3", "T5", "T6", "T7", "T8"]
+    # The channels of the store of the lock-in values of a point (see store_point)
+    POINT_CHANNELS = {"u1": "R1", "phase1": "PHASE1", "u2": "R2", "phase2": "PHASE2", "u3": "R3", "phase3": "PHASE3",
+                      "u4": "R4", "phase4": "PHASE4", "ux": "Ux", "uy": "Uy", "ur": "Ur", "theta": "Theta"}
+
     def __init__(self):
         logging.info("MEASURER: __init__")
 
@@ -1537,24 +2616,52 @@ class Measurer(threading.Thread):
         # self.STEP_MEASURE_TIME = 27.000
         # self.STEP_LIST = list(np.linspace(5, 3, 100))
         self.STEP_LASTTIME = None
-        self.STEP_FIRSTPOINT = None
-
-        self.TIME = []
-        self.R1, self.PHASE1, self.R1annotations = [], [], []
-        self.R2, self.PHASE2, self.R2annotations = [], [], []
-        self.R3, self.PHASE3, self.R3annotations = [], [], []
-        self.R4, self.PHASE4, self.R4annotations = [], [], []
-        self.RK = []
-        self.R5, self.R6 = [], []
-        self.H, self.HALL = [], []
-        self.T, self.Tsample1, self.Tsample2 = [], [], []
-        self.T1, self.T2, self.T3, self.T5, self.T6 = [], [], [], [], []
-        self.T7, self.T8 = [], []
-        self.R_Sample = []
-        self.Ux, self.Uy, self.Ur, self.Theta = [], [], [], []
+
+        self.data = ChannelStore(MEASURER_CHANNELS)
+        # Statistics of the measured (not relax) points of the current step
+        self.step_stats = RunningStats(MEASURER_CHANNELS)
+        self.errors = ErrorAggregator()
+        self.R1annotations, self.R2annotations, self.R3annotations, self.R4annotations = [], [], [], []
         self.START_TIME = time.perf_counter()
 
+        # If True, the sensitivity of R1..R4 follows the signal (see SR830Autorange)
         self.AUTORANGE = True
+        self.autorange = {}
+        # If True, the instruments are polled in parallel for every point (see acquisition_tasks)
+        self.CONCURRENT = False
+        # Durability of the data files, see DataWriter
+        self.WRITER_POLICY = {"flush_rows": 50, "flush_seconds": 1.0, "fsync_seconds": 60.0}
+        # If True, the data file is also written in the chunked binary format (storage.binary)
+        self.BINARY_OUTPUT = False
+        self.binfile = None
+        # If set (Hz, one of Instruments.SR830_SAMPLE_RATES), the lock-ins are read from their internal buffers
+        self.BUFFER_RATE = None
+        self.buffers = {}
+        # Sampling period (seconds) of every acquisition task, 0 means every point (see acquisition_tasks). All the
+        # tasks run at every point unless the program sets a period (config period-<task>), so every row has a value
+        # of every channel, as before the periods.
+        self.PERIODS = {"R1": 0, "R2": 0, "R3": 0, "R4": 0, "Lockin": 0,
+                        "field": 0, "hall": 0, "lakeshore": 0, "keithley": 0, "rk": 0, "tc": 0,
+                        "scanner": 0}
+        # Cooldown: reads T1..T8 from the LakeShore scanner (see ScannerSampler)
+        self.scanner = None
+        # Values of the tasks that are not due at a point: "sparse" (missing) or "forward" (the previous value)
+        self.FILL = "sparse"
+        # The lock-in status (overload etc.) is checked every STATUS_PERIOD seconds
+        self.STATUS_PERIOD = 5.0
+        self.status_time = {}
+        # If set (AdaptiveStep), the relax and measure times of a step are adaptive, STEP_RELAX_TIME and
+        # STEP_MEASURE_TIME are their limits
+        self.ADAPTIVE = None
+        # If set (StepRefinement), the steps are added to STEP_LIST as the sweep goes, and the proc file is sorted
+        # by the step at the end
+        self.REFINE = None
+        self.proc_header = []
+        self.proc_rows = []
+        # The data file has the STABLE_COLUMNS (set by the Program, see ProgramState.stable_output)
+        self.STABLE_OUTPUT = False
+        # The last stability criterion met by the Program (see WaitForStable and STABLE_COLUMNS)
+        self.STABLE = (math.nan, math.nan, math.nan, math.nan)
 
         self.stopped = False
         self.sample = None
@@ -1569,9 +2676,32 @@ class Measurer(threading.Thread):
         os.makedirs(os.path.join("data", dirname), exist_ok=True)
 
         self.data_filename = os.path.join("data", dirname, data_filename)
-        self.datafile = open(self.data_filename, "wt")
+        self.datafile = DataWriter(self.data_filename, **self.WRITER_POLICY)
         self.proc_filename = os.path.join("data", dirname, proc_filename)
-        self.procfile = open(self.proc_filename, "wt")
+        self.procfile = DataWriter(self.proc_filename, **self.WRITER_POLICY)
+
+    def init_binary_file(self, names, units):
+        if self.BINARY_OUTPUT:
+            self.bin_filename = os.path.splitext(self.data_filename)[0] + ".bin"
+            self.binfile = BinaryDataWriter(self.bin_filename, names, units, **self.WRITER_POLICY)
+
+    def close_files(self):
+        self.datafile.close()
+        self.procfile.close()
+        if self.binfile is not None:
+            self.binfile.close()
+        if self.REFINE is not None:
+            self.sort_proc_file()
+
+    def sort_proc_file(self):
+        """ Rewrites the proc file with the steps in order (a refined sweep visits them out of order) """
+        reverse = self.REFINE.descending
+        temporary = self.proc_filename + ".sorted"
+        writer = DataWriter(temporary, **self.WRITER_POLICY)
+        for row in self.proc_header + sorted(self.proc_rows, key=lambda row: row[0], reverse=reverse):
+            writer.write_row(row)
+        writer.close()
+        os.replace(temporary, self.proc_filename)
 
     def write_header(self):
         if I.CONFIG_MEASURE_R1_CURRENT:
@@ -1582,9 +2712,12 @@ class Measurer(threading.Thread):
              'T_Sample_1', 'T_Sample_2', 'R_Sample', 'Ux', 'Uy', 'Ur', 'Theta']
         U = ["seconds", 'U1', "degrees", "V", "degrees", "V", "degrees", "V", "degrees", "T", "Ohm", "K", "Ohm", "Ohm",
              "Ohm", 'K', 'K', "Ohm", 'V', 'V', 'V', 'degrees']
-        self.datafile.write("\t".join(P) + "\n")
-        self.datafile.write("\t".join(U) + "\n")
-        self.datafile.flush()
+        if self.STABLE_OUTPUT:
+            P += self.STABLE_COLUMNS
+            U += self.STABLE_UNITS
+        self.datafile.write_row(P)
+        self.datafile.write_row(U)
+        self.init_binary_file(P, U)
 
     def write_data(self, time_secs, U1_volts, Phase1_degrees, U2_volts, Phase2_degrees, U3_volts, Phase3_degrees,
                    U4_volts, Phase4_degrees, H_T, Hall_volts, T_K, T7_Ohm, T8_Ohm, RK_Ohm, T_Sample1_K, T_Sample2_K,
@@ -1592,8 +2725,11 @@ class Measurer(threading.Thread):
         D = [time_secs, U1_volts, Phase1_degrees, U2_volts, Phase2_degrees, U3_volts, Phase3_degrees, U4_volts,
              Phase4_degrees, H_T, Hall_volts, T_K, T7_Ohm, T8_Ohm, RK_Ohm, T_Sample1_K, T_Sample2_K, R_Sample_Ohm, X_V,
              Y_V, R_V, Theta_degrees]
-        self.datafile.write("\t".join([str(x) for x in D]) + "\n")
-        self.datafile.flush()
+        if self.STABLE_OUTPUT:
+            D += self.STABLE
+        self.datafile.write_row(D)
+        if self.binfile is not None:
+            self.binfile.write_row(D)
 
     def write_header_cooldown(self):
         if I.CONFIG_MEASURE_R1_CURRENT:
@@ -1606,17 +2742,27 @@ class Measurer(threading.Thread):
                  "T5", "T6", "T7", "T8"]
             U = ["seconds", "V", "degrees", "V", "degrees", "V", "degrees", "V", "degrees", "T", "Ohm", "K", "K", "K",
                  "K", "K", "Ohm", "Ohm"]
-        self.datafile.write("\t".join(P) + "\n")
-        self.datafile.write("\t".join(U) + "\n")
-        self.datafile.flush()
+        if self.STABLE_OUTPUT:
+            P += self.STABLE_COLUMNS
+            U += self.STABLE_UNITS
+        self.datafile.write_row(P)
+        self.datafile.write_row(U)
+        self.init_binary_file(P, U)
 
     def write_data_cooldown(self, time_secs, U1_volts, Phase1_degrees, U2_volts, Phase2_degrees, U3_volts,
                             Phase3_degrees, U4_volts, Phase4_degrees, H_T, Hall_volts, T1_K, T2_K, T3_K, T5_K, T6_K,
                             T7_Ohm, T8_Ohm):
         D = [time_secs, U1_volts, Phase1_degrees, U2_volts, Phase2_degrees, U3_volts, Phase3_degrees, U4_volts,
              Phase4_degrees, H_T, Hall_volts, T1_K, T2_K, T3_K, T5_K, T6_K, T7_Ohm, T8_Ohm]
-        self.datafile.write("\t".join([str(x) for x in D]) + "\n")
-        self.datafile.flush()
+        if self.STABLE_OUTPUT:
+            D += self.STABLE
+        self.datafile.write_row(D)
+        if self.binfile is not None:
+            self.binfile.write_row(D)
+
+    def mark_stable(self, within, window, settle):
+        """ The stability criterion has just been met: it is written with every following row """
+        self.STABLE = (time.perf_counter() - self.START_TIME, within, window, settle)
 
     def write_proc_header(self, step_value, unit_step_value):
         if I.CONFIG_MEASURE_R1_CURRENT:
@@ -1639,9 +2785,9 @@ class Measurer(threading.Thread):
              "T", "T", "T", "T",
              "K", "K", "Ohm", "Ohm", "Ohm", "Ohm",
              "Ohm", "Ohm"]
-        self.procfile.write("\t".join(P) + "\n")
-        self.procfile.write("\t".join(U) + "\n")
-        self.procfile.flush()
+        self.proc_header = [P, U]
+        self.procfile.write_row(P)
+        self.procfile.write_row(U)
 
     def write_proc(self, step, R1, deltaR1, Phase1, deltaPhase1, R2, deltaR2, Phase2, deltaPhase2, R3, deltaR3, Phase3,
                    deltaPhase3, R4, deltaR4, Phase4, deltaPhase4, H, deltaH, Hall, deltaHall, T, deltaT, T7, deltaT7,
@@ -1649,8 +2795,363 @@ class Measurer(threading.Thread):
         D = [step, R1, deltaR1, Phase1, deltaPhase1, R2, deltaR2, Phase2, deltaPhase2, R3, deltaR3, Phase3, deltaPhase3,
              R4, deltaR4, Phase4, deltaPhase4, H, deltaH, Hall, deltaHall, T, deltaT, T7, deltaT7, T8, deltaT8, RK,
              deltaRK]
-        self.procfile.write("\t".join([str(x) for x in D]) + "\n")
-        self.procfile.flush()
+        self.proc_rows.append(D)
+        self.procfile.write_row(D)
+        # The end of a step: make the step durable
+        self.datafile.checkpoint()
+        self.procfile.checkpoint()
+        if self.binfile is not None:
+            self.binfile.checkpoint()
+
+    def check_lockin(self, name, sr830, annotations, TIME, u):
+        status = I.get_status(sr830)
+        if status:
+            logging.warning(f"{name} status = {status}")
+            annotations.append((TIME, u, status))
+
+        if "OUT" in status:
+            logging.info(f"{name}: OVERLOAD (AUTORANGE={self.AUTORANGE})")
+            if name in self.autorange:
+                self.autorange[name].overload(TIME)
+
+    def status_due(self, name, TIME) -> bool:
+        if TIME - self.status_time.get(name, -np.inf) < self.STATUS_PERIOD:
+            return False
+        self.status_time[name] = TIME
+        return True
+
+    def read_lockin(self, name, sr830, annotations, TIME) -> (float, float):
+        u, phase = I.get_amplitude_and_theta(sr830)
+        if self.status_due(name, TIME):
+            self.check_lockin(name, sr830, annotations, TIME, u)
+        if name in self.autorange:
+            self.autorange[name].observe(TIME, u)
+        return u, phase
+
+    def drain_lockin(self, name, annotations, keys, TIME) -> dict:
+        """
+        Buffered counterpart of read_lockin: returns {"buffer": [(times, {keys[0]: u, keys[1]: phase})]} with the
+        arrays of the samples stored by the lock-in since the previous drain (see SR830Buffer).
+        """
+        buffer = self.buffers[name]
+        times, u, phase = buffer.drain()
+        if len(times) == 0:
+            return {}
+        if annotations is not None and self.status_due(name, TIME):
+            self.check_lockin(name, buffer.sr830, annotations, TIME, float(u[-1]))
+        if name in self.autorange:
+            # One decision per drain, on the largest sample
+            self.autorange[name].observe(TIME, float(np.max(np.abs(u))))
+        return {"buffer": [(times, {keys[0]: u, keys[1]: phase})]}
+
+    def read_field(self, TIME) -> dict:
+        return {"h": I.get_current_field()}
+
+    def read_hall(self, TIME) -> dict:
+        with DEVICELOCK(I.T):
+            hall = I.T.query_ascii_values("RDGR? 8")[0]
+        # with DEVICELOCK(I.Hall):
+        #     hall, = I.Hall.query_ascii_values("DATA?")
+        return {"hall": hall}
+
+    def read_lakeshore(self, TIME) -> dict:
+        tr1 = tr2 = 0
+        if I.CONFIG_MEASURE_LakeShore_T1:
+            with DEVICELOCK(I.LT1):
+                tr1 = I.LT1.query_ascii_values("KRDG? A")[0]
+                tr2 = 0
+        if I.CONFIG_MEASURE_LakeShore_T2:
+            with DEVICELOCK(I.LT2):
+                tr1 = I.LT2.query_ascii_values("KRDG? A")[0]
+                tr2 = I.LT2.query_ascii_values("KRDG? B")[0]
+        return {"tr1": tr1, "tr2": tr2}
+
+    def read_keithley(self, TIME) -> dict:
+        with DEVICELOCK(I.Rsample):
+            return {"r_sample": I.Rsample.query_ascii_values(':DATA?')[0]}
+
+    def read_lockin_xy(self, TIME) -> dict:
+        with DEVICELOCK(I.Lockin):
+            ux, uy, ur, theta = I.Lockin.query_ascii_values('SNAP? 1,2,3,4')
+        return {"ux": ux, "uy": uy, "ur": ur, "theta": theta}
+
+    def read_rk(self, TIME) -> dict:
+        with DEVICELOCK(I.RK):
+            rk_v, rk_i, rk_r, rk_g1, rk_g2 = I.RK.query_ascii_values(":READ?")
+        return {"rk": rk_r}
+
+    def read_tc(self, TIME) -> dict:
+        t = t7 = t8 = None
+
+        if FACILITY == Facility.BLUEFORS:
+            tc_channel = I.get_tc_channel()
+        elif FACILITY == Facility.CFMS:
+            tc_channel = 6
+        elif FACILITY == FACILITY.STUDENT_INSERT:
+            tc_channel = 'A'
+
+        if tc_channel == 6:
+            t = I.get_temperature()
+        elif tc_channel == 7:
+            with DEVICELOCK(I.T):
+                t7 = I.T.query_ascii_values("RDGR? 7")[0]
+        elif tc_channel == 8:
+            with DEVICELOCK(I.T):
+                t8 = I.T.query_ascii_values("RDGR? 8")[0]
+
+        if self.EXPERIMENT == "cooldown":
+            # T1..T8 come from the scanner task
+            return {"t": t}
+
+        return {"t": t, "t7": t7, "t8": t8}
+
+    def read_scanner(self, TIME) -> dict:
+        return self.scanner.poll()
+
+    def acquisition_tasks(self) -> list:
+        """
+        One task per instrument, see ScheduledTask. Every task takes the TIME of the point and returns the dict of the
+        values it has measured. Only the tasks that are due run at a point (see PERIODS), tasks of different
+        instruments may run at the same time (see CONCURRENT).
+        """
+        tasks = []
+        if self.BUFFER_RATE is not None:
+            tasks = self.buffered_tasks() + self.instrument_tasks(lockin=False)
+        else:
+            if I.CONFIG_MEASURE_R1:
+                tasks.append(("R1", lambda TIME: dict(zip(("u1", "phase1"),
+                                                          self.read_lockin("R1", I.R1, self.R1annotations, TIME)))))
+            if I.CONFIG_MEASURE_R2:
+                tasks.append(("R2", lambda TIME: dict(zip(("u2", "phase2"),
+                                                          self.read_lockin("R2", I.R2, self.R2annotations, TIME)))))
+            if I.CONFIG_MEASURE_R3:
+                tasks.append(("R3", lambda TIME: dict(zip(("u3", "phase3"),
+                                                          self.read_lockin("R3", I.R3, self.R3annotations, TIME)))))
+            if I.CONFIG_MEASURE_R4:
+                tasks.append(("R4", lambda TIME: dict(zip(("u4", "phase4"),
+                                                          self.read_lockin("R4", I.R4, self.R4annotations, TIME)))))
+            tasks += self.instrument_tasks(lockin=True)
+
+        scheduled = []
+        for name, function in tasks:
+            period = self.PERIODS.get(name, 0)
+            if self.BUFFER_RATE is not None and name in self.buffers:
+                period = max(period, SR830Buffer.DRAIN_PERIOD)
+            scheduled.append(ScheduledTask(name, function, period))
+        return scheduled
+
+    def lockins(self) -> list:
+        """ (name, SR830, annotations, keys of the point) of the enabled lock-ins """
+        lockins = []
+        if I.CONFIG_MEASURE_R1:
+            lockins.append(("R1", I.R1, self.R1annotations, ("u1", "phase1")))
+        if I.CONFIG_MEASURE_R2:
+            lockins.append(("R2", I.R2, self.R2annotations, ("u2", "phase2")))
+        if I.CONFIG_MEASURE_R3:
+            lockins.append(("R3", I.R3, self.R3annotations, ("u3", "phase3")))
+        if I.CONFIG_MEASURE_R4:
+            lockins.append(("R4", I.R4, self.R4annotations, ("u4", "phase4")))
+        if I.CONFIG_MEASURE_Lockin:
+            # The buffer stores R and theta only, X and Y are not measured in this mode
+            lockins.append(("Lockin", I.Lockin, None, ("ur", "theta")))
+        return lockins
+
+    def buffered_tasks(self) -> list:
+        tasks = []
+        for name, sr830, annotations, keys in self.lockins():
+            tasks.append((name, lambda TIME, name=name, annotations=annotations, keys=keys:
+                          self.drain_lockin(name, annotations, keys, TIME)))
+        return tasks
+
+    def instrument_tasks(self, lockin) -> list:
+        tasks = []
+        if I.CONFIG_MEASURE_FIELD:
+            tasks.append(("field", self.read_field))
+        if I.CONFIG_MEASURE_HALL:
+            tasks.append(("hall", self.read_hall))
+        if I.CONFIG_MEASURE_LakeShore_T1 or I.CONFIG_MEASURE_LakeShore_T2:
+            tasks.append(("lakeshore", self.read_lakeshore))
+        if I.CONFIG_MEASURE_Keithley_R1:
+            tasks.append(("keithley", self.read_keithley))
+        if I.CONFIG_MEASURE_Lockin and lockin:
+            tasks.append(("Lockin", self.read_lockin_xy))
+        if I.CONFIG_MEASURE_RK:
+            tasks.append(("rk", self.read_rk))
+        tasks.append(("tc", self.read_tc))
+        if self.scanner is not None:
+            tasks.append(("scanner", self.read_scanner))
+        return tasks
+
+    def read_point(self, TIME, tasks, executor=None) -> (dict, list):
+        """
+        Runs the due tasks. Returns the point and the failures, a list of (task name, exception): the values of the
+        tasks that have succeeded are kept (they have been consumed, e.g. the drained lock-in buffers), the values
+        of the failed tasks (the keys of their previous run) are missing.
+        """
+        point = {"u1": 0, "phase1": 0, "u2": 0, "phase2": 0, "u3": 0, "phase3": 0, "u4": 0, "phase4": 0,
+                 "h": 0, "hall": 0, "tr1": 0, "tr2": 0, "r_sample": 0, "ux": 0, "uy": 0, "ur": 0, "theta": 0,
+                 "rk": 0, "t": None, "t7": None, "t8": None,
+                 "t1": None, "t2": None, "t3": None, "t5": None, "t6": None}
+
+        if self.BUFFER_RATE is not None:
+            # The lock-in values come with their own timestamps, see drain_lockin
+            for key in ("u1", "phase1", "u2", "phase2", "u3", "phase3", "u4", "phase4", "ux", "uy", "ur", "theta"):
+                point[key] = None
+
+        due = [task for task in tasks if task.due(TIME)]
+        for task in tasks:
+            if task not in due:
+                point.update(task.last if self.FILL == "forward" else dict.fromkeys(task.last))
+
+        results, failures = [], []
+        if executor is None:
+            for task in due:
+                try:
+                    results.append(task(TIME))
+                except Exception as exc:
+                    failures.append((task, exc))
+        else:
+            # The point takes as long as the slowest instrument, not the sum of all of them
+            futures = [executor.submit(task, TIME) for task in due]
+            concurrent.futures.wait(futures)
+            for task, future in zip(due, futures):
+                if future.exception() is None:
+                    results.append(future.result())
+                else:
+                    failures.append((task, future.exception()))
+        for task, exc in failures:
+            point.update(dict.fromkeys(task.last))
+
+        buffered = []
+        for result in results:
+            buffered += result.pop("buffer", [])
+            point.update(result)
+            # Only the values just read, not the defaults and the filled ones
+            TELEMETRY.update(result)
+        point["buffer"] = buffered
+
+        return point, [(task.name, exc) for task, exc in failures]
+
+    def step_relax(self, TIME) -> bool:
+        """ True if a point taken at TIME is in the relaxation period of the current step (or before the first step) """
+        if self.STEP_LASTTIME is None:
+            return True
+        if self.ADAPTIVE is not None:
+            return self.ADAPTIVE.relaxing(TIME, self.STEP_LASTTIME, self.STEP_RELAX_TIME, self.data)
+        return TIME - self.STEP_LASTTIME < self.STEP_RELAX_TIME
+
+    def step_relax_block(self, times) -> np.ndarray:
+        """ step_relax() of every time of a block, the adaptive settling is checked once, at the last time """
+        if self.STEP_LASTTIME is None:
+            return np.ones(len(times), dtype=bool)
+        if self.ADAPTIVE is not None:
+            self.ADAPTIVE.relaxing(times[-1], self.STEP_LASTTIME, self.STEP_RELAX_TIME, self.data)
+            if self.ADAPTIVE.settled is None:
+                return np.ones(len(times), dtype=bool)
+            return times < self.ADAPTIVE.settled
+        return times - self.STEP_LASTTIME < self.STEP_RELAX_TIME
+
+    def step_finished(self, TIME) -> bool:
+        """ True if the current step is over (or there is none yet) """
+        if self.STEP_LASTTIME is None:
+            return True
+        if self.ADAPTIVE is not None and self.ADAPTIVE.channels:
+            return self.ADAPTIVE.finished(TIME, self.STEP_MEASURE_TIME, self.step_stats)
+        return TIME - self.STEP_LASTTIME >= self.STEP_MEASURE_TIME + self.STEP_RELAX_TIME
+
+    def step_outputs(self) -> (list, float):
+        """ The store channels of the enabled lock-ins and their longest time constant (0 if unknown) """
+        channels, tau = [], 0.0
+        for name, sr830, annotations, keys in self.lockins():
+            channels.append("Ur" if name == "Lockin" else name)
+            try:
+                tau = max(tau, I.get_rc_seconds(sr830))
+            except Exception as exc:
+                logging.warning(f"MEASURER: Cannot get the time constant of {name}")
+                logging.exception(exc)
+        return channels, tau
+
+    def store_point(self, TIME, point):
+        """ Appends the point to the channel store and writes it to the data file """
+        u1, phase1, u2, phase2 = point["u1"], point["phase1"], point["u2"], point["phase2"]
+        u3, phase3, u4, phase4 = point["u3"], point["phase3"], point["u4"], point["phase4"]
+        h, hall, t, t7, t8, rk = point["h"], point["hall"], point["t"], point["t7"], point["t8"], point["rk"]
+        tr1, tr2, r_sample = point["tr1"], point["tr2"], point["r_sample"]
+        ux, uy, ur, theta = point["ux"], point["uy"], point["ur"], point["theta"]
+
+        relax = None
+        if self.EXPERIMENT == "step":
+            relax = self.step_relax(TIME)
+
+        row = dict(TIME=TIME,
+                   R1=u1, PHASE1=phase1, R2=u2, PHASE2=phase2,
+                   R3=u3, PHASE3=phase3, R4=u4, PHASE4=phase4,
+                   H=h, HALL=hall, T=t, T7=t7, T8=t8, RK=rk,
+                   Tsample1=tr1, Tsample2=tr2, R_Sample=r_sample,
+                   Ux=ux, Uy=uy, Ur=ur, Theta=theta,
+                   T1=point["t1"], T2=point["t2"], T3=point["t3"], T5=point["t5"], T6=point["t6"])
+        self.data.append(RELAX=relax, **row)
+        if relax is False:
+            self.step_stats.update(row)
+
+        if self.EXPERIMENT == "cooldown":
+            self.write_data_cooldown(TIME, u1, phase1, u2, phase2, u3, phase3, u4, phase4, h, hall,
+                                     point["t1"], point["t2"], point["t3"], point["t5"], point["t6"], t7, t8)
+        else:
+            self.write_data(TIME, u1, phase1, u2, phase2, u3, phase3, u4, phase4, h, hall, t, t7, t8, rk, tr1,
+                            tr2, r_sample, ux, uy, ur, theta)
+
+    def store_buffered_point(self, TIME, point):
+        """
+        In the buffered mode every lock-in sample becomes a row of its own with the buffer timestamp, the other
+        channels of that row are missing. The samples of one drain are stored as blocks (store_block), in the time
+        order with the row of the other instruments at TIME.
+        """
+        values = {key: value for key, value in point.items() if key != "buffer"}
+        if not point["buffer"]:
+            self.store_point(TIME, values)
+            return
+
+        size = sum(len(times) for times, samples in point["buffer"])
+        rows = np.full((size, len(MEASURER_CHANNELS)), np.nan)
+        start = 0
+        for times, samples in point["buffer"]:
+            rows[start:start + len(times), 0] = times
+            for key, column in samples.items():
+                rows[start:start + len(times), MEASURER_CHANNELS.index(self.POINT_CHANNELS[key])] = column
+            start += len(times)
+        rows = rows[np.argsort(rows[:, 0], kind="stable")]
+
+        before = int(np.searchsorted(rows[:, 0], TIME, "right"))
+        self.store_block(rows[:before])
+        self.store_point(TIME, values)
+        self.store_block(rows[before:])
+
+    def store_block(self, rows):
+        """
+        Block counterpart of store_point: rows (rows, MEASURER_CHANNELS) are appended to the channel store, the
+        step statistics and the data file at once
+        """
+        if not len(rows):
+            return
+        times = rows[:, 0]
+        if self.EXPERIMENT == "step":
+            relax = self.step_relax_block(times)
+            rows[:, MEASURER_CHANNELS.index("RELAX")] = relax
+            self.step_stats.update_block(rows[~relax])
+        self.data.extend(rows)
+
+        columns = self.COOLDOWN_COLUMNS if self.EXPERIMENT == "cooldown" else self.DATA_COLUMNS
+        block = rows[:, [MEASURER_CHANNELS.index(name) for name in columns]]
+        # The missing readings are None, the same as in write_data, the stability criterion not met yet is nan
+        missing = ["None"] * len(columns)
+        if self.STABLE_OUTPUT:
+            stable = np.array(self.STABLE, dtype=float)
+            block = np.hstack([block, np.broadcast_to(stable, (len(block), len(stable)))])
+            missing += ["nan"] * len(self.STABLE_COLUMNS)
+        self.datafile.write_rows(block, missing)
+        if self.binfile is not None:
+            self.binfile.write_rows(block)
 
     def run(self):
         logging.info("MEASURER: Measurements started")
@@ -1661,235 +3162,66 @@ class Measurer(threading.Thread):
         else:
             self.write_header()
 
-        r1_output_overload_in_row = 0
-        r2_output_overload_in_row = 0
-        r3_output_overload_in_row = 0
-        r4_output_overload_in_row = 0
+        if self.BUFFER_RATE is not None:
+            self.buffers = {name: SR830Buffer(sr830, self.BUFFER_RATE, self.START_TIME)
+                            for name, sr830, annotations, keys in self.lockins()}
+            for buffer in self.buffers.values():
+                buffer.start()
 
-        while not self.stopped:
-            TIME = time.perf_counter() - self.START_TIME
+        if self.EXPERIMENT == "cooldown":
+            self.scanner = ScannerSampler()
+            self.scanner.start()
 
-            try:
-                if I.CONFIG_MEASURE_R1:
-                    u1, phase1 = I.get_amplitude_and_theta(I.R1)
-                    if len(self.R1) % 100 == 0:
-                        status = I.get_status(I.R1)
-                        if status:
-                            logging.warning(f"R1 status = {status}")
-                            self.R1annotations.append((TIME, u1, status))
-
-                        if "OUT" in status:
-                            r1_output_overload_in_row += 1
-                            if r1_output_overload_in_row == 3:
-                                logging.info(f"R1: OVERLOAD THREE TIMES IN A RO  W (AUTORANGE={self.AUTORANGE})")
-                                if self.AUTORANGE:
-                                    I.range_up(I.R1)
-                        else:
-                            r1_output_overload_in_row = 0
-                else:
-                    u1, phase1 = 0, 0
-
-                if I.CONFIG_MEASURE_R2:
-                    u2, phase2 = I.get_amplitude_and_theta(I.R2)
-                    if len(self.R2) % 100 == 0:
-                        status = I.get_status(I.R2)
-                        if status:
-                            logging.warning(f"R2 status = {status}")
-                            self.R2annotations.append((TIME, u2, status))
-
-                        if "OUT" in status:
-                            r2_output_overload_in_row += 1
-                            if r2_output_overload_in_row == 3:
-                                logging.info(f"R2: OVERLOAD THREE TIMES IN A ROW (AUTORANGE={self.AUTORANGE})")
-                                if self.AUTORANGE:
-                                    I.range_up(I.R2)
-                        else:
-                            r2_output_overload_in_row = 0
-                else:
-                    u2, phase2 = 0, 0
-
-                if I.CONFIG_MEASURE_R3:
-                    u3, phase3 = I.get_amplitude_and_theta(I.R3)
-                    if len(self.R3) % 100 == 0:
-                        status = I.get_status(I.R3)
-                        if status:
-                            logging.warning(f"R3 status = {status}")
-                            self.R3annotations.append((TIME, u3, status))
-
-                        if "OUT" in status:
-                            r3_output_overload_in_row += 1
-                            if r3_output_overload_in_row == 3:
-                                logging.info(f"R3: OVERLOAD THREE TIMES IN A ROW (AUTORANGE={self.AUTORANGE})")
-                                if self.AUTORANGE:
-                                    I.range_up(I.R3)
-                        else:
-                            r3_output_overload_in_row = 0
-                else:
-                    u3, phase3 = 0, 0
-
-                if I.CONFIG_MEASURE_R4:
-                    u4, phase4 = I.get_amplitude_and_theta(I.R4)
-                    if len(self.R4) % 100 == 0:
-                        status = I.get_status(I.R4)
-                        if status:
-                            logging.warning(f"R4 status = {status}")
-                            self.R4annotations.append((TIME, u4, status))
-
-                        if "OUT" in status:
-                            r4_output_overload_in_row += 1
-                            if r4_output_overload_in_row == 3:
-                                logging.info(f"R4: OVERLOAD THREE TIMES IN A ROW (AUTORANGE={self.AUTORANGE})")
-                                if self.AUTORANGE:
-                                    I.range_up(I.R4)
-                        else:
-                            r4_output_overload_in_row = 0
-                else:
-                    u4, phase4 = 0, 0
+        # The settings may have been changed on the front panel since the previous measurement
+        I.sr830_state.invalidate()
+        if self.AUTORANGE:
+            for name, sr830, annotations, keys in self.lockins():
+                if name != "Lockin":
+                    self.autorange[name] = SR830Autorange(name, sr830)
 
-                if I.CONFIG_MEASURE_FIELD:
-                    h = I.get_current_field()
-                else:
-                    h = 0
+        tasks = self.acquisition_tasks()
+        executor = None
+        if self.CONCURRENT:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix="MEASURER")
 
-                if I.CONFIG_MEASURE_HALL:
-                    with DEVICELOCK:
-                        hall = I.T.query_ascii_values("RDGR? 8")[0]
-                    # with DEVICELOCK:
-                    #     hall, = I.Hall.query_ascii_values("DATA?")
-                else:
-                    hall = 0
-                if I.CONFIG_MEASURE_LakeShore_T1:
-                    with DEVICELOCK:
-                        tr1 = I.LT1.query_ascii_values("KRDG? A")[0]
-                        tr2 = 0
-                if I.CONFIG_MEASURE_LakeShore_T2:
-                    with DEVICELOCK:
-                        tr1 = I.LT2.query_ascii_values("KRDG? A")[0]
-                        tr2 = I.LT2.query_ascii_values("KRDG? B")[0]
-
-                if I.CONFIG_MEASURE_Keithley_R1:
-                    with DEVICELOCK:
-                        r_sample = I.Rsample.query_ascii_values(':DATA?')[0]
-                else:
-                    r_sample = 0
-                if I.CONFIG_MEASURE_Lockin:
-                    with DEVICELOCK:
-                        data = I.Lockin.query_ascii_values('SNAP? 1,2,3,4')
-                        ux=data[0]
-                        uy=data[1]
-                        ur=data[2]
-                        theta=data[3]
-                if I.CONFIG_MEASURE_RK:
-                    with DEVICELOCK:
-                        rk_v, rk_i, rk_r, rk_g1, rk_g2 = I.RK.query_ascii_values(":READ?")
-                        rk = rk_r
-                else:
-                    rk = 0
-
-                t = t7 = t8 = None
-
-                if FACILITY == Facility.BLUEFORS:
-                    tc_channel = I.get_tc_channel()
-                elif FACILITY == Facility.CFMS:
-                    tc_channel = 6
-                elif FACILITY == FACILITY.STUDENT_INSERT:
-                    tc_channel = 'A'
-
-                if tc_channel == 6:
-                    t = I.get_temperature()
-                elif tc_channel == 7:
-                    with DEVICELOCK:
-                        t7 = I.T.query_ascii_values("RDGR? 7")[0]
-                elif tc_channel == 8:
-                    with DEVICELOCK:
-                        t8 = I.T.query_ascii_values("RDGR? 8")[0]
-
-                if self.EXPERIMENT == "cooldown":
-                    t1 = t2 = t3 = t5 = t6 = t7 = t8 = None
-                    with DEVICELOCK:
-                        channel = int(I.T.query("SCAN?").strip().split(",")[0])
-                        if channel == 1:
-                            t1 = float(I.T.query("RDGK? 1").strip())
-                        elif channel == 2:
-                            t2 = float(I.T.query("RDGK? 2").strip())
-                        elif channel == 3:
-                            t3 = float(I.T.query("RDGK? 3").strip())
-                        elif channel == 5:
-                            t5 = float(I.T.query("RDGK? 5").strip())
-                        elif channel == 6:
-                            t6 = float(I.T.query("RDGK? 6").strip())
-                        elif channel == 7:
-                            t7 = float(I.T.query("RDGR? 7").strip())
-                        elif channel == 8:
-                            t8 = float(I.T.query("RDGR? 8").strip())
-                        else:
-                            logging.info("UNKNOWN CHANNEL!")
-
-                    self.T1.append(t1)
-                    self.T2.append(t2)
-                    self.T3.append(t3)
-                    self.T5.append(t5)
-                    self.T6.append(t6)
-                    # self.T7.append(t7)
-                    # self.T8.append(t8)
+        while not self.stopped:
+            TIME = time.perf_counter() - self.START_TIME
 
+            try:
+                point, failures = self.read_point(TIME, tasks, executor)
             except Exception as exc:
-                logging.info("MEASURER: Cannot obtain point!")
-                logging.exception(exc)
-            else:
-                self.R1.append(u1)
-                self.PHASE1.append(phase1)
-                self.R2.append(u2)
-                self.PHASE2.append(phase2)
-                self.R3.append(u3)
-                self.PHASE3.append(phase3)
-                self.R4.append(u4)
-                self.PHASE4.append(phase4)
-                self.H.append(h)
-                self.HALL.append(hall)
-                self.T.append(t)
-                self.T7.append(t7)
-                self.T8.append(t8)
-                self.RK.append(rk)
-                self.TIME.append(TIME)
-                self.Tsample2.append(tr2)
-                self.Tsample1.append(tr1)
-                self.R_Sample.append(r_sample)
-                self.Ux.append(ux)
-                self.Uy.append(uy)
-                self.Ur.append(ur)
-                self.Theta.append(theta)
-
-                if self.EXPERIMENT == "cooldown":
-                    self.write_data_cooldown(TIME, u1, phase1, u2, phase2, u3, phase3, u4, phase4, h, hall, t1, t2, t3,
-                                             t5, t6, t7, t8)
+                point, failures = None, [("point", exc)]
+            # A failed instrument costs its own values only, the point is stored anyway
+            for name, error in failures:
+                self.errors.report(name, error)
+            self.errors.summarize()
+            if point is not None:
+                if self.BUFFER_RATE is not None:
+                    self.store_buffered_point(TIME, point)
                 else:
-                    self.write_data(TIME, u1, phase1, u2, phase2, u3, phase3, u4, phase4, h, hall, t, t7, t8, rk, tr1,
-                                    tr2, r_sample, ux, uy, ur, theta)
+                    self.store_point(TIME, point)
 
             if self.EXPERIMENT == "step":
-                if self.STEP_LASTTIME is None or (
-                        TIME - self.STEP_LASTTIME >= self.STEP_MEASURE_TIME + self.STEP_RELAX_TIME):
-                    if self.STEP_FIRSTPOINT is not None:
+                if self.step_finished(TIME):
+                    if self.STEP_LASTTIME is not None:
                         # It's not the first point
-                        # We have to remove None from list to calculate mean value
-                        mean_dev = lambda arr: (
-                            np.mean([x for x in arr if x is not None]), np.std([x for x in arr if x is not None]))
-
-                        R1M, R1D = mean_dev(self.R1[self.STEP_FIRSTPOINT:])
-                        P1M, P1D = mean_dev(self.PHASE1[self.STEP_FIRSTPOINT:])
-                        R2M, R2D = mean_dev(self.R2[self.STEP_FIRSTPOINT:])
-                        P2M, P2D = mean_dev(self.PHASE2[self.STEP_FIRSTPOINT:])
-                        R3M, R3D = mean_dev(self.R3[self.STEP_FIRSTPOINT:])
-                        P3M, P3D = mean_dev(self.PHASE3[self.STEP_FIRSTPOINT:])
-                        R4M, R4D = mean_dev(self.R4[self.STEP_FIRSTPOINT:])
-                        P4M, P4D = mean_dev(self.PHASE4[self.STEP_FIRSTPOINT:])
-                        HM, HD = mean_dev(self.H[self.STEP_FIRSTPOINT:])
-                        HallM, HallD = mean_dev(self.HALL[self.STEP_FIRSTPOINT:])
-                        TM, TD = mean_dev(self.T[self.STEP_FIRSTPOINT:])
-                        T7M, T7D = mean_dev(self.T7[self.STEP_FIRSTPOINT:])
-                        T8M, T8D = mean_dev(self.T8[self.STEP_FIRSTPOINT:])
-                        RKM, RKD = mean_dev(self.RK[self.STEP_FIRSTPOINT:])
+                        # The statistics are accumulated by store_point, missing values are skipped
+                        mean_dev = self.step_stats.mean_dev
+
+                        R1M, R1D = mean_dev("R1")
+                        P1M, P1D = mean_dev("PHASE1")
+                        R2M, R2D = mean_dev("R2")
+                        P2M, P2D = mean_dev("PHASE2")
+                        R3M, R3D = mean_dev("R3")
+                        P3M, P3D = mean_dev("PHASE3")
+                        R4M, R4D = mean_dev("R4")
+                        P4M, P4D = mean_dev("PHASE4")
+                        HM, HD = mean_dev("H")
+                        HallM, HallD = mean_dev("HALL")
+                        TM, TD = mean_dev("T")
+                        T7M, T7D = mean_dev("T7")
+                        T8M, T8D = mean_dev("T8")
+                        RKM, RKD = mean_dev("RK")
 
                         self.write_proc(self.STEP_LIST[0],
                                         R1M, R1D, P1M, P1D,
@@ -1900,8 +3232,13 @@ class Measurer(threading.Thread):
                                         TM, TD, T7M, T7D, T8M, T8D,
                                         RKM, RKD)
 
+                        if self.REFINE is not None:
+                            self.REFINE.add(self.STEP_LIST[0], {"R1": R1M, "R2": R2M, "R3": R3M, "R4": R4M,
+                                                                "Ur": self.step_stats.mean("Ur")})
                         self.STEP_LIST.pop(0)
 
+                    if len(self.STEP_LIST) == 0 and self.REFINE is not None:
+                        self.STEP_LIST = self.REFINE.next_steps()
                     if len(self.STEP_LIST) == 0:
                         break
 
@@ -1929,32 +3266,26 @@ class Measurer(threading.Thread):
                         self.write_proc_header(self.STEP_VALUE, "")
 
                     self.STEP_LASTTIME = TIME
-                    self.STEP_FIRSTPOINT = None
-
-                elif TIME - self.STEP_LASTTIME >= self.STEP_RELAX_TIME:
-                    if self.STEP_FIRSTPOINT is None:
-                        self.STEP_FIRSTPOINT = len(self.TIME) - 1
-
-                else:
-                    # This point is not needed
-                    self.TIME.pop()
-                    self.R1.pop()
-                    self.PHASE1.pop()
-                    self.R2.pop()
-                    self.PHASE2.pop()
-                    self.R3.pop()
-                    self.PHASE3.pop()
-                    self.R4.pop()
-                    self.PHASE4.pop()
-                    self.H.pop()
-                    self.HALL.pop()
-                    self.T.pop()
-                    self.T7.pop()
-                    self.T8.pop()
-                    self.RK.pop()
+                    self.step_stats.reset()
+                    if self.ADAPTIVE is not None:
+                        self.ADAPTIVE.start(*self.step_outputs(), len(self.data))
+
+        if executor is not None:
+            executor.shutdown()
+        self.errors.summarize(force=True)
+        for name, buffer in self.buffers.items():
+            if buffer.skipped:
+                logging.info(f"MEASURER: {buffer.skipped} samples of {name} skipped by the buffer restarts")
+            try:
+                buffer.stop()
+            except Exception as exc:
+                logging.warning(f"MEASURER: Cannot stop the buffer of {name}")
+                logging.exception(exc)
+        self.close_files()
 
         logging.info("MEASURER: Measurements stopped")
         self.stopped = True
+        TELEMETRY.notify()
 
     def requestInterruption(self):
         self.stopped = True
@@ -1964,471 +3295,1038 @@ class ExceptionSyntaxError(Exception):
     pass
 
 
-class Program(threading.Thread):
+# PROGRAM ==============================================================================================================
+#
+# The program text is compiled once into a tuple of immutable commands: the arguments are checked and converted to the
+# units of the instruments (seconds, T, T/min, K, K/min, V, A, Hz). Program.check() (the dry run, which estimates the
+# time) and Program.run() walk the same tuple, so the run never stops on a syntax error that the check has missed.
+#
+# Loops:
+#     repeat <N> {
+#         ...
+#     }
+#     for <X> in <FROM>..<TO> [step <STEP>] {
+#         set-target-field $X T with rate 0.1 T/min
+#         start-simple RT_${X}T
+#         ...
+#     }
+# The body of a for loop is compiled for every value when the program is checked and again when it runs. The dry run
+# only walks the first two and the last two iterations for the estimate, so the log of the check stays short whatever
+# the number of iterations.
+
+TIME_UNITS = {"s": 1, "sec": 1, "seconds": 1, "m": 60, "min": 60, "minute": 60, "minutes": 60,
+              "h": 3600, "hour": 3600, "hours": 3600}
+
+
+def parse_number(text: str, usage: str, kind=float):
+    try:
+        return kind(text)
+    except ValueError:
+        raise ExceptionSyntaxError(usage)
+
+
+def parse_quantity(value: str, unit: str, units: dict, usage: str) -> float:
+    """ The value converted with the factor of its unit in `units` """
+    if unit not in units:
+        raise ExceptionSyntaxError(usage)
+    return parse_number(value, usage) * units[unit]
+
+
+def parse_switch(value: str, name: str) -> bool:
+    if value.lower() in ["on", "1"]:
+        return True
+    if value.lower() in ["off", "0"]:
+        return False
+    raise ExceptionSyntaxError(f"Unknown parameter value for {name}!")
+
+
+def format_duration(seconds: float) -> str:
+    return f"{int(seconds / 3600):02d}:{int(seconds / 60 % 60):02d}:{int(seconds % 60):02d}"
+
+
+class ProgramState:
+    """
+    What the commands of a running (or checked) program leave for the next ones: the config values, the current field
+    and temperature for the estimates, and the estimated time so far
+    """
+
     def __init__(self):
-        super().__init__()
+        self.step_relax = None
+        self.step_measure = None
+        self.autorange = None
+        self.concurrent = None
+        self.writer_policy = {}
+        self.binary = None
+        # Hz, 0 means off (see Measurer.BUFFER_RATE)
+        self.buffer_rate = None
+        self.periods = {}
+        self.fill = None
+        self.current_field = None
+        self.current_temperature = None
+        # The measured field (T) or temperature (K) must be this close to the target for wait-for-* to be over.
+        # The temperature tolerance depends on the range by default (see WaitFor.TEMPERATURE_TOLERANCES).
+        self.field_tolerance = 2e-4
+        self.temperature_tolerance = None
+        # See AdaptiveStep
+        self.adaptive_step = None
+        self.settle_taus = None
+        self.settle_tolerance = None
+        self.target_sem = None
+        # The program has a wait-for-stable: the data files get the Measurer.STABLE_COLUMNS
+        self.stable_output = False
+        self.total_time = 0.0
+
+    def configure(self, measurer):
+        if self.autorange is not None:
+            measurer.AUTORANGE = self.autorange
+        if self.concurrent is not None:
+            measurer.CONCURRENT = self.concurrent
+        measurer.WRITER_POLICY.update(self.writer_policy)
+        if self.binary is not None:
+            measurer.BINARY_OUTPUT = self.binary
+        if self.buffer_rate is not None:
+            measurer.BUFFER_RATE = self.buffer_rate or None
+        measurer.PERIODS.update(self.periods)
+        if self.fill is not None:
+            measurer.FILL = self.fill
+        if self.adaptive_step:
+            settings = {"taus": self.settle_taus, "tolerance": self.settle_tolerance, "target_sem": self.target_sem}
+            measurer.ADAPTIVE = AdaptiveStep(**{key: value for key, value in settings.items() if value is not None})
+        measurer.STABLE_OUTPUT = self.stable_output
+
+
+@dataclasses.dataclass(frozen=True)
+class Command(abc.ABC):
+    """ One command of a compiled program, `line` is its line number in the program text """
+    line: int
+
+    # The first words of the lines of this command
+    KEYWORDS = ()
+
+    @classmethod
+    @abc.abstractmethod
+    def parse(cls, line: int, keyword: str, args: list) -> "Command":
+        pass
+
+    @abc.abstractmethod
+    def execute(self, program: "Program", state: ProgramState, dryrun: bool):
+        """ Runs the command (not in the dry run) and adds its duration to state.total_time """
+
+    def __str__(self):
+        values = [f"{field.name}={reprlib.repr(getattr(self, field.name))}" for field in dataclasses.fields(self)[1:]]
+        return f"{type(self).__name__}({', '.join(values)})"
+
+
+@dataclasses.dataclass(frozen=True)
+class Config(Command):
+    name: str
+    value: object
+
+    KEYWORDS = ("config",)
+    USAGE = ("config [step-relax,step-measure,current-field,current-temperature,autorange,concurrent,"
+             "flush-rows,flush-seconds,fsync-seconds,binary,buffer-rate,fill,field-tolerance,temperature-tolerance,"
+             "adaptive-step,settle-taus,settle-tolerance,target-sem,"
+             "period-<R1|R2|R3|R4|Lockin|field|hall|lakeshore|keithley|rk|tc|scanner>] <value>")
+    # config period-<task> <seconds> is opt-in: by default every task runs at every point. A slow instrument with a
+    # period (e.g. config period-field 1) leaves the rows in between without its values (config fill sparse, written
+    # as None) or with its previous values (config fill forward).
+    TASKS = ["R1", "R2", "R3", "R4", "Lockin", "field", "hall", "lakeshore", "keithley", "rk", "tc", "scanner"]
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        try:
+            name, value = args[0], args[1]
+        except IndexError:
+            raise ExceptionSyntaxError(cls.USAGE)
+
+        if name in ["step-relax", "step-measure", "current-field", "current-temperature", "flush-seconds",
+                    "fsync-seconds", "field-tolerance", "temperature-tolerance", "settle-taus", "settle-tolerance",
+                    "target-sem"]:
+            value = parse_number(value, f"config {name} <number>")
+        elif name == "flush-rows":
+            value = parse_number(value, "config flush-rows <rows>", int)
+        elif name in ["autorange", "concurrent", "binary", "adaptive-step"]:
+            value = parse_switch(value, name.upper())
+        elif name == "buffer-rate":
+            if value.lower() in ["off", "0"]:
+                value = 0
+            else:
+                value = parse_number(value, "config buffer-rate <Hz|off>")
+                if value not in Instruments.SR830_SAMPLE_RATES:
+                    raise ExceptionSyntaxError(f"Buffer rate must be one of {Instruments.SR830_SAMPLE_RATES} Hz")
+        elif name == "fill":
+            value = value.lower()
+            if value not in ["forward", "sparse"]:
+                raise ExceptionSyntaxError("Unknown parameter value for FILL!")
+        elif name.startswith("period-"):
+            if name[len("period-"):] not in cls.TASKS:
+                raise ExceptionSyntaxError(f"Unknown channel {name[len('period-'):]}!")
+            value = parse_number(value, f"config {name} <seconds>")
+        else:
+            raise ExceptionSyntaxError("Unknown parameter name!")
+        return cls(line, name, value)
+
+    def execute(self, program, state, dryrun):
+        if self.name in ["flush-rows", "flush-seconds", "fsync-seconds"]:
+            state.writer_policy[self.name.replace("-", "_")] = self.value
+        elif self.name.startswith("period-"):
+            state.periods[self.name[len("period-"):]] = self.value
+        else:
+            setattr(state, self.name.replace("-", "_"), self.value)
+        if not dryrun:
+            logging.info(f"CONFIG: {self.name} set to {self.value}")
 
-        self.stopped = False
-        self.commands = program_widget.toPlainText().split("\n")
 
-    def run_commands(self, dryrun=True) -> Optional[float]:
+@dataclasses.dataclass(frozen=True)
+class StartMeasurer(Command):
+    """ start-simple and start-cooldown """
+    experiment: str
+    name: str
+
+    KEYWORDS = ("start-simple", "start-cooldown")
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        if not args:
+            raise ExceptionSyntaxError(f"{keyword} <EXPERIMENT_NAME>")
+        return cls(line, keyword[len("start-"):], args[0])
+
+    def execute(self, program, state, dryrun):
         global MEASURER_OBJECT
-        CONFIG_STEP_RELAX = None
-        CONFIG_STEP_MEASURE = None
-        CONFIG_AUTORANGE = None
+        if dryrun:
+            return
 
-        total_time_in_seconds = 0
-        current_field = None
-        current_temperature = None
+        if self.experiment == "cooldown" and FACILITY == Facility.BLUEFORS:
+            I.select_channel(1, 1)
+
+        logging.info("Creating Measurer...")
+        MEASURER_OBJECT = Measurer()
+        MEASURER_OBJECT.sample = SAMPLE
+        MEASURER_OBJECT.name = self.name
+        MEASURER_OBJECT.EXPERIMENT = self.experiment
+        state.configure(MEASURER_OBJECT)
+
+        logging.info("Starting Measurer...")
+        MEASURER_OBJECT.start()
+
+
+@dataclasses.dataclass(frozen=True)
+class StartStep(Command):
+    """
+    With `refine`, <POINTS> is the coarse grid and more steps are added where the signal changes most, up to
+    <BUDGET> steps in all and not closer than <SPACING> (see StepRefinement)
+    """
+    name: str
+    step: str
+    values: tuple
+    budget: Optional[int] = None
+    min_spacing: Optional[float] = None
+
+    KEYWORDS = ("start-step",)
+    USAGE = "start-step <NAME> <STEP> <FROM>..<TO> <POINTS>*<ZIGZAG> [refine <BUDGET> [min <SPACING>]]"
+    STEPS = ["AMP-R1", "AMP-ALL", "FREQ", "VG", "H", "HEATER"]
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        try:
+            name, step = args[0], args[1].upper()
+            value_from, value_to = [float(x) for x in args[2].split("..")]
+            numpoints, zigzag = [int(x) for x in args[3].split("*")]
+        except (IndexError, ValueError):
+            raise ExceptionSyntaxError(cls.USAGE)
+
+        if step not in cls.STEPS:
+            raise ExceptionSyntaxError("Unknown step parameter! Must be from list {}".format(cls.STEPS))
+
+        budget = min_spacing = None
+        if len(args) > 4:
+            if args[4] != "refine" or len(args) not in (6, 8) or (len(args) == 8 and args[6] != "min"):
+                raise ExceptionSyntaxError(cls.USAGE)
+            budget = parse_number(args[5], cls.USAGE, int)
+            # The finest step is a tenth of the uniform grid of the budget by default
+            min_spacing = abs(parse_number(args[7], cls.USAGE)) if len(args) == 8 else \
+                abs(value_to - value_from) / (10 * budget)
+            if zigzag != 1 or numpoints < 2 or budget < numpoints:
+                raise ExceptionSyntaxError("Refine needs a single sweep (ZIGZAG 1) and BUDGET >= POINTS >= 2!")
+
+        values = []
+        for i in range(zigzag):
+            sweep = np.linspace(value_from, value_to, numpoints)
+            values.extend(sweep if i % 2 == 0 else sweep[::-1])
+        return cls(line, name, step, tuple(float(value) for value in values), budget, min_spacing)
+
+    def execute(self, program, state, dryrun):
+        global MEASURER_OBJECT
+        if state.step_relax is None:
+            raise ExceptionSyntaxError("CONFIG_STEP_RELAX not set!")
+        if state.step_measure is None:
+            raise ExceptionSyntaxError("CONFIG_STEP_MEASURE not set!")
 
-        log_info = "\n" + "*" * 25 + "\n" + "\n".join(self.commands) + "\n" + "*" * 25
-        logging.info(log_info)
+        steps = len(self.values) if self.budget is None else self.budget
+        estimated_time_in_seconds = steps * (state.step_measure + state.step_relax)
+        logging.info("Step experiment will take {}{:.1f} minutes".format("at most " if state.adaptive_step else "",
+                                                                        estimated_time_in_seconds / 60))
+        state.total_time += estimated_time_in_seconds
 
+        if not dryrun:
+            logging.info("Creating Measurer...")
+            MEASURER_OBJECT = Measurer()
+
+            MEASURER_OBJECT.sample = SAMPLE
+            MEASURER_OBJECT.name = self.name
+
+            MEASURER_OBJECT.EXPERIMENT = "step"
+            MEASURER_OBJECT.STEP_VALUE = self.step
+            MEASURER_OBJECT.STEP_RELAX_TIME = state.step_relax
+            MEASURER_OBJECT.STEP_MEASURE_TIME = state.step_measure
+            # The Measurer consumes its own copy of the list
+            MEASURER_OBJECT.STEP_LIST = list(self.values)
+            if self.budget is not None:
+                MEASURER_OBJECT.REFINE = StepRefinement(self.budget, self.min_spacing, self.values[-1] < self.values[0])
+            state.configure(MEASURER_OBJECT)
+
+            logging.info("Starting Measurer...")
+            MEASURER_OBJECT.start()
+
+
+@dataclasses.dataclass(frozen=True)
+class StartDidv(Command):
+    name: str
+    current_start: float
+    current_finish: float
+    numsteps: int
+    current_delta: float
+
+    KEYWORDS = ("start-didv",)
+    USAGE = "start-didv <NAME> <FROM>..<TO> <POINTS> with delta <DELTA>"
+
+    @classmethod
+    def parse(cls, line, keyword, args):
         try:
-            for lineno, cmd in enumerate(self.commands, start=1):
-                if self.stopped:
+            name = args[0]
+            value_from, value_to = [float(x) for x in args[1].split("..")]
+            numpoints = int(args[2])
+            if args[3:5] != ["with", "delta"]:
+                raise ValueError
+            delta = float(args[5])
+        except (IndexError, ValueError):
+            raise ExceptionSyntaxError(cls.USAGE)
+        return cls(line, name, value_from, value_to, numpoints, delta)
+
+    def execute(self, program, state, dryrun):
+        global MEASURER_OBJECT
+        if dryrun:
+            return
+
+        logging.info("Creating DiDvMeasurer...")
+        MEASURER_OBJECT = DiDvMeasurer()
+
+        MEASURER_OBJECT.sample = SAMPLE
+        MEASURER_OBJECT.name = self.name
+
+        MEASURER_OBJECT.current_start = self.current_start
+        MEASURER_OBJECT.current_finish = self.current_finish
+        MEASURER_OBJECT.numsteps = self.numsteps
+        MEASURER_OBJECT.current_delta = self.current_delta
+        if state.autorange is not None:
+            MEASURER_OBJECT.AUTORANGE = state.autorange
+
+        logging.info("Starting DiDvMeasurer...")
+        MEASURER_OBJECT.start()
+
+
+@dataclasses.dataclass(frozen=True)
+class TcCurrent(Command):
+    direction: str
+
+    KEYWORDS = ("tc-current",)
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        if not args or args[0].lower() not in ["up", "down"]:
+            raise ExceptionSyntaxError("tc-current [up|down]")
+        return cls(line, args[0].lower())
+
+    def execute(self, program, state, dryrun):
+        if dryrun:
+            return
+        if self.direction == "down":
+            I.tc_current_down()
+        else:
+            I.tc_current_up()
+
+
+@dataclasses.dataclass(frozen=True)
+class SetRange(Command):
+    """ set-rng: the excitation range of a LakeShore 370 channel """
+    channel: int
+    direction: str
+
+    KEYWORDS = ("set-rng",)
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        try:
+            channel = int(args[0])
+            direction = args[1].upper()
+            if direction not in ["UP", "DOWN"]:
+                raise ValueError
+        except (IndexError, ValueError):
+            raise ExceptionSyntaxError("set-rng <channel> [UP|DOWN]")
+        return cls(line, channel, direction)
+
+    def execute(self, program, state, dryrun):
+        if dryrun:
+            return
+        channel = self.channel
+        mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {channel}")
+        if self.direction == "DOWN":
+            if excitation > 1:
+                I.T.write(f"RDGRNG {channel},{mode},{excitation},{rng - 1},{autorange},{cs}")
+                logging.info(f"Setting TC range of channel {channel} to {I.TC_CURRENT_RANGE_LABELS[rng - 1]}")
+        else:
+            if excitation < 22:
+                I.T.write(f"RDGRNG {channel},{mode},{excitation},{rng + 1},{autorange},{cs}")
+                logging.info(f"Setting TC range of channel {channel} to {I.TC_CURRENT_RANGE_LABELS[rng + 1]}")
+
+
+@dataclasses.dataclass(frozen=True)
+class Stop(Command):
+    KEYWORDS = ("stop",)
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        return cls(line)
+
+    def execute(self, program, state, dryrun):
+        global MEASURER_OBJECT
+        if dryrun:
+            return
+        if MEASURER_OBJECT is not None:
+            logging.info("Waiting for MEASURER to stop in up to 10 seconds...")
+            MEASURER_OBJECT.requestInterruption()
+            MEASURER_OBJECT.join(10)
+            if MEASURER_OBJECT.is_alive():
+                logging.error("Error on waiting for MEASURER_OBJECT to stop")
+            MEASURER_OBJECT = None
+        else:
+            logging.error("Experiment not started!")
+
+
+@dataclasses.dataclass(frozen=True)
+class Wait(Command):
+    seconds: float
+
+    KEYWORDS = ("wait",)
+    USAGE = "Syntax error! wait <time> [s,sec,seconds,m,min,minute,minutes,h,hour,hours]"
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        if len(args) != 2:
+            raise ExceptionSyntaxError(cls.USAGE)
+        return cls(line, parse_quantity(args[0], args[1], TIME_UNITS, cls.USAGE))
+
+    def execute(self, program, state, dryrun):
+        state.total_time += self.seconds
+        if dryrun:
+            return
+
+        logging.info(f"WAIT: Waiting for {self.seconds} seconds")
+        # Exactly self.seconds, unless the program is stopped earlier
+        TELEMETRY.wait_until(lambda: False, self.seconds, stop=lambda: program.stopped)
+        logging.info("WAIT: Pause finished")
+
+
+@dataclasses.dataclass(frozen=True)
+class WaitFor(Command):
+    """
+    wait-for-field, wait-for-temperature, wait-for-program [timeout <time> <unit>]
+
+    The field and the temperature have arrived when the ramp of the instrument has finished, as before, and the value
+    measured by the Measurer (TELEMETRY) is within the tolerance of the target of the last set-target-* command. The
+    ramp status is only asked once the measured value is there, and then every POLL seconds, so the waits add no
+    instrument traffic while the value is on its way. A value that is not measured is not waited for.
+    The tolerances are config field-tolerance and temperature-tolerance, the default temperature tolerance depends on
+    the range (TEMPERATURE_TOLERANCES).
+    """
+    what: str
+    timeout: Optional[float]
+
+    KEYWORDS = ("wait-for-field", "wait-for-temperature", "wait-for-program")
+    USAGE = "wait-for-[field|temperature|program] [timeout <time> [s,min,h]]"
+    POLL = 5.0
+    # Older values of the Measurer are not trusted
+    MAX_AGE = 10.0
+    # (up to the target temperature in K, tolerance in K)
+    TEMPERATURE_TOLERANCES = [(1.0, 2e-3), (10.0, 20e-3), (100.0, 0.1), (math.inf, 0.5)]
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        timeout = None
+        if args:
+            if len(args) != 3 or args[0] != "timeout":
+                raise ExceptionSyntaxError(cls.USAGE)
+            timeout = parse_quantity(args[1], args[2], TIME_UNITS, cls.USAGE)
+        return cls(line, keyword[len("wait-for-"):], timeout)
+
+    @classmethod
+    def temperature_tolerance(cls, target: float) -> float:
+        return next(tolerance for limit, tolerance in cls.TEMPERATURE_TOLERANCES if target <= limit)
+
+    def execute(self, program, state, dryrun):
+        if dryrun:
+            return
+
+        if self.what == "field":
+            target, tolerance = state.current_field, state.field_tolerance
+            logging.info(f"WAIT: Waiting for field stabilizing (within {tolerance:g} T of {target} T)")
+            if self.wait(program, "h", target, tolerance, lambda: not I.get_magnet_ramping()):
+                logging.info("WAIT: Field stabilized")
+        elif self.what == "temperature":
+            target, tolerance = state.current_temperature, state.temperature_tolerance
+            if tolerance is None and target is not None:
+                tolerance = self.temperature_tolerance(target)
+            logging.info(f"WAIT: Waiting for temperature stabilizing (within {tolerance} K of {target} K)")
+            if self.wait(program, "t", target, tolerance, lambda: not I.get_temperature_ramping()):
+                logging.info("WAIT: Temperature stabilized")
+        elif self.what == "program":
+            logging.info("WAIT: Waiting for program finishing")
+            # The Measurer notifies TELEMETRY when it stops
+            if TELEMETRY.wait_until(lambda: MEASURER_OBJECT is None or MEASURER_OBJECT.stopped, self.timeout,
+                                    stop=lambda: program.stopped):
+                logging.info("WAIT: Program finished")
+            elif not program.stopped:
+                logging.warning(f"WAIT: Timeout, the program is still running after {self.timeout} seconds")
+
+    def wait(self, program, channel, target, tolerance, finished) -> bool:
+        """
+        True when the ramp has finished and the value has arrived, False on the timeout or when the program is
+        stopped
+        """
+        def measured():
+            return target is not None and TELEMETRY.get(channel, self.MAX_AGE) is not None
+
+        def arrived():
+            value = TELEMETRY.get(channel, self.MAX_AGE)
+            return value is not None and target is not None and abs(value - target) <= tolerance
+
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            if (arrived() or not measured()) and finished():
+                return True
+
+            until = time.monotonic() + self.POLL
+            if deadline is not None:
+                until = min(until, deadline)
+            # Wakes up as soon as the value arrives, otherwise at the next poll of the ramp status
+            predicate = arrived if measured() and not arrived() else lambda: False
+            TELEMETRY.wait_until(predicate, until - time.monotonic(), stop=lambda: program.stopped)
+            if program.stopped:
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.warning(f"WAIT: Timeout, {channel} has not arrived at {target} in {self.timeout} seconds")
+                return False
+
+
+@dataclasses.dataclass(frozen=True)
+class WaitForStable(Command):
+    """
+    wait-for-stable <T|H> within <tolerance> <unit> for <window> <unit> [timeout <time> <unit>]
+
+    Waits until the readings of the Measurer (TELEMETRY) of the last `window` seconds stay within the tolerance: the
+    drift of the least-squares line over the window plus twice the scatter around it must not exceed the tolerance.
+    The criterion is checked with every new reading. When it is met, the rows of the data file get it (see
+    Measurer.STABLE_COLUMNS, which the data files of a program with wait-for-stable have).
+    """
+    channel: str
+    tolerance: float
+    window: float
+    timeout: Optional[float]
+
+    KEYWORDS = ("wait-for-stable",)
+    USAGE = "wait-for-stable [T,H] within <tolerance> [K,mK,T,mT,Oe] for <time> [s,min,h] [timeout <time> [s,min,h]]"
+    CHANNELS = {"T": ("t", {"K": 1, "mK": 1e-3}), "H": ("h", {"T": 1, "mT": 1e-3, "Oe": 1e-4})}
+    # Readings of the window, at least
+    MIN_POINTS = 3
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        if len(args) not in (7, 10) or args[0] not in cls.CHANNELS or args[1] != "within" or args[4] != "for":
+            raise ExceptionSyntaxError(cls.USAGE)
+        tolerance = parse_quantity(args[2], args[3], cls.CHANNELS[args[0]][1], cls.USAGE)
+        window = parse_quantity(args[5], args[6], TIME_UNITS, cls.USAGE)
+        timeout = None
+        if len(args) == 10:
+            if args[7] != "timeout":
+                raise ExceptionSyntaxError(cls.USAGE)
+            timeout = parse_quantity(args[8], args[9], TIME_UNITS, cls.USAGE)
+        if tolerance <= 0 or window <= 0:
+            raise ExceptionSyntaxError("The tolerance and the window must be positive!")
+        return cls(line, args[0], tolerance, window, timeout)
+
+    def execute(self, program, state, dryrun):
+        # It takes one window at least
+        state.total_time += self.window
+        if dryrun:
+            return
+
+        logging.info(f"WAIT: Waiting for {self.channel} stable within {self.tolerance:g} for {self.window:g} seconds")
+        start = time.monotonic()
+        last = [None]
+
+        def stable():
+            # Only a new reading can change the result
+            values = TELEMETRY.values.get(self.CHANNELS[self.channel][0])
+            if values is last[0]:
+                return False
+            last[0] = values
+            return self.stable()
+
+        if TELEMETRY.wait_until(stable, self.timeout, stop=lambda: program.stopped):
+            settle = time.monotonic() - start
+            logging.info(f"WAIT: {self.channel} stable within {self.tolerance:g} for {self.window:g} seconds "
+                         f"after {format_duration(settle)}")
+            if MEASURER_OBJECT is not None:
+                MEASURER_OBJECT.mark_stable(self.tolerance, self.window, settle)
+        elif not program.stopped:
+            logging.warning(f"WAIT: Timeout, {self.channel} is not stable after {self.timeout} seconds")
+
+    def stable(self) -> bool:
+        times, values = TELEMETRY.window(self.CHANNELS[self.channel][0], self.window)
+        now = time.monotonic()
+        # The readings must cover the whole window and still come
+        if len(times) < self.MIN_POINTS + 1 or times[0] > now - self.window or now - times[-1] > WaitFor.MAX_AGE:
+            return False
+        slope, scatter = linear_fit(times[1:], values[1:])
+        return abs(slope) * self.window + 2 * scatter <= self.tolerance
+
+
+@dataclasses.dataclass(frozen=True)
+class SetGate(Command):
+    """ set-gate-voltage (V) and set-gate-current (A) """
+    quantity: str
+    value: float
+
+    KEYWORDS = ("set-gate-voltage", "set-gate-current")
+    USAGE = "set-gate-voltage <voltage> [V,mV] | set-gate-current <current> [A,mA]"
+    UNITS = {"voltage": {"v": 1, "mv": 1e-3}, "current": {"a": 1, "ma": 1e-3}}
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        if len(args) != 2:
+            raise ExceptionSyntaxError(cls.USAGE)
+        quantity = keyword[len("set-gate-"):]
+        return cls(line, quantity, parse_quantity(args[0], args[1].lower(), cls.UNITS[quantity], cls.USAGE))
+
+    def execute(self, program, state, dryrun):
+        if dryrun:
+            return
+        if self.quantity == "voltage":
+            logging.info(f"Setting gate voltage to {self.value} V")
+            I.set_gate_voltage(self.value)
+        else:
+            logging.info(f"Setting gate current to {self.value} A")
+            I.set_gate_current(self.value)
+
+
+@dataclasses.dataclass(frozen=True)
+class SetGateState(Command):
+    on: int
+
+    KEYWORDS = ("set-gate-state",)
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        if not args:
+            raise ExceptionSyntaxError("set-gate-state {0|1}")
+        return cls(line, parse_number(args[0], "set-gate-state {0|1}", int))
+
+    def execute(self, program, state, dryrun):
+        if dryrun:
+            return
+        logging.info(f"Setting gate state to {self.on}")
+        I.set_gate_state(self.on)
+
+
+@dataclasses.dataclass(frozen=True)
+class SetTargetField(Command):
+    field: float
+    rate: float
+
+    KEYWORDS = ("set-target-field",)
+    USAGE = "set-target-field <field> [T,Oe] with rate <rate> [T/min,Oe/min]"
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        if len(args) != 6 or args[2:4] != ["with", "rate"]:
+            raise ExceptionSyntaxError(cls.USAGE)
+        field = parse_quantity(args[0], args[1], {"T": 1, "Oe": 1e-4}, cls.USAGE)
+        rate = parse_quantity(args[4], args[5], {"T/min": 1, "Oe/min": 1e-4}, cls.USAGE)
+        return cls(line, field, rate)
+
+    def execute(self, program, state, dryrun):
+        if state.current_field is None:
+            raise ExceptionSyntaxError("CURRENT_FIELD NOT SET!")
+        delay = abs(self.field - state.current_field) / self.rate * 60.0
+        logging.info(f"Setting target field to {self.field} T with rate {self.rate} T/min: "
+                     f"it will take {format_duration(delay)}")
+        state.total_time += delay
+        state.current_field = self.field
+
+        if not dryrun:
+            I.set_target_field(self.field, self.rate)
+
+
+@dataclasses.dataclass(frozen=True)
+class SetTargetTemperature(Command):
+    temperature: float
+    # K/min
+    rate: float
+
+    KEYWORDS = ("set-target-temperature",)
+    USAGE = "Syntax error! set-target-temperature <temp> [K,mK] with rate <rate> [K/min,mK/min]"
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        if len(args) != 6 or args[2:4] != ["with", "rate"]:
+            raise ExceptionSyntaxError(cls.USAGE)
+        temperature = parse_quantity(args[0], args[1], {"K": 1, "mK": 1e-3}, cls.USAGE)
+        rate = parse_quantity(args[4], args[5], {"K/min": 1, "mK/min": 1e-3}, cls.USAGE)
+        return cls(line, temperature, rate)
+
+    def execute(self, program, state, dryrun):
+        if state.current_temperature is None:
+            raise ExceptionSyntaxError("CURRENT_TEMPERATURE NOT SET!")
+        delay = abs(self.temperature - state.current_temperature) / self.rate * 60.0
+        logging.info(f"Setting target temperature to {self.temperature} K with rate {self.rate * 1000} mK/min: "
+                     f"it will take {format_duration(delay)}")
+        state.total_time += delay
+        state.current_temperature = self.temperature
+
+        if not dryrun:
+            # rate in mK/min
+            I.set_target_temperature(self.temperature, self.rate * 1000)
+
+
+@dataclasses.dataclass(frozen=True)
+class SetLockin(Command):
+    """ set-amplitude (V) and set-frequency (Hz) of R1 """
+    setting: str
+    value: float
+
+    KEYWORDS = ("set-amplitude", "set-frequency")
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        setting = keyword[len("set-"):]
+        if not args:
+            raise ExceptionSyntaxError(f"Cannot determine {setting}!")
+        return cls(line, setting, parse_number(args[0], f"Cannot determine {setting}!"))
+
+    def execute(self, program, state, dryrun):
+        if dryrun:
+            return
+        logging.info("Setting {} to {}".format(self.setting, self.value))
+        if self.setting == "amplitude":
+            I.set_amplitude(I.R1, self.value)
+        else:
+            I.set_frequency(I.R1, self.value)
+
+
+@dataclasses.dataclass(frozen=True)
+class SetOffsetExpand(Command):
+    lockin: str
+    enabled: bool
+    expand: str
+
+    KEYWORDS = ("set-offset-and-expand",)
+    USAGE = "Syntax error! set-offset-and-expand <R1|R2|R3|R4> <on|off> <1x|10x|100x>"
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        try:
+            lockin, onoff, expand = args[0].upper(), args[1].lower(), args[2].lower()
+        except IndexError:
+            raise ExceptionSyntaxError(cls.USAGE)
+        if lockin not in ["R1", "R2", "R3", "R4"] or onoff not in ["on", "off"] or expand not in ["1x", "10x", "100x"]:
+            raise ExceptionSyntaxError(cls.USAGE)
+        return cls(line, lockin, onoff == "on", expand)
+
+    def execute(self, program, state, dryrun):
+        if dryrun:
+            return
+        sr830 = getattr(I, self.lockin)
+        if self.enabled:
+            logging.info(f"Enabling offset for {self.lockin} with expand {self.expand}")
+            offset = I.set_offset_expand_on(sr830, self.expand)
+            logging.info(f"Offset for {self.lockin}: {offset}%")
+        else:
+            logging.info(f"Disabling offset and expand for {self.lockin}")
+            I.set_offset_expand_off(sr830)
+
+
+@dataclasses.dataclass(frozen=True)
+class TcChannel(Command):
+    channel: int
+
+    KEYWORDS = ("tc-channel",)
+
+    @classmethod
+    def parse(cls, line, keyword, args):
+        if not args:
+            raise ExceptionSyntaxError("Cannot determine channel number!")
+        return cls(line, parse_number(args[0], "Cannot determine channel number!", int))
+
+    def execute(self, program, state, dryrun):
+        if dryrun:
+            return
+        logging.info("Setting channel to {}".format(self.channel))
+        I.select_channel(self.channel, 0)
+
+
+@dataclasses.dataclass(frozen=True)
+class Loop(Command):
+    """ A block of commands run several times, see Repeat and For """
+
+    @abc.abstractmethod
+    def iterations(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    def commands(self, iteration: int) -> tuple:
+        """ The compiled body for the iteration """
+
+    @abc.abstractmethod
+    def describe(self, iteration: int) -> str:
+        pass
+
+    def execute(self, program, state, dryrun):
+        n = self.iterations()
+        if not dryrun:
+            for iteration in range(n):
+                if program.stopped:
                     break
+                logging.info("{:02d}: {} (iteration {} of {})".format(self.line, self.describe(iteration),
+                                                                    iteration + 1, n))
+                program.execute_commands(self.commands(iteration), state, dryrun)
+            return
 
-                if not cmd:
-                    continue
-
-                command, *args = cmd.split(" ")
-
-                # Remove empty commands
-                args = [A.strip() for A in args if A.strip()]
-
-                logging.info("{:02d}: Processing command {}({})".format(lineno, command, ",".join(args)))
-
-                if command == "config":
-                    try:
-                        param_name = args[0]
-                        param_value = args[1]
-                    except IndexError:
-                        raise ExceptionSyntaxError(
-                            "config [step-relax,step-measure,current-field,current-temperature] <value>")
-
-                    if param_name == "step-relax":
-                        try:
-                            CONFIG_STEP_RELAX = float(param_value)
-                            logging.info(f"CONFIG_STEP_RELAX set to {CONFIG_STEP_RELAX}")
-                        except ValueError:
-                            raise ExceptionSyntaxError
-                    elif param_name == "step-measure":
-                        try:
-                            CONFIG_STEP_MEASURE = float(param_value)
-                            logging.info(f"CONFIG_STEP_MEASURE set to {CONFIG_STEP_MEASURE}")
-                        except ValueError:
-                            raise ExceptionSyntaxError
-                    elif param_name == "current-field":
-                        try:
-                            current_field = float(param_value)
-                            logging.info(f"Setting current field to {current_field} T")
-                        except ValueError:
-                            raise ExceptionSyntaxError
-                    elif param_name == "current-temperature":
-                        try:
-                            current_temperature = float(param_value)
-                            logging.info(f"Setting current temperature to {current_temperature} K")
-                        except ValueError:
-                            raise ExceptionSyntaxError
-                    elif param_name == "autorange":
-                        if param_value.lower() in ["on", "1"]:
-                            CONFIG_AUTORANGE = True
-                        elif param_value.lower() in ["off", "0"]:
-                            CONFIG_AUTORANGE = False
-                        else:
-                            raise ExceptionSyntaxError(f"Unknown parameter value for AUTORANGE!")
-                    else:
-                        raise ExceptionSyntaxError("Unknown parameter name!")
-
-                elif command == "start-simple":
-                    try:
-                        name = args[0]
-                    except IndexError:
-                        raise ExceptionSyntaxError("start-simple <EXPERIMENT_NAME>")
-
-                    if not dryrun:
-
-                        # if FACILITY == Facility.BLUEFORS:
-                        #     if I.CONFIG_MEASURE_PT_FLANGE:
-                        #         I.select_channel(2, 0)
-                        #     else:
-                        #         I.select_channel(6, 0)
-
-                        logging.info("Creating Measurer...")
-                        MEASURER_OBJECT = Measurer()
-                        MEASURER_OBJECT.sample = SAMPLE
-                        MEASURER_OBJECT.name = name
-                        MEASURER_OBJECT.EXPERIMENT = "simple"
-                        if CONFIG_AUTORANGE is not None:
-                            MEASURER_OBJECT.AUTORANGE = CONFIG_AUTORANGE
-
-                        logging.info("Starting Measurer...")
-                        MEASURER_OBJECT.start()
-
-                elif command == "start-cooldown":
-                    try:
-                        name = args[0]
-                    except IndexError:
-                        raise ExceptionSyntaxError("start-cooldown <EXPERIMENT_NAME>")
-
-                    if not dryrun:
-                        if FACILITY == Facility.BLUEFORS:
-                            I.select_channel(1, 1)
-
-                        logging.info("Creating Measurer...")
-                        MEASURER_OBJECT = Measurer()
-                        MEASURER_OBJECT.sample = SAMPLE
-                        MEASURER_OBJECT.name = name
-                        MEASURER_OBJECT.EXPERIMENT = "cooldown"
-                        if CONFIG_AUTORANGE is not None:
-                            MEASURER_OBJECT.AUTORANGE = CONFIG_AUTORANGE
-
-                        logging.info("Starting Measurer...")
-                        MEASURER_OBJECT.start()
-
-                elif command == "start-step":
-                    try:
-                        name = args[0]
-                        step = args[1]
-                        value_from, value_to = [float(x) for x in args[2].split("..")]
-                        numpoints, zigzag = [int(x) for x in args[3].split("*")]
-                    except (IndexError, ValueError):
-                        raise ExceptionSyntaxError("start-step <NAME> <STEP> <FROM>..<TO> <POINTS>*<ZIGZAG>")
-
-                    if CONFIG_STEP_RELAX is None:
-                        raise ExceptionSyntaxError("CONFIG_STEP_RELAX not set!")
-
-                    if CONFIG_STEP_MEASURE is None:
-                        raise ExceptionSyntaxError("CONFIG_STEP_MEASURE not set!")
-
-                    STEP_PARAM_AVAILABLE = ["AMP-R1", "AMP-ALL", "FREQ", "VG", "H", "HEATER"]
-                    if step.upper() not in STEP_PARAM_AVAILABLE:
-                        raise ExceptionSyntaxError(
-                            "Unknown step parameter! Must be from list {}".format(STEP_PARAM_AVAILABLE))
-
-                    steplist = []
-                    for i in range(zigzag):
-                        if i % 2 == 0:
-                            steplist.extend(list(np.linspace(value_from, value_to, numpoints)))
-                        else:
-                            steplist.extend(reversed(list(np.linspace(value_from, value_to, numpoints))))
-
-                    estimated_time_in_seconds = len(steplist) * (CONFIG_STEP_MEASURE + CONFIG_STEP_RELAX)
-                    logging.info("Step experiment will take {:.1f} minutes".format(estimated_time_in_seconds / 60))
-
-                    total_time_in_seconds += estimated_time_in_seconds
-
-                    if not dryrun:
-                        logging.info("Creating Measurer...")
-                        MEASURER_OBJECT = Measurer()
-
-                        MEASURER_OBJECT.sample = SAMPLE
-                        MEASURER_OBJECT.name = name
-
-                        MEASURER_OBJECT.EXPERIMENT = "step"
-                        MEASURER_OBJECT.STEP_VALUE = step.upper()
-                        MEASURER_OBJECT.STEP_RELAX_TIME = CONFIG_STEP_RELAX
-                        MEASURER_OBJECT.STEP_MEASURE_TIME = CONFIG_STEP_MEASURE
-                        MEASURER_OBJECT.STEP_LIST = steplist
-                        if CONFIG_AUTORANGE is not None:
-                            MEASURER_OBJECT.AUTORANGE = CONFIG_AUTORANGE
-
-                        logging.info("Starting Measurer...")
-                        MEASURER_OBJECT.start()
-
-                elif command == "start-didv":
-                    try:
-                        name = args[0]
-                        value_from, value_to = [float(x) for x in args[1].split("..")]
-                        numpoints = int(args[2])
-                        with_str, delta_str = args[3], args[4]
-                        assert with_str == "with"
-                        assert delta_str == "delta"
-                        delta = float(args[5])
-                    except (IndexError, ValueError):
-                        raise ExceptionSyntaxError("start-didv <NAME> <FROM>..<TO> <POINTS> with delta <DELTA>")
-
-                    if not dryrun:
-                        logging.info("Creating DiDvMeasurer...")
-                        MEASURER_OBJECT = DiDvMeasurer()
-
-                        MEASURER_OBJECT.sample = SAMPLE
-                        MEASURER_OBJECT.name = name
-
-                        MEASURER_OBJECT.current_start = value_from
-                        MEASURER_OBJECT.current_finish = value_to
-                        MEASURER_OBJECT.numsteps = numpoints
-                        MEASURER_OBJECT.current_delta = delta
-                        if CONFIG_AUTORANGE is not None:
-                            MEASURER_OBJECT.AUTORANGE = CONFIG_AUTORANGE
-
-                        logging.info("Starting DiDvMeasurer...")
-                        MEASURER_OBJECT.start()
-
-                elif command == "tc-current":
-                    try:
-                        tow = args[0].strip().lower()
-                        assert tow in ["up", "down"]
-                    except (IndexError, ValueError, AssertionError):
-                        raise ExceptionSyntaxError("tc-current [up|down]")
-
-                    if tow == "down":
-                        if not dryrun:
-                            I.tc_current_down()
-                    elif tow == "up":
-                        if not dryrun:
-                            I.tc_current_up()
-                    else:
-                        raise ExceptionSyntaxError("Impossible situation!")
-                elif command == "set-rng":
-                    try:
-                        tow = args[1]
-                        channel = int(args[0])
-                    except (IndexError, ValueError):
-                        raise ExceptionSyntaxError("set-rng <channel> <direction>")
-
-                    if not dryrun:
-                        if tow == "DOWN":
-                            mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {channel}")
-                            if excitation > 1:
-                                I.T.write(f"RDGRNG {channel},{mode},{excitation},{rng - 1},{autorange},{cs}")
-                                logging.info(
-                                    f"Setting TC range of channel {channel} to {I.TC_CURRENT_RANGE_LABELS[rng - 1]}")
-                        elif tow == "UP":
-                            mode, excitation, rng, autorange, cs = I.T.query_ascii_values(f"RDGRNG? {channel}")
-                            if excitation < 22:
-                                I.T.write(f"RDGRNG {channel},{mode},{excitation},{rng + 1},{autorange},{cs}")
-                                logging.info(
-                                    f"Setting TC range of channel {channel} to {I.TC_CURRENT_RANGE_LABELS[rng + 1]}")
-
-                elif command == "stop":
-                    if not dryrun:
-                        if MEASURER_OBJECT is not None:
-                            logging.info("Waiting for MEASURER to stop in up to 10 seconds...")
-                            MEASURER_OBJECT.requestInterruption()
-                            MEASURER_OBJECT.join(10)
-                            if MEASURER_OBJECT.is_alive():
-                                logging.error("Error on waiting for MEASURER_OBJECT to stop")
-                            del MEASURER_OBJECT
-                            MEASURER_OBJECT = None
-                        else:
-                            logging.error("Experiment not started!")
-
-                elif command == "wait":
-                    try:
-                        seconds, units = args
-                        seconds = float(seconds)
-                        if units in ("s", "sec", "seconds"):
-                            seconds = seconds
-                        elif units in ("m", "min", "minutes", "minute"):
-                            seconds *= 60
-                        elif units in ("h", "hours", "hour"):
-                            seconds *= 3600
-                        else:
-                            raise AssertionError
-                    except (ValueError, IndexError, AssertionError):
-                        raise ExceptionSyntaxError(
-                            "Syntax error! wait <time> [s,sec,seconds,m,min,minute,minutes,h,hour,hours]")
-
-                    logging.info(f"WAIT: Waiting for {seconds} seconds")
-
-                    total_time_in_seconds += seconds
-                    if not dryrun:
-                        while seconds > 0 and not self.stopped:
-                            time.sleep(5)
-                            seconds -= 5
-
-                    logging.info("WAIT: Pause finished")
-
-                elif command == "wait-for-field":
-                    logging.info("WAIT: Waiting for field stabilizing")
-                    if not dryrun:
-                        while I.get_magnet_ramping() and not self.stopped:
-                            time.sleep(5)
-                    logging.info("WAIT: Field stabilized")
-
-                elif command == "wait-for-temperature":
-                    logging.info("WAIT: Waiting for temperature stabilizing")
-                    if not dryrun:
-                        while I.get_temperature_ramping() and not self.stopped:
-                            time.sleep(5)
-                    logging.info("WAIT: Temperature stabilized")
-
-                elif command == "wait-for-program":
-                    logging.info("WAIT: Waiting for program finishing")
-                    if not dryrun:
-                        if MEASURER_OBJECT is not None:
-                            while not MEASURER_OBJECT.stopped and not self.stopped:
-                                time.sleep(5)
-                    logging.info("WAIT: Program finished")
-
-                elif command in ["set-gate-voltage", "set-gate-current"]:
-                    try:
-                        value, units = float(args[0]), args[1].lower()
-                    except (ValueError, IndexError):
-                        raise ExceptionSyntaxError(
-                            "set-gate-voltage <voltage> [V,mV] | set-gate-current <current] [A,mA]")
-                    if units in ["v", "a"]:
-                        pass
-                    elif units in ["mv", "ma"]:
-                        value *= 1e-3
-                    else:
-                        raise ExceptionSyntaxError(
-                            "set-gate-voltage <voltage> [V,mV] | set-gate-current <current] [A,mA]")
-
-                    if command == "set-gate-voltage":
-                        logging.info(f"Setting gate voltage to {value} V")
-                        if not dryrun:
-                            I.set_gate_voltage(value)
-                    elif command == "set-gate-current":
-                        logging.info(f"Setting gate current to {value} A")
-                        if not dryrun:
-                            I.set_gate_current(value)
-                elif command == "set-gate-state":
-                    try:
-                        state = int(args[0])
-                    except (ValueError, IndexError):
-                        raise ExceptionSyntaxError("set-gate-state {0|1}")
-                    logging.info(f"Setting gate state to {state}")
-                    if not dryrun:
-                        I.set_gate_state(state)
-
-                elif command == "set-target-field":
-                    try:
-                        field, field_unit, wrd_with, wrd_rate, rate, rate_unit = args
-                        field = float(field)
-                        if field_unit == "T":
-                            field = field
-                        elif field_unit == "Oe":
-                            field = field * 0.0001
-                        else:
-                            raise AssertionError
-
-                        assert wrd_with == "with"
-                        assert wrd_rate == "rate"
-
-                        rate = float(rate)
-                        if rate_unit == "T/min":
-                            rate = rate
-                        elif rate_unit == "Oe/min":
-                            rate = rate * 0.0001
-                        else:
-                            raise AssertionError
-
-                    except (ValueError, IndexError, AssertionError):
-                        raise ExceptionSyntaxError("set-target-field <field> [T,Oe] with rate <rate> [T/min,Oe/min]")
-                    logging.info("Setting target field to {} T with rate {} T/min".format(field, rate))
-
-                    if current_field is not None:
-                        delay = abs(field - current_field) / rate * 60.0
-                        logging.info(
-                            f"It will take {int(delay / 3600):02d}:{int(delay / 60 % 60):02d}:{int(delay % 60):02d} seconds")
-                        total_time_in_seconds += delay
-                        current_field = field
-                    else:
-                        raise ExceptionSyntaxError("CURRENT_FIELD NOT SET!")
-
-                    if not dryrun:
-                        I.set_target_field(field, rate)
-
-                elif command == "set-target-temperature":
-                    try:
-                        temp, temp_unit, wrd_with, wrd_rate, rate, rate_unit = args
-
-                        temp = float(temp)
-                        if temp_unit == "K":
-                            temp = temp
-                        elif temp_unit == "mK":
-                            temp = temp * 0.001
-                        else:
-                            raise AssertionError
-
-                        assert wrd_with == "with"
-                        assert wrd_rate == "rate"
-
-                        rate = float(rate)
-                        if rate_unit == "K/min":
-                            rate = rate * 1000
-                        elif rate_unit == "mK/min":
-                            rate = rate
-                        else:
-                            raise AssertionError
-
-                    except (ValueError, IndexError, AssertionError):
-                        raise ExceptionSyntaxError(
-                            "Syntax error! set-target-temperature <temp> [K,mK] with rate <rate> K/min")
-                    logging.info(f"Setting target temperature to {temp} K with rate {rate} mK/min")
-
-                    if current_temperature is not None:
-                        delay = abs(temp - current_temperature) / (rate / 1000) * 60.0
-                        logging.info(
-                            f"It will take {int(delay / 3600):02d}:{int(delay / 60 % 60):02d}:{int(delay % 60):02d} seconds")
-                        total_time_in_seconds += delay
-                        current_temperature = temp
-                    else:
-                        raise ExceptionSyntaxError("CURRENT_TEMPERATURE NOT SET!")
-
-                    if not dryrun:
-                        # I.set_temperature_ramp(True, rate)
-                        # rate in mK/min
-                        I.set_target_temperature(temp, rate)
-
-                elif command == "set-amplitude":
-                    try:
-                        amp = float(args[0])
-                    except (ValueError, IndexError):
-                        raise ExceptionSyntaxError("Cannot determine amplitude!")
-                    logging.info("Setting amplitude to {}".format(amp))
-                    if not dryrun:
-                        I.set_amplitude(I.R1, amp)
-
-                elif command == "set-frequency":
-                    try:
-                        freq = float(args[0])
-                    except (ValueError, IndexError):
-                        raise ExceptionSyntaxError("Cannot determine frequency!")
-                    logging.info("Setting frequency to {}".format(freq))
-                    if not dryrun:
-                        I.set_frequency(I.R1, freq)
-
-                elif command == "set-offset-and-expand":
-                    try:
-                        lockin_number, onoff, mult = args[0].strip().lower(), args[1].strip().lower(), args[
-                            2].strip().lower()
-                        assert lockin_number in ["r1", "r2", "r3", "r4"]
-                        assert onoff in ["on", "off"]
-                        assert mult in ["1x", "10x", "100x"]
-                    except (ValueError, IndexError, AssertionError):
-                        raise ExceptionSyntaxError(
-                            "Syntax error! set-offset-and-expand <R1|R2|R3|R4> <on|off> <1x|10x|100x>")
-
-                    sr830 = {"r1": I.R1, "r2": I.R2, "r3": I.R3, "r4": I.R4}[lockin_number]
-
-                    if onoff == "on":
-                        logging.info(f"Enabling offset for {lockin_number.upper()} with expand {mult}")
-                        if not dryrun:
-                            offset = I.set_offset_expand_on(sr830, mult)
-                            logging.info(f"Offset for {lockin_number.upper()}: {offset}%")
-                    elif onoff == "off":
-                        logging.info(f"Disabling offset and expand for {lockin_number.upper()}")
-                        if not dryrun:
-                            I.set_offset_expand_off(sr830)
-                    else:
-                        raise ExceptionSyntaxError("IMPOSSIBLE SITUATION!")
+        # The first iteration starts from the state before the loop. Every next one starts where the previous one has
+        # left (e.g. the field one step away). Their durations are taken as linear in the iteration (e.g. wait $X s)
+        # from the second to the last one. Both are walked right after the iteration before them, so the one before
+        # the last is walked too (its own duration is not used, it starts from the state of the second one). The last
+        # one also gives the state after the loop.
+        start = state.total_time
+        durations = {}
+        for iteration in [iteration for iteration in sorted({0, 1, n - 2, n - 1}) if 0 <= iteration < n]:
+            before = state.total_time
+            try:
+                program.execute_commands(self.commands(iteration), state, dryrun)
+            except ExceptionSyntaxError as exc:
+                raise ExceptionSyntaxError(f"{self.describe(iteration)}: {exc}") from None
+            durations[iteration] = state.total_time - before
+        if n > 1:
+            state.total_time = start + durations[0] + (n - 1) * (durations[1] + durations[n - 1]) / 2
+        else:
+            state.total_time = start + durations.get(0, 0)
+
+    def check_iterations(self):
+        """
+        Compiles the body of every iteration, and of every iteration of the loops in it: the dry run only walks some of
+        them, but a substitution may go wrong with any value
+        """
+        for iteration in self.distinct_iterations():
+            try:
+                for command in self.commands(iteration):
+                    if isinstance(command, Loop):
+                        command.check_iterations()
+            except ExceptionSyntaxError as exc:
+                raise ExceptionSyntaxError(f"{self.describe(iteration)}: {exc}") from None
+
+    def distinct_iterations(self) -> range:
+        """ The iterations whose bodies may differ """
+        return range(self.iterations())
+
+
+def contains_command(commands: tuple, command_type: type) -> bool:
+    """ Whether the compiled commands have a command of the type, in any iteration of the loops """
+    for command in commands:
+        if isinstance(command, command_type):
+            return True
+        if isinstance(command, Loop) and any(contains_command(command.commands(iteration), command_type)
+                                             for iteration in command.distinct_iterations()):
+            return True
+    return False
+
+
+@dataclasses.dataclass(frozen=True)
+class Repeat(Loop):
+    count: int
+    body: tuple
+
+    KEYWORDS = ("repeat",)
+
+    @classmethod
+    def parse(cls, line, keyword, args, body):
+        if len(args) != 1:
+            raise ExceptionSyntaxError("repeat <N> {")
+        count = parse_number(args[0], "repeat <N> {", int)
+        # Nothing to substitute: the body is compiled once
+        return cls(line, count, compile_lines(body))
+
+    def iterations(self):
+        return max(self.count, 0)
+
+    def commands(self, iteration):
+        return self.body
+
+    def describe(self, iteration):
+        return "repeat"
+
+    def distinct_iterations(self):
+        return range(min(self.iterations(), 1))
+
+
+@dataclasses.dataclass(frozen=True)
+class For(Loop):
+    variable: str
+    start: float
+    stop: float
+    step: float
+    # (line, text) of the body, $X and ${X} are replaced with the value
+    body: tuple
+
+    KEYWORDS = ("for",)
+    USAGE = "for <X> in <FROM>..<TO> [step <STEP>] {"
+
+    @classmethod
+    def parse(cls, line, keyword, args, body):
+        try:
+            variable, word_in, values = args[0], args[1], args[2]
+            start, stop = [float(x) for x in values.split("..")]
+            if len(args) == 3:
+                step = 1.0 if stop >= start else -1.0
+            elif len(args) == 5 and args[3] == "step":
+                step = float(args[4])
+            else:
+                raise ValueError
+            if word_in != "in" or not variable.isidentifier():
+                raise ValueError
+        except (IndexError, ValueError):
+            raise ExceptionSyntaxError(cls.USAGE)
+        if step == 0 or (stop - start) * step < 0:
+            raise ExceptionSyntaxError(f"The step {step:g} never goes from {start:g} to {stop:g}!")
+        return cls(line, variable, start, stop, step, tuple(body))
+
+    def iterations(self):
+        # The end is included, up to the rounding of the values
+        return int(math.floor((self.stop - self.start) / self.step + 1e-9)) + 1
+
+    def value(self, iteration) -> str:
+        # Up to 12 digits: 0.1 * 3 is 0.3, not 0.30000000000000004
+        return "%.12g" % (self.start + iteration * self.step)
+
+    def commands(self, iteration):
+        pattern = re.compile(r"\$\{" + self.variable + r"\}|\$" + self.variable + r"\b")
+        value = self.value(iteration)
+        return compile_lines([(line, pattern.sub(value, text)) for line, text in self.body])
+
+    def describe(self, iteration):
+        return f"for {self.variable} = {self.value(iteration)}"
+
+
+PROGRAM_COMMANDS = {keyword: command
+                    for command in [Config, StartMeasurer, StartStep, StartDidv, TcCurrent, SetRange, Stop, Wait,
+                                    WaitFor, WaitForStable, SetGate, SetGateState, SetTargetField,
+                                    SetTargetTemperature, SetLockin, SetOffsetExpand, TcChannel]
+                    for keyword in command.KEYWORDS}
+PROGRAM_LOOPS = {keyword: command for command in [Repeat, For] for keyword in command.KEYWORDS}
+
+
+def block_end(lines: list, start: int, header: str) -> int:
+    """ The index of the "}" closing the block whose body starts at lines[start] """
+    depth = 1
+    for index in range(start, len(lines)):
+        words = lines[index][1].split()
+        if words[-1:] == ["{"]:
+            depth += 1
+        elif words == ["}"]:
+            depth -= 1
+            if depth == 0:
+                return index
+    raise ExceptionSyntaxError(f"No }} for {header}")
+
+
+def compile_lines(lines: list) -> tuple:
+    """ The commands of (line number, text) lines. Raises ExceptionSyntaxError with the line of the first error. """
+    commands = []
+    index = 0
+    while index < len(lines):
+        line, source = lines[index]
+        index += 1
+        words = source.split()
+        if not words:
+            continue
+        keyword, args = words[0], words[1:]
+        try:
+            if keyword in PROGRAM_LOOPS:
+                if args[-1:] != ["{"]:
+                    raise ExceptionSyntaxError(f"{keyword} ... {{")
+                end = block_end(lines, index, source.strip())
+                commands.append(PROGRAM_LOOPS[keyword].parse(line, keyword, args[:-1], lines[index:end]))
+                index = end + 1
+            elif keyword in PROGRAM_COMMANDS:
+                commands.append(PROGRAM_COMMANDS[keyword].parse(line, keyword, args))
+            else:
+                raise ExceptionSyntaxError("Unknown command!")
+        except ExceptionSyntaxError as exc:
+            raise ExceptionSyntaxError(f"Line {line}: {source.strip()}: {exc}") from None
+    return tuple(commands)
 
-                elif command == "tc-channel":
-                    try:
-                        channel = int(args[0])
-                    except (ValueError, IndexError):
-                        raise ExceptionSyntaxError("Cannot determine channel number!")
-                    logging.info("Setting channel to {}".format(channel))
-                    if not dryrun:
-                        I.select_channel(channel, 0)
 
-                else:
-                    raise ExceptionSyntaxError("Unknown command!")
+def compile_program(text: str) -> tuple:
+    """ The commands of a program text (the loops with their bodies), every iteration of the loops is compiled """
+    commands = compile_lines(list(enumerate(text.split("\n"), start=1)))
+    for command in commands:
+        if isinstance(command, Loop):
+            try:
+                command.check_iterations()
+            except ExceptionSyntaxError as exc:
+                raise ExceptionSyntaxError(f"Line {command.line}: {exc}") from None
+    return commands
+
+
+class Program(threading.Thread):
+    def __init__(self, text: Optional[str] = None):
+        """ text: the program, by default the one in the program widget """
+        super().__init__()
 
+        self.stopped = False
+        self.text = text
+        # The compiled program (see compile_program), set by check()
+        self.commands = None
+
+    def source(self) -> str:
+        return program_widget.toPlainText() if self.text is None else self.text
+
+    def execute_commands(self, commands: tuple, state: ProgramState, dryrun: bool):
+        for command in commands:
+            if self.stopped:
+                break
+            if not dryrun and not isinstance(command, Loop):
+                logging.info("{:02d}: Processing command {}".format(command.line, command))
+            try:
+                command.execute(self, state, dryrun)
+            except ExceptionSyntaxError as exc:
+                raise ExceptionSyntaxError(f"Line {command.line}: {exc}") from None
+
+    def run_commands(self, dryrun=True) -> Optional[float]:
+        """ Walks the compiled program. Returns the estimated time, None on an error. """
+        state = ProgramState()
+        try:
+            if not dryrun:
+                state.stable_output = contains_command(self.commands, WaitForStable)
+            self.execute_commands(self.commands, state, dryrun)
         except ExceptionSyntaxError as exc:
             logging.exception(exc)
             return None
@@ -2437,31 +4335,43 @@ class Program(threading.Thread):
             logging.exception(exc)
             return None
 
-        return total_time_in_seconds
+        return state.total_time
 
     def check(self):
-        self.commands = program_widget.toPlainText().split("\n")
+        text = self.source()
+        logging.info("\n" + "*" * 25 + "\n" + text + "\n" + "*" * 25)
+        try:
+            self.commands = compile_program(text)
+        except ExceptionSyntaxError as exc:
+            logging.exception(exc)
+            return False
+
         estimated_time = self.run_commands(dryrun=True)
         if estimated_time is not None:
+            logging.info(f"{len(self.commands)} commands")
             logging.info(f"Estimated time is {estimated_time / 60 / 60:.1f} hours ({estimated_time / 60:.1f} minutes)")
             finish_time = datetime.datetime.now() + datetime.timedelta(seconds=estimated_time)
             logging.info("Experiment will be finished at {:%H:%M}".format(finish_time))
         return estimated_time is not None
 
     def run(self):
-        self.run_commands(dryrun=False)
+        if self.commands is not None or self.check():
+            self.run_commands(dryrun=False)
         self.stopped = True
 
     def requestInterruption(self):
         self.stopped = True
+        # Wakes up the waits at once
+        TELEMETRY.notify()
 
 
 class MonitoringThread(threading.Thread):
-    def __init__(self):
+    def __init__(self, host="localhost", port=13000):
         super().__init__()
 
         self.stopped = False
         self.server = None
+        self.address = (host, port)
 
     def status(self):
         global MEASURER_OBJECT
@@ -2471,24 +4381,17 @@ class MonitoringThread(threading.Thread):
             D["message"] = "Experiment stopped"
         else:
             D["message"] = "Experiment running"
-            D["R1"] = MEASURER_OBJECT.R1[-1]
-            D["R2"] = MEASURER_OBJECT.R2[-1]
-            D["R3"] = MEASURER_OBJECT.R3[-1]
-            D["R4"] = MEASURER_OBJECT.R4[-1]
-            D["PHASE1"] = MEASURER_OBJECT.PHASE1[-1]
-            D["PHASE2"] = MEASURER_OBJECT.PHASE2[-1]
-            D["PHASE3"] = MEASURER_OBJECT.PHASE3[-1]
-            D["PHASE4"] = MEASURER_OBJECT.PHASE4[-1]
-            D["H"] = MEASURER_OBJECT.H[-1]
-            D["HALL"] = MEASURER_OBJECT.HALL[-1]
-            D["T"] = MEASURER_OBJECT.T[-1]
+            last = MEASURER_OBJECT.data.latest()
+            D["errors"] = MEASURER_OBJECT.errors.counters()
+            for name in ["R1", "R2", "R3", "R4", "PHASE1", "PHASE2", "PHASE3", "PHASE4", "H", "HALL", "T"]:
+                D[name] = last.get(name)
 
             if MEASURER_OBJECT.EXPERIMENT == "cooldown":
-                D["T1"] = MEASURER_OBJECT.T1[-1]
-                D["T2"] = MEASURER_OBJECT.T2[-1]
-                D["T3"] = MEASURER_OBJECT.T3[-1]
-                D["T5"] = MEASURER_OBJECT.T5[-1]
-                D["T6"] = MEASURER_OBJECT.T6[-1]
+                for name in ["T1", "T2", "T3", "T5", "T6"]:
+                    D[name] = last.get(name)
+            elif MEASURER_OBJECT.EXPERIMENT == "didv":
+                for name in ["I", "dVdI"]:
+                    D[name] = last.get(name)
 
         return D
 
@@ -2496,40 +4399,58 @@ class MonitoringThread(threading.Thread):
         while not self.stopped:
             logging.info("Starting monitoring server")
             try:
-                with xmlrpc.server.SimpleXMLRPCServer(("localhost", 13000), allow_none=True,
+                with xmlrpc.server.SimpleXMLRPCServer(self.address, allow_none=True,
                                                       logRequests=False) as self.server:
                     self.server.register_function(self.status, "status")
                     self.server.serve_forever()
             except Exception as exc:
                 logging.warning("Exception in monitoring thread!")
                 logging.exception(exc)
+                # E.g. the port is busy: do not spin
+                time.sleep(1.0)
 
     def requestInterruption(self):
         self.stopped = True
-        self.server.shutdown()
-
-
-# Start Qt event loop unless running in interactive mode.
-if __name__ == '__main__':
-    import sys
-
-    logging.info("Application started")
-
-    I = Instruments()
-
-    # MONITORING_OBJECT = MonitoringThread()
-    # MONITORING_OBJECT.start()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def run_headless() -> bool:
+    """
+    Runs PROGRAM_TEXT without Qt: until the program and the measurer it started are finished, or until SIGTERM/Ctrl+C
+    (e.g. from a service manager). The data is available over the monitoring server. False if the program is wrong.
+    """
+    global MONITORING_OBJECT
+    MONITORING_OBJECT = MonitoringThread(ARGUMENTS.monitoring_host)
+    MONITORING_OBJECT.start()
+
+    start(PROGRAM_TEXT)
+    if PROGRAM_OBJECT is None:
+        return False
+
+    terminated = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: terminated.set())
+    try:
+        while not terminated.wait(1.0):
+            program, measurer = PROGRAM_OBJECT, MEASURER_OBJECT
+            if not (program is not None and program.is_alive()) and not (measurer is not None and measurer.is_alive()):
+                logging.info("Program finished")
+                break
+        else:
+            logging.info("Terminated")
+    except KeyboardInterrupt:
+        logging.info("Interrupted by the user")
+    return True
 
-    if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
-        QtGui.QApplication.instance().exec()
 
-    # if MONITORING_OBJECT is not None:
-    #     logging.info("Stopping monitoring")
-    #     MONITORING_OBJECT.requestInterruption()
-    #     MONITORING_OBJECT.join(5)
-    #     if MONITORING_OBJECT.is_alive():
-    #         logging.error("Error stopping monitoring thread")
-    #     logging.info("MONITORING_OBJECT finished")
+def shutdown():
+    if MONITORING_OBJECT is not None:
+        logging.info("Stopping monitoring")
+        MONITORING_OBJECT.requestInterruption()
+        MONITORING_OBJECT.join(5)
+        if MONITORING_OBJECT.is_alive():
+            logging.error("Error stopping monitoring thread")
+        logging.info("MONITORING_OBJECT finished")
 
     if PROGRAM_OBJECT is not None:
         logging.info("Stopping program thread")
@@ -2547,4 +4468,27 @@ if __name__ == '__main__':
             logging.error("Error stopping measurer thread")
         logging.info("MEASURER_OBJECT finished")
 
+
+# Start Qt event loop unless running in interactive mode.
+if __name__ == '__main__':
+    logging.info("Application started" + (" (headless)" if HEADLESS else ""))
+
+    I = Instruments()
+
+    if HEADLESS:
+        success = run_headless()
+        shutdown()
+        logging.info("Application finished")
+        LOG_LISTENER.stop()
+        sys.exit(0 if success else 1)
+
+    # MONITORING_OBJECT = MonitoringThread()
+    # MONITORING_OBJECT.start()
+
+    if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
+        QtGui.QApplication.instance().exec()
+
+    shutdown()
+
     logging.info("Application finished")
+    LOG_LISTENER.stop()
@@ -18,6 +18,7 @@ class UNITS(enum.Enum):
     Siemens = "SIEM"
 
 K1 = keithley6221.Keithley6221(address="GPIB0::13::INSTR", rm=pyvisa.ResourceManager())
+K1.set_data_format(keithley6221.DATA_FORMATS.DREAL)
 
 time.sleep(1)
 #K1._device.write('SYST:COMM:SER:SEND "VOLT:NPLC 1"')
@@ -33,8 +34,9 @@ tmax=60
 ###########################################################
 
 Delay=0.002 #s
+Poll=0.5 #s, the new readings are read from the buffer in blocks
 
-K1.RunDeltaMeasurements(UNITS.Ohms,I,Delay,"INF",1)
+K1.RunDeltaMeasurements(UNITS.Ohms,I,Delay,"INF",1,buffer_points=65000)
 time.sleep(1)
 
 K1._device.write('SYST:COMM:SER:SEND "VOLT:NPLC 1"')
@@ -48,12 +50,16 @@ file = open("Cooling_curve.txt", "w")
 t=0
 t_start = time.perf_counter()
 while t < tmax:
-      R = K1.GetData()
+      time.sleep(Poll)
+      # (R, timestamp) of every reading since the previous poll; the timestamps come from the buffer
+      rows = K1.GetNewData()
       t = time.perf_counter() - t_start
       #print(t)
-      file.write('%s' % t)
-      file.write(' %s\n' % R)
+      file.write(''.join('%s %s\n' % (ts, R) for R, ts in rows))
 
+# The readings of the last poll interval
+rows = K1.GetNewData()
+file.write(''.join('%s %s\n' % (ts, R) for R, ts in rows))
 
 K1._device.write("SOUR:SWE:ABOR")
 file.close()
@@ -5,12 +5,51 @@ import pyvisa.constants
 import pyvisa.resources as visa_res
 import logging
 import enum
-import matplotlib.pyplot as plt
+import numpy as np
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
 
+class DATA_FORMATS(enum.Enum):
+    ASCII = "ASC"
+    SREAL = "SRE"  # IEEE754 single precision
+    DREAL = "DRE"  # IEEE754 double precision
+
+
+def set_data_format(device: visa_res.MessageBasedResource, data_format: DATA_FORMATS) -> None:
+    """
+    Selects the format of TRAC:DATA? and SENS:DATA? responses.
+    Binary values are sent as an IEEE488.2 block, the byte order is set to little endian (SWAPped).
+    """
+    device.write(f"FORM:DATA {data_format.value}")
+    device.write("FORM:BORD SWAP")
+
+
+def query_trace(
+        device: visa_res.MessageBasedResource,
+        data_format: DATA_FORMATS,
+        start: Optional[int]=None,
+        count: Optional[int]=None,
+        elements: int=2,
+) -> np.ndarray:
+    """
+    Reads the buffer (all of it, or `count` readings from `start`) straight into a numpy array
+    of shape (readings, elements). By default the elements are the reading and its timestamp.
+    """
+    if start is None:
+        command = "TRAC:DATA?"
+    else:
+        command = f"TRAC:DATA:SEL? {start},{count}"
+
+    if data_format == DATA_FORMATS.ASCII:
+        values = device.query_ascii_values(command, container=np.array)
+    else:
+        datatype = "f" if data_format == DATA_FORMATS.SREAL else "d"
+        values = device.query_binary_values(command, datatype=datatype, is_big_endian=False, container=np.array)
+    return np.asarray(values, dtype=np.float64).reshape(-1, elements)
+
+
 class Keithley6221:
     class WAVE_RANGES(enum.Enum):
         BEST = "BEST"
@@ -77,6 +116,8 @@ class Keithley6221:
         self._device_name = device_name
         self._address = address
         self._rm = rm
+        self._data_format = DATA_FORMATS.ASCII
+        self._trace_read = 0
         logger.info(f"Device Keithley6221 [{self._address}] is initialized successfully!")
 
     ########################################################################
@@ -150,11 +191,13 @@ class Keithley6221:
             delay: float=10e-3,
             count: Union[int,str]="INF",
             swe_count: int=1,
+            buffer_points: Optional[int]=None,
     ) -> None:
 
         """
         Эта функция запускать процесс измерения данных, но не хранит ничего в буфере.
         Это значит, что данные можно будет получать просто запросом -- get_delta_data или что-то в этом роде
+        If buffer_points is given, the readings are also stored in the buffer and can be streamed with GetNewData().
         """
         enable_compliance_abort = self.ON_OFF_STATE.ON
         is_2182_ok = self.get_delta_2182_presence()
@@ -196,6 +239,10 @@ class Keithley6221:
         # self.get_error_status()
         self._device.write(f"SOUR:DELT:CAB {enable_compliance_abort.value}")
         self.get_error_status()
+        if buffer_points is not None:
+            self.set_trace_points(buffer_points)
+            self.get_error_status()
+            self.reset_trace_stream()
         self.get_opc()
         self._device.write("SOUR:DELT:ARM")
         time.sleep(2)
@@ -268,6 +315,7 @@ class Keithley6221:
         self.get_error_status()
         self._device.write(f"TRAC:POIN {buffer_points}")
         self.get_error_status()
+        self.reset_trace_stream()
         self._device.write("SOUR:DCON:ARM")
         self.get_error_status()
         self._device.write("INIT:IMM")
@@ -276,6 +324,21 @@ class Keithley6221:
         # To disarm -- SOUR:SWE:ABOR
         return
 
+    def GetNewData(self) -> np.ndarray:
+        """
+        Streaming readout: returns the (reading, timestamp) rows stored in the buffer since the previous call,
+        instead of polling the latest reading with GetData(). Call reset_trace_stream() when a new measurement starts.
+        """
+        count = self.get_trace_actual_data_points()
+        if count <= self._trace_read:
+            return np.zeros((0, 2))
+        rows = query_trace(self._device, self._data_format, start=self._trace_read, count=count - self._trace_read)
+        self._trace_read = count
+        return rows
+
+    def reset_trace_stream(self) -> None:
+        self._trace_read = 0
+
     def GetData(self) -> float:
         response = self._device.query("SENS:DATA?")
         #print(response)
@@ -320,6 +383,9 @@ class Keithley6221:
 
     def restore_defaults(self):
         self._device.write("*RST")
+        # *RST returns the data format to ASCII, keep the selected one
+        if self._data_format != DATA_FORMATS.ASCII:
+            set_data_format(self._device, self._data_format)
 
     def get_idn(self) -> str:
         idn = self._device.query("*IDN?")
@@ -510,11 +576,17 @@ class Keithley6221:
     def set_trace_points(self, buffer_size: int):
         self._device.write(f"TRACe:POINts {buffer_size}")
 
+    def set_data_format(self, data_format: DATA_FORMATS) -> None:
+        set_data_format(self._device, data_format)
+        self._data_format = data_format
+
+    def get_trace_array(self, start: Optional[int]=None, count: Optional[int]=None) -> np.ndarray:
+        """ (reading, timestamp) rows of the buffer, see query_trace """
+        return query_trace(self._device, self._data_format, start=start, count=count)
+
     def get_trace_data(self) -> List[float]:
-        response = self._device.query(f"TRACe:DATA?").strip()
-        numbers = response.split(",")
-        result = [float(number) for number in numbers]
-        logger.info(f"Response from trace = [{response}]")
+        result = self.get_trace_array().ravel().tolist()
+        logger.info(f"Trace: {len(result)} values")
         return result
 
     def get_trace_data_type(self, ):
@@ -567,6 +639,8 @@ class Keithley6221:
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
     rm = pyvisa.ResourceManager()
     x = None
 
@@ -574,6 +648,7 @@ if __name__ == "__main__":
         address = "GPIB0::13::INSTR"
         dev = Keithley6221(address=address, rm=rm)
         print(dev.get_idn())
+        dev.set_data_format(DATA_FORMATS.DREAL)
         start_current = -25e-6
         stop_current=25e-6
         step_size=0.1e-6
@@ -596,12 +671,11 @@ if __name__ == "__main__":
         count = dev.get_trace_actual_data_points()
         print("Trace actual size", count)
         print("Trace buffer free size", dev.get_trace_free_memory())
-        numbers = dev.get_trace_data()
-        print(f"Trace length: {len(numbers)}")
-        print(f"Trace numbers: ", numbers)
-        points = [numbers[2 * i] for i in range(count)]
-        currents = [start_current + i * step_size for i in range(points.__len__())]
-        time_stamps = [numbers[2 * i + 1] for i in range(count)]
+        trace = dev.get_trace_array()
+        print(f"Trace length: {len(trace)}")
+        points = trace[:count, 0]
+        currents = start_current + np.arange(len(points)) * step_size
+        time_stamps = trace[:count, 1]
         print(f"Trace data type: {dev.get_trace_data_type()}")
         plt.plot(currents, points, "o")
         plt.show()
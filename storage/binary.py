@@ -0,0 +1,302 @@
+"""
+Chunked columnar binary data files.
+
+Layout (little endian):
+    b"LTMBIN01"                      magic
+    uint32                           length of the JSON header
+    JSON                             {"channels": [...], "units": [...], "chunk_rows": N, "dtype": "<f8"}
+    padding                          up to a multiple of 64 bytes
+    chunk, chunk, ...
+
+Every chunk has the same size: a 16 byte header (b"CHNK", uint32 number of valid rows, 8 reserved bytes) followed by
+the preallocated float64 columns, `chunk_rows` values each. Missing values are NaN. The rows counter is updated after
+the data, so a file that is being written (or was cut by a crash) is always readable up to the last counted row.
+
+Usage:
+    f = BinaryDataFile("data/2021-01-01/....bin")
+    T = f["T"]        # one channel as an ndarray, no text parsing
+    f.snapshot()      # all the channels for a MinMaxPyramid, served from the memory map
+
+    python -m storage.binary data/2021-01-01/*.txt    # converts existing TSV files
+"""
+
+import bisect
+import json
+import logging
+import os
+import struct
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from storage.writer import DataWriter, _Block
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LTMBIN01"
+CHUNK_MAGIC = b"CHNK"
+CHUNK_HEADER_SIZE = 16
+ALIGNMENT = 64
+
+
+def _to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class ChunkedFileWriter:
+    """ Appends rows to a chunked binary data file (synchronously) """
+
+    def __init__(self, filename: str, names: List[str], units: List[str], chunk_rows: int = 65536):
+        self.filename = filename
+        self.names = list(names)
+        self.units = list(units)
+        self.chunk_rows = chunk_rows
+        self.chunk_bytes = CHUNK_HEADER_SIZE + len(self.names) * chunk_rows * 8
+
+        header = json.dumps({"channels": self.names, "units": self.units, "chunk_rows": chunk_rows,
+                             "dtype": "<f8"}).encode("utf-8")
+        head = MAGIC + struct.pack("<I", len(header)) + header
+        self.data_offset = (len(head) + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+        self._file = open(filename, "w+b")
+        self._file.write(head.ljust(self.data_offset, b"\0"))
+        self._chunks = 0
+        self._fill = chunk_rows  # No chunk yet: the first row starts a new one
+
+    def fileno(self) -> int:
+        return self._file.fileno()
+
+    def _chunk_offset(self) -> int:
+        return self.data_offset + (self._chunks - 1) * self.chunk_bytes
+
+    def _new_chunk(self):
+        self._chunks += 1
+        # Preallocate the whole chunk (sparse where supported), the unused values are never read
+        self._file.truncate(self.data_offset + self._chunks * self.chunk_bytes)
+        self._file.seek(self._chunk_offset())
+        self._file.write(CHUNK_MAGIC + struct.pack("<IQ", 0, 0))
+        self._fill = 0
+
+    def append(self, rows: Iterable[Iterable]):
+        """
+        Appends rows of values in the channel order (a 2D array or rows of values). None and non-numbers are stored
+        as NaN.
+        """
+        if isinstance(rows, np.ndarray):
+            data = rows.astype("<f8").reshape(-1, len(self.names))
+        else:
+            data = np.array([[_to_float(x) for x in row] for row in rows], dtype="<f8").reshape(-1, len(self.names))
+
+        start = 0
+        while start < len(data):
+            if self._fill == self.chunk_rows:
+                self._new_chunk()
+            count = min(self.chunk_rows - self._fill, len(data) - start)
+            offset = self._chunk_offset()
+            for i in range(len(self.names)):
+                self._file.seek(offset + CHUNK_HEADER_SIZE + (i * self.chunk_rows + self._fill) * 8)
+                self._file.write(data[start:start + count, i].tobytes())
+            self._fill += count
+            # The counter goes last: readers never see rows that are not written yet
+            self._file.seek(offset + len(CHUNK_MAGIC))
+            self._file.write(struct.pack("<I", self._fill))
+            start += count
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class BinaryDataWriter(DataWriter):
+    """ DataWriter producing a chunked binary file instead of the TSV one (same queue and durability policy) """
+
+    def __init__(self, filename: str, names: List[str], units: List[str], chunk_rows: int = 65536, **policy):
+        self.names = names
+        self.units = units
+        self.chunk_rows = chunk_rows
+        super().__init__(filename, **policy)
+
+    def _open(self):
+        return ChunkedFileWriter(self.filename, self.names, self.units, self.chunk_rows)
+
+    def _write(self, items: list):
+        # The rows between the blocks are appended together
+        rows = []
+        for item in items + [None]:
+            if isinstance(item, _Block) or item is None:
+                if rows:
+                    self._file.append(rows)
+                    self.written_rows += len(rows)
+                    rows = []
+                if item is not None:
+                    self._file.append(item.rows)
+                    self.written_rows += len(item)
+            else:
+                rows.append(item)
+        self._file.flush()
+
+
+class BinaryDataFile:
+    """
+    Memory-mapped reader of a chunked binary data file.
+
+    Opening the file reads only the header, the data is mapped with numpy.memmap. chunks(name) gives zero-copy views,
+    file[name] concatenates them into one array. The file may be appended while it is open, call refresh() to see the
+    new rows.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is not a binary data file")
+            length, = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(length).decode("utf-8"))
+
+        self.names: List[str] = header["channels"]
+        self.units: List[str] = header["units"]
+        self.chunk_rows: int = header["chunk_rows"]
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self.data_offset = (len(MAGIC) + 4 + length + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        self._dtype = np.dtype([("magic", "S4"), ("rows", "<u4"), ("reserved", "<u8"),
+                                ("data", header["dtype"], (len(self.names), self.chunk_rows))])
+        self.refresh()
+
+    def refresh(self):
+        chunks = (os.path.getsize(self.filename) - self.data_offset) // self._dtype.itemsize
+        if chunks > 0:
+            self._map = np.memmap(self.filename, dtype=self._dtype, mode="r", offset=self.data_offset,
+                                  shape=(chunks,))
+            self._rows = np.array(self._map["rows"], dtype=np.int64)
+        else:
+            self._map = None
+            self._rows = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return int(self._rows.sum())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def unit(self, name: str) -> str:
+        return self.units[self._index[name]]
+
+    def chunks(self, name: str) -> Iterator[np.ndarray]:
+        i = self._index[name]
+        for k, rows in enumerate(self._rows):
+            yield self._map["data"][k, i, :rows]
+
+    def blocks(self) -> Iterator[np.ndarray]:
+        """ Zero-copy views of the chunks, shape (channels, rows) each """
+        for k, rows in enumerate(self._rows):
+            yield self._map["data"][k, :, :rows]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        parts = list(self.chunks(name))
+        if not parts:
+            return np.zeros(0)
+        return np.concatenate(parts)
+
+    def snapshot(self, rows: Optional[int] = None) -> "BinarySnapshot":
+        """ The first `rows` rows (all by default) with the interface of a ChannelSnapshot, nothing is copied """
+        rows = len(self) if rows is None else min(rows, len(self))
+        data = self._map["data"] if self._map is not None else np.zeros((0, len(self.names), self.chunk_rows))
+        return BinarySnapshot(self.names, self._index, data, rows)
+
+
+class ChunkedColumn:
+    """
+    One channel of a BinaryDataFile as a read-only sequence of `length` values over the mapped chunks, shape
+    (chunks, chunk_rows). A slice within a chunk is a view of the map, a slice over several chunks copies only its
+    rows. All the chunks but the last one are full (ChunkedFileWriter starts a chunk when the previous one is full).
+    """
+
+    def __init__(self, chunks: np.ndarray, length: int):
+        self._chunks = chunks
+        self._length = length
+        self._rows = chunks.shape[1]
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            index = range(self._length)[index]
+            return float(self._chunks[index // self._rows, index % self._rows])
+        start, stop, step = index.indices(self._length)
+        if step != 1:
+            return np.asarray(self)[index]
+        if stop <= start:
+            return np.zeros(0)
+        first, last = start // self._rows, (stop - 1) // self._rows
+        if first == last:
+            return self._chunks[first, start % self._rows:stop - first * self._rows]
+        return np.concatenate([self._chunks[first, start % self._rows:]] +
+                              [self._chunks[k] for k in range(first + 1, last)] +
+                              [self._chunks[last, :stop - last * self._rows]])
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def searchsorted(self, value: float, side: str = "left") -> int:
+        """ As ndarray.searchsorted for non-decreasing values (the time), without reading the whole column """
+        return (bisect.bisect_left if side == "left" else bisect.bisect_right)(self, value)
+
+
+class BinarySnapshot:
+    """ The first rows of a BinaryDataFile as ChunkedColumns, in the interface of a ChannelSnapshot (MinMaxPyramid) """
+
+    def __init__(self, names: List[str], index: Dict[str, int], data: np.ndarray, length: int):
+        self.names = names
+        self._index = index
+        self._data = data
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __getitem__(self, name: str) -> ChunkedColumn:
+        return ChunkedColumn(self._data[:, self._index[name], :], self._length)
+
+
+def convert_tsv(filename: str, output: Optional[str] = None, chunk_rows: int = 65536,
+                block_rows: int = 10000) -> str:
+    """ Converts a TSV data file (two header lines: names and units) to the binary format """
+    if output is None:
+        output = os.path.splitext(filename)[0] + ".bin"
+
+    with open(filename, "rt") as f:
+        names = f.readline().rstrip("\n").split("\t")
+        units = f.readline().rstrip("\n").split("\t")
+        writer = ChunkedFileWriter(output, names, units, chunk_rows)
+        try:
+            block = []
+            for line in f:
+                values = line.rstrip("\n").split("\t")
+                if len(values) != len(names):
+                    logger.warning(f"{filename}: skipping malformed line {line!r}")
+                    continue
+                block.append(values)
+                if len(block) == block_rows:
+                    writer.append(block)
+                    block = []
+            writer.append(block)
+        finally:
+            writer.close()
+
+    return output
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+    for path in sys.argv[1:]:
+        logger.info(f"{path} -> {convert_tsv(path)}")
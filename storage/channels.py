@@ -0,0 +1,142 @@
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+
+class ChannelSnapshot:
+    """
+    Length-aligned, read-only views over the channels of a ChannelStore.
+
+    The views share memory with the store: taking a snapshot never copies the data. Rows below `len(snapshot)` are
+    never written again by the store, so a snapshot stays valid while the acquisition keeps appending.
+    `sequence` is the number of changes of the store when the snapshot was taken: equal sequences mean equal data.
+    """
+
+    def __init__(self, names: List[str], index: Dict[str, int], buffer: np.ndarray, length: int, sequence: int = 0):
+        self.names = names
+        self._index = index
+        self._buffer = buffer
+        self._length = length
+        self.sequence = sequence
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        view = self._buffer[self._index[name], :self._length]
+        view.flags.writeable = False
+        return view
+
+    def last(self) -> Dict[str, Optional[float]]:
+        """ The last row as a dict, missing values (NaN) as None """
+        if self._length == 0:
+            return {name: None for name in self.names}
+        row = self._buffer[:, self._length - 1]
+        return {name: (None if np.isnan(row[i]) else float(row[i])) for name, i in self._index.items()}
+
+
+class ChannelStore:
+    """
+    Columnar storage for the measured channels.
+
+    All the channels live in one preallocated float64 array of shape (channels, capacity). When it is full, the
+    capacity is doubled (always a whole number of chunks), so append() is O(1) amortised. Missing values are NaN.
+
+    There is a single writer (the measurer thread). Readers use snapshot() or store[name], both are zero-copy and
+    lock-free: the writer fills a row first and then publishes the new (buffer, length, sequence) with a single
+    assignment, so a reader always gets a length-aligned view of rows that are complete.
+    """
+
+    def __init__(self, names: Iterable[str], chunk_size: int = 16384):
+        self.names = list(names)
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self._chunk_size = chunk_size
+        self._buffer = np.full((len(self.names), chunk_size), np.nan)
+        self._length = 0
+        # (buffer, length, sequence) is replaced as a whole, so readers always see a consistent triple
+        self._sequence = 0
+        self._published = (self._buffer, 0, 0)
+        # The last value of every channel that has been measured at least once (the channels may be sparse)
+        self._latest = {}
+        self._write_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._published[1]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.snapshot()[name]
+
+    @property
+    def capacity(self) -> int:
+        return self._buffer.shape[1]
+
+    def _grow(self):
+        capacity = max(self.capacity * 2, self._chunk_size)
+        capacity = (capacity + self._chunk_size - 1) // self._chunk_size * self._chunk_size
+        buffer = np.full((len(self.names), capacity), np.nan)
+        buffer[:, :self._length] = self._buffer[:, :self._length]
+        # Old snapshots keep referencing the old buffer, it is never written again
+        self._buffer = buffer
+
+    def append(self, **values: Optional[float]) -> int:
+        """
+        Appends one row. Channels that are not given or given as None are stored as NaN.
+        Returns the index of the new row.
+        """
+        with self._write_lock:
+            if self._length == self.capacity:
+                self._grow()
+
+            row = self._length
+            column = self._buffer[:, row]
+            column[:] = np.nan
+            for name, value in values.items():
+                if value is not None:
+                    column[self._index[name]] = value
+                    self._latest[name] = float(value)
+
+            self._length += 1
+            self._publish()
+            return row
+
+    def extend(self, rows: np.ndarray):
+        """ Appends a block of rows: shape (rows, channels), the channels in the order of the names, NaN if missing """
+        rows = np.asarray(rows, dtype=float).reshape(-1, len(self.names))
+        with self._write_lock:
+            while self._length + len(rows) > self.capacity:
+                self._grow()
+
+            self._buffer[:, self._length:self._length + len(rows)] = rows.T
+            for i, name in enumerate(self.names):
+                present = np.flatnonzero(~np.isnan(rows[:, i]))
+                if len(present):
+                    self._latest[name] = float(rows[present[-1], i])
+
+            self._length += len(rows)
+            self._publish()
+
+    def _publish(self):
+        self._sequence += 1
+        self._published = (self._buffer, self._length, self._sequence)
+
+    def snapshot(self) -> ChannelSnapshot:
+        buffer, length, sequence = self._published
+        return ChannelSnapshot(self.names, self._index, buffer, length, sequence)
+
+    def last(self) -> Dict[str, Optional[float]]:
+        return self.snapshot().last()
+
+    def latest(self) -> Dict[str, Optional[float]]:
+        """
+        The most recent value of every channel, None if it has never been measured. Unlike last(), it does not
+        depend on which channels happen to be present in the last row.
+        """
+        latest = dict(self._latest)
+        return {name: latest.get(name) for name in self.names}
@@ -0,0 +1,184 @@
+"""
+Finished (or still growing) data files for the history browser of experiment2.
+
+A run is loaded block by block in a background thread, and its MinMaxPyramid is built as the blocks come, so the
+beginning of a big file is plotted right away. TSV files (Measurer and DiDvMeasurer: a line of names, a line of units,
+tab-separated values) are memory-mapped and indexed by their line ends, then parsed one block of lines at a time into a
+ChannelStore. Binary files (storage.binary) need neither parsing nor a copy: the pyramid reads their memory-mapped
+chunks as they are. If a TSV file has a binary twin (Measurer.BINARY_OUTPUT), the binary one is loaded instead.
+"""
+
+import io
+import logging
+import os
+import threading
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+from storage.binary import BinaryDataFile
+from storage.channels import ChannelStore
+from storage.pyramid import MinMaxPyramid
+
+logger = logging.getLogger(__name__)
+
+
+def line_ends(data: np.ndarray, window: int = 1 << 26) -> np.ndarray:
+    """ Offsets of the b"\\n" of a memory-mapped file, found `window` bytes at a time """
+    parts = [np.flatnonzero(data[start:start + window] == ord("\n")) + start for start in range(0, len(data), window)]
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+
+def parse_tsv(data: bytes, columns: int, filename: str = "") -> np.ndarray:
+    """ Rows of tab-separated values as an array (rows, columns). None is NaN, malformed lines are skipped. """
+    data = data.replace(b"\r", b"").replace(b"None", b"nan")
+    try:
+        return np.loadtxt(io.BytesIO(data), delimiter="\t", ndmin=2).reshape(-1, columns)
+    except ValueError:
+        pass
+
+    # Slow path, only for the blocks with broken lines (e.g. cut by a crash)
+    rows = []
+    for line in data.split(b"\n"):
+        values = line.split(b"\t")
+        try:
+            if len(values) != columns:
+                raise ValueError
+            rows.append([float(value) for value in values])
+        except ValueError:
+            if line:
+                logger.warning(f"{filename}: skipping malformed line {line!r}")
+    return np.array(rows, dtype=float).reshape(-1, columns)
+
+
+class HistoryRun(threading.Thread):
+    """
+    One data file loaded in the background, query() gives the decimated curve of a channel against the channel chosen
+    with set_x() (the first column by default). The rows of a TSV file are parsed into `store` (ChannelStore), the
+    columns of a binary file are read from its memory map as they are (BinaryDataFile.snapshot), so only the pyramid
+    takes memory.
+    """
+
+    BLOCK_ROWS = 65536
+
+    def __init__(self, filename: str):
+        super().__init__(name=f"HistoryRun({os.path.basename(filename)})", daemon=True)
+
+        binary = os.path.splitext(filename)[0] + ".bin"
+        if not filename.endswith(".bin") and os.path.exists(binary):
+            logger.info(f"{filename}: loading the binary twin {binary}")
+            filename = binary
+
+        self.filename = filename
+        self.stopped = False
+        self.error: Optional[Exception] = None
+
+        if filename.endswith(".bin"):
+            self._open_binary()
+            self.store = None
+        else:
+            self._open_tsv()
+            self.store = ChannelStore(self.names, chunk_size=max(self.total_rows, 1))
+        self.loaded = 0
+        # Channels that never decrease (so far): the visible range is found with a binary search on them
+        self._monotone = np.ones(len(self.names), dtype=bool)
+        self._last_row = None
+
+        # The pyramid is updated by the loader and read by the GUI
+        self.lock = threading.Lock()
+        self.x = self.names[0]
+        self.pyramid = MinMaxPyramid(self.names, time_name=self.x)
+        self.start()
+
+    def _open_tsv(self):
+        self._data = np.memmap(self.filename, dtype=np.uint8, mode="r")
+        ends = line_ends(self._data)
+        if len(ends) < 2:
+            raise ValueError(f"{self.filename}: no header")
+        self.names: List[str] = bytes(self._data[:ends[0]]).decode("cp1251").rstrip("\r").split("\t")
+        self.units: List[str] = bytes(self._data[ends[0] + 1:ends[1]]).decode("cp1251").rstrip("\r").split("\t")
+        # A line without its end is still being written: it is not loaded
+        self._line_ends = ends[1:]
+        self.total_rows = len(self._line_ends) - 1
+
+    def _open_binary(self):
+        self._file = BinaryDataFile(self.filename)
+        self.names = self._file.names
+        self.units = self._file.units
+        self.total_rows = len(self._file)
+
+    def _blocks(self) -> Iterator[np.ndarray]:
+        if self.filename.endswith(".bin"):
+            # Zero-copy views of the chunks, one chunk is one block
+            for block in self._file.blocks():
+                yield block.T
+            return
+
+        for first in range(0, self.total_rows, self.BLOCK_ROWS):
+            last = min(first + self.BLOCK_ROWS, self.total_rows)
+            start, stop = self._line_ends[first] + 1, self._line_ends[last] + 1
+            yield parse_tsv(bytes(self._data[start:stop]), len(self.names), self.filename)
+
+    def run(self):
+        try:
+            for block in self._blocks():
+                if self.stopped:
+                    break
+                if not len(block):
+                    continue
+
+                rows = block if self._last_row is None else np.vstack([self._last_row, block])
+                self._monotone &= np.all(np.diff(rows, axis=0) >= 0, axis=0)
+                self._last_row = block[-1]
+
+                if self.store is not None:
+                    self.store.extend(block)
+                self.loaded += len(block)
+                with self.lock:
+                    self.pyramid.update(self.snapshot())
+            logger.info(f"{self.name}: {self.loaded} rows loaded")
+        except Exception as exc:
+            self.error = exc
+            logger.warning(f"{self.name}: cannot load the data file!")
+            logger.exception(exc)
+
+    def requestInterruption(self):
+        self.stopped = True
+
+    def progress(self) -> (int, int):
+        """ (loaded rows, rows in the file) """
+        return self.loaded, self.total_rows
+
+    def snapshot(self):
+        """ The rows loaded so far: a ChannelSnapshot of the store, or a BinarySnapshot of the mapped file """
+        return self._file.snapshot(self.loaded) if self.store is None else self.store.snapshot()
+
+    def set_x(self, name: str):
+        """ Plots against another channel. The pyramid is rebuilt in the background. """
+        if name == self.x:
+            return
+        with self.lock:
+            self.x = name
+            self.pyramid = MinMaxPyramid(self.names, time_name=name)
+        # If the loader still runs, it updates the new pyramid too: the update of this thread is then just shorter
+        threading.Thread(target=self._update_pyramid, name=f"{self.name}.pyramid", daemon=True).start()
+
+    def _update_pyramid(self):
+        with self.lock:
+            self.pyramid.update(self.snapshot())
+
+    def rows(self) -> int:
+        """ The number of rows that can be plotted now """
+        return self.pyramid.rows
+
+    def query(self, name: str, x0: float, x1: float, max_points: int = 2000,
+              context_points: int = 500) -> (np.ndarray, np.ndarray):
+        """
+        (x, values) of a channel. Against a non-decreasing X (the time) the visible range [x0, x1] gets max_points
+        points and the rest context_points (see MinMaxPyramid.query_view), otherwise the whole run gets max_points.
+        """
+        with self.lock:
+            if self._monotone[self.names.index(self.x)]:
+                start, stop = self.pyramid.rows_between(x0, x1)
+                return self.pyramid.query_view(name, start, stop, max_points, context_points)
+            return self.pyramid.query(name, 0, None, max_points)
@@ -0,0 +1,168 @@
+from typing import List, Tuple
+
+import numpy as np
+
+
+def _reduce(tmin: np.ndarray, vmin: np.ndarray, tmax: np.ndarray, vmax: np.ndarray, factor: int):
+    """
+    Groups every `factor` consecutive buckets (or points) of every channel into one. All arrays have the shape
+    (channels, n), n is a multiple of factor. Returns the (tmin, vmin, tmax, vmax) of the new buckets.
+    """
+    channels, n = vmin.shape
+    shape = (channels, n // factor, factor)
+
+    def pick(times, values, fill, arg):
+        values = values.reshape(shape)
+        index = arg(np.where(np.isnan(values), fill, values), axis=2)[..., np.newaxis]
+        value = np.take_along_axis(values, index, axis=2)[..., 0]
+        time = np.take_along_axis(times.reshape(shape), index, axis=2)[..., 0]
+        # A bucket without any value gives NaN (the fill value is never picked otherwise)
+        time[np.isnan(value)] = np.nan
+        return time, value
+
+    tmin, vmin = pick(tmin, vmin, np.inf, np.argmin)
+    tmax, vmax = pick(tmax, vmax, -np.inf, np.argmax)
+    return tmin, vmin, tmax, vmax
+
+
+class _Level:
+    """ Buckets of one level: the time and value of the minimum and of the maximum, for every channel """
+
+    def __init__(self, channels: int, capacity: int = 1024):
+        self.length = 0
+        self.arrays = [np.full((channels, capacity), np.nan) for _ in range(4)]
+
+    def append(self, parts):
+        count = parts[0].shape[1]
+        if self.length + count > self.arrays[0].shape[1]:
+            capacity = max(2 * self.arrays[0].shape[1], self.length + count)
+            for i, array in enumerate(self.arrays):
+                grown = np.full((array.shape[0], capacity), np.nan)
+                grown[:, :self.length] = array[:, :self.length]
+                self.arrays[i] = grown
+        for array, part in zip(self.arrays, parts):
+            array[:, self.length:self.length + count] = part
+        self.length += count
+
+    def slice(self, start: int, stop: int):
+        return [array[:, start:stop] for array in self.arrays]
+
+
+class MinMaxPyramid:
+    """
+    Multi-resolution min/max decimation of the channels of a ChannelStore.
+
+    A bucket of level L covers factor**L consecutive rows and keeps the minimum and the maximum of every channel
+    together with their times, so a decimated curve still shows every spike. update() only reduces the rows added
+    since the previous call. query() picks the coarsest level that still gives `max_points` points for the requested
+    rows and fills the edges with finer levels, so its cost depends on max_points, not on the number of rows.
+    """
+
+    def __init__(self, names: List[str], time_name: str = "TIME", factor: int = 4):
+        self.names = list(names)
+        self.time_name = time_name
+        self.factor = factor
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self.reset()
+
+    def reset(self):
+        self.rows = 0
+        self.levels: List[_Level] = []
+        self._snapshot = None
+
+    def update(self, snapshot):
+        """ Takes the new rows of a ChannelSnapshot of the store (or a BinarySnapshot of a file) """
+        if len(snapshot) < self.rows:
+            # Rows have been removed from the store: start over
+            self.reset()
+        self._snapshot = snapshot
+        self.rows = len(snapshot)
+
+        level = 1
+        while True:
+            if level > len(self.levels):
+                if self._length(level - 1) < self.factor:
+                    break
+                self.levels.append(_Level(len(self.names)))
+
+            current = self.levels[level - 1]
+            start = current.length * self.factor
+            count = (self._length(level - 1) - start) // self.factor * self.factor
+            if count:
+                current.append(_reduce(*self._parts(level - 1, start, start + count), self.factor))
+            level += 1
+
+    def _length(self, level: int) -> int:
+        return self.rows if level == 0 else self.levels[level - 1].length
+
+    def _parts(self, level: int, start: int, stop: int):
+        if level > 0:
+            return self.levels[level - 1].slice(start, stop)
+        times = np.broadcast_to(self._snapshot[self.time_name][start:stop], (len(self.names), stop - start))
+        values = np.stack([self._snapshot[name][start:stop] for name in self.names])
+        return times, values, times, values
+
+    def level_for(self, rows: int, max_points: int) -> int:
+        """ The coarsest level needed to show `rows` rows with at most max_points points (2 per bucket) """
+        level = 0
+        while level < len(self.levels) and rows / self.factor ** level > max_points / 2:
+            level += 1
+        return level
+
+    def _cover(self, level: int, start: int, stop: int) -> List[Tuple[int, int, int]]:
+        """ (level, start, stop) segments covering the rows [start, stop), the middle one at the given level """
+        if start >= stop:
+            return []
+        if level == 0:
+            return [(0, start, stop)]
+        size = self.factor ** level
+        first = -(-start // size)
+        last = min(stop // size, self.levels[level - 1].length)
+        if first >= last:
+            return self._cover(level - 1, start, stop)
+        return (self._cover(level - 1, start, first * size) + [(level, first, last)] +
+                self._cover(level - 1, last * size, stop))
+
+    def rows_between(self, t0: float, t1: float) -> (int, int):
+        """ The rows [start, stop) with t0 <= time <= t1. The time is assumed non-decreasing (the Measurer order). """
+        if self._snapshot is None:
+            return 0, 0
+        # The snapshot has self.rows rows, searchsorted() of the column (ndarray or ChunkedColumn) reads only a few
+        times = self._snapshot[self.time_name]
+        return int(times.searchsorted(t0, "left")), int(times.searchsorted(t1, "right"))
+
+    def query(self, name: str, start: int = 0, stop: int = None, max_points: int = 2000) -> (np.ndarray, np.ndarray):
+        """ (times, values) of the channel over the rows [start, stop), without missing values """
+        if self._snapshot is None:
+            return np.zeros(0), np.zeros(0)
+        stop = self.rows if stop is None else min(stop, self.rows)
+        i = self._index[name]
+
+        xs, ys = [], []
+        for level, first, last in self._cover(self.level_for(stop - start, max_points), start, stop):
+            if level == 0:
+                xs.append(self._snapshot[self.time_name][first:last])
+                ys.append(self._snapshot[name][first:last])
+                continue
+            tmin, vmin, tmax, vmax = (array[i] for array in self.levels[level - 1].slice(first, last))
+            # Both extremes of every bucket, in the time order
+            swap = tmax < tmin
+            xs.append(np.column_stack([np.where(swap, tmax, tmin), np.where(swap, tmin, tmax)]).ravel())
+            ys.append(np.column_stack([np.where(swap, vmax, vmin), np.where(swap, vmin, vmax)]).ravel())
+
+        if not xs:
+            return np.zeros(0), np.zeros(0)
+        x, y = np.concatenate(xs), np.concatenate(ys)
+        finite = np.isfinite(y)
+        return x[finite], y[finite]
+
+    def query_view(self, name: str, start: int, stop: int, max_points: int = 2000,
+                   context_points: int = 500) -> (np.ndarray, np.ndarray):
+        """
+        Like query(), with the level of detail of a map: the visible rows [start, stop) get max_points points (all
+        the rows when zoomed in), the rows before and after them get context_points points each.
+        """
+        parts = [self.query(name, 0, start, context_points),
+                 self.query(name, start, stop, max_points),
+                 self.query(name, stop, self.rows, context_points)]
+        return np.concatenate([x for x, y in parts]), np.concatenate([y for x, y in parts])
@@ -0,0 +1,101 @@
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+
+class RunningStats:
+    """
+    Running count, mean, variance, min and max of every channel (Welford's algorithm).
+
+    update() takes one row, so the statistics of a step are ready as soon as the step ends, without going over its
+    points again. Missing values (None, NaN) are skipped, the same as with np.nanmean/np.nanstd.
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self.names = list(names)
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self.reset()
+
+    def reset(self):
+        n = len(self.names)
+        self.count = np.zeros(n, dtype=np.int64)
+        self._mean = np.zeros(n)
+        self._m2 = np.zeros(n)
+        self._min = np.full(n, np.inf)
+        self._max = np.full(n, -np.inf)
+
+    def update(self, values: Dict[str, Optional[float]]):
+        row = np.full(len(self.names), np.nan)
+        for name, value in values.items():
+            i = self._index.get(name)
+            if i is not None and value is not None:
+                row[i] = value
+
+        present = np.isfinite(row)
+        x = row[present]
+        self.count[present] += 1
+        delta = x - self._mean[present]
+        self._mean[present] += delta / self.count[present]
+        self._m2[present] += delta * (x - self._mean[present])
+        self._min[present] = np.minimum(self._min[present], x)
+        self._max[present] = np.maximum(self._max[present], x)
+
+    def update_block(self, rows: np.ndarray):
+        """ Takes a block of rows, shape (rows, channels) in the order of the names, NaN if missing """
+        rows = np.asarray(rows, dtype=float).reshape(-1, len(self.names))
+        present = np.isfinite(rows)
+        count = present.sum(axis=0)
+        used = count > 0
+        if not np.any(used):
+            return
+        rows, present, count = rows[:, used], present[:, used], count[used]
+
+        # The statistics of the block, merged with the running ones (Chan et al.)
+        mean = np.where(present, rows, 0).sum(axis=0) / count
+        m2 = np.where(present, (rows - mean) ** 2, 0).sum(axis=0)
+        total = self.count[used] + count
+        delta = mean - self._mean[used]
+        self._mean[used] += delta * count / total
+        self._m2[used] += m2 + delta ** 2 * self.count[used] * count / total
+        self.count[used] = total
+        self._min[used] = np.minimum(self._min[used], np.where(present, rows, np.inf).min(axis=0))
+        self._max[used] = np.maximum(self._max[used], np.where(present, rows, -np.inf).max(axis=0))
+
+    def _value(self, array: np.ndarray, name: str) -> float:
+        i = self._index[name]
+        return float(array[i]) if self.count[i] else np.nan
+
+    def mean(self, name: str) -> float:
+        return self._value(self._mean, name)
+
+    def var(self, name: str) -> float:
+        """ Population variance (ddof=0), as np.var """
+        i = self._index[name]
+        return float(self._m2[i] / self.count[i]) if self.count[i] else np.nan
+
+    def std(self, name: str) -> float:
+        return float(np.sqrt(self.var(name)))
+
+    def min(self, name: str) -> float:
+        return self._value(self._min, name)
+
+    def max(self, name: str) -> float:
+        return self._value(self._max, name)
+
+    def mean_dev(self, name: str) -> (float, float):
+        return self.mean(name), self.std(name)
+
+
+def linear_fit(times: np.ndarray, values: np.ndarray) -> (float, float):
+    """
+    Least-squares line through the points: (slope, standard deviation of the residuals). Missing values are skipped,
+    NaN if there are less than 2 points.
+    """
+    present = np.isfinite(values)
+    t, v = times[present], values[present]
+    if len(t) < 2 or np.ptp(t) == 0:
+        return np.nan, np.nan
+    t = t - t.mean()
+    slope = float(np.dot(t, v - v.mean()) / np.dot(t, t))
+    residuals = v - v.mean() - slope * t
+    return slope, float(residuals.std())
@@ -0,0 +1,182 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Iterable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Control messages of the queue
+_CHECKPOINT = object()
+_CLOSE = object()
+
+
+class _Block:
+    """ A block of rows queued by write_rows(), `missing` is the text of NaN in each column """
+    __slots__ = ("rows", "missing")
+
+    def __init__(self, rows: np.ndarray, missing: list):
+        self.rows = rows
+        self.missing = missing
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class DataWriter(threading.Thread):
+    """
+    Writes the rows of a tab-separated data file in a background thread.
+
+    write_row() only puts the row into a bounded queue, so the acquisition never waits for the disk. The rows are
+    formatted and written in blocks. Durability policy:
+        * the block is written and flushed to the OS every `flush_rows` rows or `flush_seconds` seconds,
+          whatever comes first, so a crash of the program loses at most one flush interval;
+        * the file is fsync'ed every `fsync_seconds` seconds and on every checkpoint() (end of a step etc.),
+          so a power loss loses at most the data since the last checkpoint.
+    If the queue is full (the disk is stuck for a long time) new rows are dropped and counted in `dropped_rows`.
+    Rows that cannot be written (e.g. the disk is full) are kept and written with the next block. close() gives them one
+    last attempt, the rows that are still not written are counted in `dropped_rows` and logged as an error.
+    write_rows() queues a whole block of rows (a 2D array) as one item, for the sources that produce many rows at once.
+    """
+
+    def __init__(self, filename: str, flush_rows: int = 50, flush_seconds: float = 1.0,
+                 fsync_seconds: Optional[float] = 60.0, max_rows: int = 100000):
+        super().__init__(name=f"DataWriter({os.path.basename(filename)})", daemon=True)
+
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync_seconds = fsync_seconds
+
+        self.written_rows = 0
+        self.dropped_rows = 0
+
+        self._queue = queue.Queue(maxsize=max_rows)
+        self._file = self._open()
+        self.start()
+
+    def write_row(self, values: Iterable) -> bool:
+        """ Queues one row. Never blocks. Returns False if the row has been dropped. """
+        try:
+            self._queue.put_nowait(tuple(values))
+        except queue.Full:
+            self.dropped_rows += 1
+            if self.dropped_rows == 1 or self.dropped_rows % 1000 == 0:
+                logger.warning(f"{self.name}: queue is full, {self.dropped_rows} rows dropped")
+            return False
+        return True
+
+    def write_rows(self, rows: np.ndarray, missing="None") -> bool:
+        """
+        Queues a block of rows, shape (rows, values), NaN is a missing value. Never blocks. `missing` is how NaN is
+        written: one text for all the columns or one per column. None by default, the same as in the rows.
+        """
+        rows = np.asarray(rows, dtype=float).reshape(len(rows), -1)
+        if isinstance(missing, str):
+            missing = [missing] * rows.shape[1]
+        try:
+            self._queue.put_nowait(_Block(rows, list(missing)))
+        except queue.Full:
+            self.dropped_rows += len(rows)
+            logger.warning(f"{self.name}: queue is full, {self.dropped_rows} rows dropped")
+            return False
+        return True
+
+    def checkpoint(self):
+        """ Asks for the queued rows to be written and fsync'ed. Never blocks. """
+        try:
+            self._queue.put_nowait(_CHECKPOINT)
+        except queue.Full:
+            # The writer is busy anyway, the rows will be flushed with the next block
+            pass
+
+    def close(self, timeout: Optional[float] = None):
+        """ Writes everything that is queued, fsyncs and closes the file """
+        self._queue.put(_CLOSE)
+        self.join(timeout)
+        if self.is_alive():
+            logger.error(f"{self.name}: the writer has not finished in {timeout} seconds")
+
+    def _open(self):
+        return open(self.filename, "wt")
+
+    def _write(self, items: list):
+        """ Writes the queued items: rows (tuples) and blocks of rows (arrays) """
+        lines = []
+        for item in items:
+            if isinstance(item, _Block):
+                missing = item.missing
+                lines.extend("\t".join([missing[i] if x != x else str(x) for i, x in enumerate(row)]) + "\n"
+                             for row in item.rows.tolist())
+            else:
+                lines.append("\t".join([str(x) for x in item]) + "\n")
+        self._file.write("".join(lines))
+        self._file.flush()
+        self.written_rows += len(lines)
+
+    def _fsync(self):
+        os.fsync(self._file.fileno())
+
+    def run(self):
+        pending = []
+        pending_rows = 0
+        dirty = False
+        last_flush = last_fsync = time.monotonic()
+
+        while True:
+            # Sleep until the next row or until the pending block/unsynced data is due
+            deadlines = []
+            if pending:
+                deadlines.append(last_flush + self.flush_seconds)
+            if dirty and self.fsync_seconds is not None:
+                deadlines.append(last_fsync + self.fsync_seconds)
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            closing = item is _CLOSE
+            sync = closing or item is _CHECKPOINT
+            if item is not None and not sync:
+                pending.append(item)
+                pending_rows += len(item) if isinstance(item, _Block) else 1
+
+            now = time.monotonic()
+            try:
+                if pending and (sync or pending_rows >= self.flush_rows or now - last_flush >= self.flush_seconds):
+                    self._write(pending)
+                    pending = []
+                    pending_rows = 0
+                    dirty = True
+                    last_flush = now
+
+                if dirty and (sync or (self.fsync_seconds is not None and now - last_fsync >= self.fsync_seconds)):
+                    self._fsync()
+                    dirty = False
+                    last_fsync = now
+            except Exception as exc:
+                # Keep the rows, the next attempt after flush_seconds may succeed (e.g. after freeing disk space)
+                logger.warning(f"{self.name}: cannot write the data file!")
+                logger.exception(exc)
+                last_flush = last_fsync = now
+
+            if closing:
+                if pending:
+                    self._write_last(pending, pending_rows)
+                break
+
+        self._file.close()
+
+    def _write_last(self, pending: list, pending_rows: int):
+        """ One more attempt on close, the rows that still cannot be written are counted in dropped_rows and logged """
+        try:
+            self._write(pending)
+        except Exception as exc:
+            self.dropped_rows += pending_rows
+            logger.error(f"{self.name}: {pending_rows} rows are lost, the data file cannot be written!")
+            logger.exception(exc)
@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+import pytest
+
+# experiment2 needs the instrument libraries even without the GUI
+pytest.importorskip("pyvisa")
+os.environ["EXPERIMENT2_HEADLESS"] = "1"
+
+import experiment2  # noqa: E402
+from experiment2 import ExceptionSyntaxError, For, Repeat, Wait, block_end, compile_lines, compile_program  # noqa: E402
+from experiment2 import AdaptiveStep, StepRefinement, WaitForStable, contains_command  # noqa: E402
+from storage.channels import ChannelStore  # noqa: E402
+from storage.stats import RunningStats  # noqa: E402
+
+
+def numbered(text: str) -> list:
+    return list(enumerate(text.split("\n"), start=1))
+
+
+def estimate(text: str) -> float:
+    program = experiment2.Program(text)
+    program.commands = compile_program(text)
+    return program.run_commands(dryrun=True)
+
+
+def test_block_end():
+    lines = numbered("repeat 2 {\n  for X in 1..2 {\n    wait 1 s\n  }\n  wait 2 s\n}\nwait 3 s")
+    assert block_end(lines, 1, "repeat 2 {") == 5
+    assert block_end(lines, 2, "for X in 1..2 {") == 3
+    with pytest.raises(ExceptionSyntaxError, match="No } for repeat 2"):
+        block_end(lines[:5], 1, "repeat 2 {")
+
+
+def test_compile_lines_nested_loops():
+    commands = compile_lines(numbered("wait 1 s\n\nrepeat 2 {\n  for X in 1..3 {\n    wait $X s\n  }\n}\nwait 2 s"))
+
+    assert [type(command) for command in commands] == [Wait, Repeat, Wait]
+    assert [command.line for command in commands] == [1, 3, 8]
+    loop, = commands[1].commands(0)
+    assert isinstance(loop, For) and loop.iterations() == 3
+    assert loop.commands(2) == (Wait(5, 3.0),)
+
+
+def test_compile_lines_reports_the_line():
+    with pytest.raises(ExceptionSyntaxError, match="Line 2: wiat 1 s"):
+        compile_lines(numbered("wait 1 s\nwiat 1 s"))
+    with pytest.raises(ExceptionSyntaxError, match="Line 1: repeat 2"):
+        compile_lines(numbered("repeat 2\nwait 1 s\n}"))
+
+
+def test_compile_program_checks_every_iteration():
+    # Only the value in the middle makes a wrong command
+    with pytest.raises(ExceptionSyntaxError, match="Line 1: for X = 1.5: Line 2: repeat 1.5"):
+        compile_program("for X in 1..2 step 0.5 {\n  repeat $X {\n    wait 1 s\n  }\n}")
+
+
+def test_loop_estimate():
+    assert estimate("repeat 3 {\n  wait 2 s\n}") == 6.0
+    assert estimate("for X in 1..4 {\n  wait $X s\n}") == 10.0
+    assert estimate("for X in 1..1 {\n  wait $X min\n}") == 60.0
+    assert estimate("repeat 0 {\n  wait 1 s\n}") == 0.0
+    # Every iteration ramps the field from where the one before left it: 1 T in 1 min
+    assert estimate("config current-field 0\nfor X in 0..10 {\n  set-target-field $X T with rate 1 T/min\n}") == 600.0
+    assert estimate("config current-field 5\nfor X in 1..3 {\n  set-target-field $X T with rate 1 T/min\n}") == 360.0
+    assert estimate("config current-field 0\nrepeat 3 {\n  set-target-field 1 T with rate 1 T/min\n  "
+                    "set-target-field 0 T with rate 1 T/min\n}") == 360.0
+
+
+def test_contains_command():
+    assert contains_command(compile_program("wait 1 s\nwait-for-stable T within 1 mK for 1 min"), WaitForStable)
+    assert contains_command(compile_program("repeat 2 {\n  for X in 1..2 {\n    wait-for-stable H within $X mT for 10 s"
+                                            "\n  }\n}"), WaitForStable)
+    assert not contains_command(compile_program("repeat 2 {\n  wait 1 s\n}"), WaitForStable)
+
+
+def relax(adaptive: AdaptiveStep, signal, relax_time: float, period: float = 0.1) -> float:
+    """ Feeds the points of the signal after a step at 0 s, returns the time the relaxation ends """
+    data = ChannelStore(["TIME", "R1"])
+    adaptive.start(["R1"], tau=1.0, first_row=0)
+    for time in np.arange(0.0, 100.0, period):
+        data.append(TIME=time, R1=signal(time))
+        if not adaptive.relaxing(time, 0.0, relax_time, data):
+            return time
+    return np.inf
+
+
+def test_adaptive_step_relaxation():
+    def decay(time):
+        return 1.0 + 0.5 * np.exp(-time)
+
+    # The drift over the window of 3 s, 0.5 (e^3 - 1) exp(-t), is within 1e-3 after 9.2 s (a bit earlier with the
+    # scatter of the curve around the fitted line)
+    assert 8.5 < relax(AdaptiveStep(), decay, relax_time=60.0) <= 9.2
+    # Never before TAUS time constants, never after the relax time
+    assert relax(AdaptiveStep(), lambda time: 1.0, relax_time=60.0) == pytest.approx(5.0)
+    assert relax(AdaptiveStep(), decay, relax_time=4.0) == pytest.approx(4.0)
+
+
+def test_adaptive_step_measurement():
+    rng = np.random.default_rng(3)
+    adaptive = AdaptiveStep(target_sem=1e-4)
+    adaptive.start(["R1"], tau=0.1, first_row=0)
+    adaptive.settled = 0.0
+    stats = RunningStats(["R1"])
+    assert not adaptive.finished(0.0, 60.0, stats)
+
+    finished = None
+    for time in np.arange(0.0, 60.0, 0.01):
+        stats.update({"R1": 1.0 + 1e-3 * rng.normal()})
+        if adaptive.finished(time, 60.0, stats):
+            finished = time
+            break
+    # The standard error of 1e-3 noise is 1e-4 with 100 independent points, one every 2 tau
+    assert finished == pytest.approx(20.0, rel=0.2)
+    assert adaptive.finished(1.0, 1.0, stats)
+
+
+def refine(refinement: StepRefinement, signal, steps) -> list:
+    """ Measures the coarse steps and the refined ones until the budget is spent, returns all the steps in order """
+    measured = []
+    while steps:
+        for step in steps:
+            refinement.add(step, {"R1": signal(step), "R2": 0.0})
+            measured.append(step)
+        steps = refinement.next_steps()
+    return measured
+
+
+def test_step_refinement_next_steps():
+    refinement = StepRefinement(budget=20, min_spacing=0.1)
+    assert refinement.next_steps() == []
+    for step in range(11):
+        refinement.add(float(step), {"R1": float(step > 5.5)})
+
+    # A quarter of the 10 intervals, the jump first
+    steps = refinement.next_steps()
+    assert len(steps) == 3 and 5.5 in steps
+    assert steps == sorted(steps)
+
+    descending = StepRefinement(budget=20, min_spacing=0.1, descending=True)
+    descending.points = refinement.points
+    assert descending.next_steps() == steps[::-1]
+
+
+def test_step_refinement_budget_and_spacing():
+    def jump(step):
+        return float(step > 5.55)
+
+    measured = refine(StepRefinement(budget=30, min_spacing=0.01), jump, [float(step) for step in range(11)])
+    assert len(measured) == 30
+    assert len(set(measured)) == 30
+    # Most of the new steps go around the jump
+    assert sum(5.0 <= step <= 6.0 for step in measured[11:]) > len(measured[11:]) / 2
+
+    # The intervals are not split below 2 min_spacing: the budget is not spent
+    measured = refine(StepRefinement(budget=30, min_spacing=0.6), jump, [0.0, 2.0, 4.0])
+    assert sorted(measured) == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+def test_sr830_sensitivity_labels():
+    labels = [experiment2.Instruments.sensitivity_label(value) for value in experiment2.Instruments.SR830_SENSITIVITIES]
+    assert labels[:3] == ["2 nV", "5 nV", "10 nV"]
+    assert labels[7:10] == ["500 nV", "1 uV", "2 uV"]
+    assert labels[-2:] == ["500 mV", "1 V"]
+    assert len(set(labels)) == len(labels)
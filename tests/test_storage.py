@@ -0,0 +1,299 @@
+import numpy as np
+import pytest
+
+from storage.binary import BinaryDataFile, ChunkedFileWriter, convert_tsv
+from storage.channels import ChannelStore
+from storage.history import HistoryRun, line_ends, parse_tsv
+from storage.pyramid import MinMaxPyramid
+from storage.stats import RunningStats
+from storage.writer import DataWriter
+
+
+def test_channel_store_append_and_grow():
+    store = ChannelStore(["TIME", "R1"], chunk_size=4)
+    for i in range(10):
+        assert store.append(TIME=float(i), R1=None if i % 3 else 10.0 * i) == i
+
+    assert len(store) == 10
+    assert store.capacity == 16
+    np.testing.assert_array_equal(store["TIME"], np.arange(10.0))
+    assert np.isnan(store["R1"][1])
+    assert store["R1"][9] == 90.0
+
+
+def test_channel_store_extend_matches_append():
+    rows = np.array([[0.0, 1.0], [1.0, np.nan], [2.0, 3.0]])
+    appended = ChannelStore(["TIME", "R1"], chunk_size=2)
+    for time, r1 in rows:
+        appended.append(TIME=time, R1=None if np.isnan(r1) else r1)
+    extended = ChannelStore(["TIME", "R1"], chunk_size=2)
+    extended.extend(rows)
+
+    for name in ["TIME", "R1"]:
+        np.testing.assert_array_equal(extended[name], appended[name])
+    assert extended.latest() == appended.latest() == {"TIME": 2.0, "R1": 3.0}
+
+
+def test_channel_store_snapshot_is_stable():
+    store = ChannelStore(["TIME"], chunk_size=2)
+    store.append(TIME=1.0)
+    snapshot = store.snapshot()
+    # Growing the store leaves the rows of the snapshot alone
+    store.extend(np.arange(5.0).reshape(-1, 1))
+
+    assert len(snapshot) == 1
+    assert snapshot["TIME"].tolist() == [1.0]
+    assert snapshot.sequence < store.snapshot().sequence
+    with pytest.raises(ValueError):
+        snapshot["TIME"][0] = 0.0
+
+
+def test_channel_store_last_and_latest():
+    store = ChannelStore(["TIME", "T"])
+    assert store.last() == store.latest() == {"TIME": None, "T": None}
+    store.append(TIME=0.0, T=4.2)
+    store.append(TIME=1.0)
+
+    assert store.last() == {"TIME": 1.0, "T": None}
+    assert store.latest() == {"TIME": 1.0, "T": 4.2}
+
+
+def test_chunked_file_round_trip(tmp_path):
+    filename = str(tmp_path / "data.bin")
+    rows = np.column_stack([np.arange(10.0), np.arange(10.0) ** 2])
+    writer = ChunkedFileWriter(filename, ["TIME", "R1"], ["seconds", "Ohm"], chunk_rows=4)
+    writer.append(rows[:3])
+    writer.append([[3.0, None], [4.0, "x"]])
+    writer.append(rows[5:])
+    writer.close()
+
+    data = BinaryDataFile(filename)
+    assert len(data) == 10
+    assert data.unit("R1") == "Ohm"
+    assert [len(chunk) for chunk in data.chunks("TIME")] == [4, 4, 2]
+    np.testing.assert_array_equal(data["TIME"], rows[:, 0])
+    expected = rows[:, 1].copy()
+    expected[3:5] = np.nan
+    np.testing.assert_array_equal(data["R1"], expected)
+
+
+def test_binary_file_sees_appended_rows(tmp_path):
+    filename = str(tmp_path / "data.bin")
+    writer = ChunkedFileWriter(filename, ["TIME"], ["seconds"], chunk_rows=4)
+    writer.flush()
+    data = BinaryDataFile(filename)
+    assert len(data) == 0
+    assert len(data["TIME"]) == 0
+
+    writer.append([[1.0], [2.0]])
+    writer.flush()
+    assert len(data) == 0
+    data.refresh()
+    # Only the counted rows of the preallocated chunk are read
+    assert data["TIME"].tolist() == [1.0, 2.0]
+    writer.close()
+
+
+def test_binary_snapshot_columns(tmp_path):
+    filename = str(tmp_path / "data.bin")
+    writer = ChunkedFileWriter(filename, ["TIME", "R1"], ["seconds", "Ohm"], chunk_rows=4)
+    writer.append(np.column_stack([np.arange(10.0), -np.arange(10.0)]))
+    writer.close()
+
+    snapshot = BinaryDataFile(filename).snapshot(9)
+    assert len(snapshot) == 9 and "R1" in snapshot
+    column = snapshot["R1"]
+    assert column[1:3].tolist() == [-1.0, -2.0]
+    assert column[2:9].tolist() == [-2.0, -3.0, -4.0, -5.0, -6.0, -7.0, -8.0]
+    assert column[::4].tolist() == [0.0, -4.0, -8.0]
+    assert column[-1] == -8.0 and len(column[5:5]) == 0
+    np.testing.assert_array_equal(np.asarray(column), -np.arange(9.0))
+    assert snapshot["TIME"].searchsorted(4.0) == 4
+    assert snapshot["TIME"].searchsorted(4.0, "right") == 5
+    assert snapshot["TIME"].searchsorted(20.0) == 9
+
+
+def test_history_run_binary_matches_tsv(tmp_path):
+    rows = _pyramid_rows(5000)
+    source = tmp_path / "run.txt"
+    source.write_text("TIME\tR1\nseconds\tOhm\n" + "".join(f"{t}\t{r}\n" for t, r in rows.tolist()))
+    tsv = HistoryRun(str(source))
+    tsv.join()
+    # The binary twin is loaded instead of the TSV file, without a copy of its rows
+    convert_tsv(str(source), chunk_rows=1000)
+    binary = HistoryRun(str(source))
+    binary.join()
+
+    assert binary.filename.endswith(".bin") and binary.store is None
+    assert binary.progress() == tsv.progress() == (5000, 5000)
+    for x0, x1 in [(0.0, 5000.0), (1234.5, 2345.5)]:
+        x, y = binary.query("R1", x0, x1, 200, 50)
+        x_tsv, y_tsv = tsv.query("R1", x0, x1, 200, 50)
+        np.testing.assert_array_equal(x, x_tsv)
+        np.testing.assert_array_equal(y, y_tsv)
+
+
+def test_convert_tsv(tmp_path):
+    source = tmp_path / "data.txt"
+    source.write_text("time\tT\nseconds\tK\n0.0\t4.2\n1.0\tNone\nbroken\n2.0\t4.3\n")
+
+    data = BinaryDataFile(convert_tsv(str(source), block_rows=2))
+    assert data.names == ["time", "T"]
+    assert data.units == ["seconds", "K"]
+    np.testing.assert_array_equal(data["time"], [0.0, 1.0, 2.0])
+    np.testing.assert_array_equal(data["T"], [4.2, np.nan, 4.3])
+
+
+def test_running_stats_match_numpy():
+    rng = np.random.default_rng(0)
+    values = 1e6 + rng.normal(size=(200, 2))
+    values[::7, 1] = np.nan
+    stats = RunningStats(["A", "B", "C"])
+    for a, b in values:
+        stats.update({"A": a, "B": None if np.isnan(b) else b, "C": None, "D": 1.0})
+
+    for name, column in zip(["A", "B"], values.T):
+        assert stats.mean(name) == pytest.approx(np.nanmean(column), rel=1e-12)
+        assert stats.var(name) == pytest.approx(np.nanvar(column), rel=1e-6)
+        assert stats.min(name) == np.nanmin(column)
+        assert stats.max(name) == np.nanmax(column)
+    assert stats.count.tolist() == [200, 171, 0]
+    assert np.isnan(stats.mean("C")) and np.isnan(stats.std("C"))
+
+    stats.reset()
+    assert np.isnan(stats.mean("A"))
+
+
+def test_running_stats_block_update_matches_rows():
+    rng = np.random.default_rng(1)
+    rows = 300.0 + rng.normal(size=(50, 2))
+    rows[3:9, 0] = np.nan
+    by_row = RunningStats(["A", "B"])
+    for a, b in rows:
+        by_row.update({"A": a, "B": b})
+    by_block = RunningStats(["A", "B"])
+    for block in np.array_split(rows, [1, 2, 20, 20]):
+        by_block.update_block(block)
+
+    assert by_block.count.tolist() == by_row.count.tolist()
+    for name in ["A", "B"]:
+        assert by_block.mean(name) == pytest.approx(by_row.mean(name), rel=1e-12)
+        assert by_block.var(name) == pytest.approx(by_row.var(name), rel=1e-9)
+        assert by_block.min(name) == by_row.min(name)
+        assert by_block.max(name) == by_row.max(name)
+
+
+def _pyramid_rows(rows: int) -> np.ndarray:
+    values = np.random.default_rng(2).normal(size=rows)
+    values[::5] = np.nan
+    return np.column_stack([np.arange(rows, dtype=float), values])
+
+
+def test_pyramid_cover_is_exact():
+    store = ChannelStore(["TIME", "R1"])
+    store.extend(_pyramid_rows(1000))
+    pyramid = MinMaxPyramid(["TIME", "R1"])
+    pyramid.update(store.snapshot())
+
+    for start, stop in [(0, 1000), (3, 997), (17, 18), (250, 250), (100, 900)]:
+        for level in range(len(pyramid.levels) + 1):
+            row = start
+            for segment, first, last in pyramid._cover(level, start, stop):
+                assert segment <= level and first < last
+                # The segments follow each other without gaps
+                assert first * pyramid.factor ** segment == row
+                row = last * pyramid.factor ** segment
+            assert row == stop
+
+
+def test_pyramid_query_keeps_the_extremes():
+    rows = _pyramid_rows(10000)
+    store = ChannelStore(["TIME", "R1"])
+    pyramid = MinMaxPyramid(["TIME", "R1"])
+    # Updated as the rows come, the levels are the same as after one update
+    for block in np.array_split(rows, [1, 8, 5000]):
+        store.extend(block)
+        pyramid.update(store.snapshot())
+    reference = MinMaxPyramid(["TIME", "R1"])
+    reference.update(store.snapshot())
+    assert len(pyramid.levels) == len(reference.levels)
+    for level, other in zip(pyramid.levels, reference.levels):
+        np.testing.assert_array_equal(level.slice(0, level.length), other.slice(0, other.length))
+
+    times, values = pyramid.query("R1", 123, 9877, max_points=200)
+    expected = rows[123:9877, 1]
+    assert len(times) <= 200
+    assert np.all(np.diff(times) >= 0)
+    assert 123 <= times[0] and times[-1] < 9877
+    assert values.min() == np.nanmin(expected)
+    assert values.max() == np.nanmax(expected)
+
+    # Zoomed in: every row that has a value
+    times, values = pyramid.query("R1", 40, 60)
+    assert times.tolist() == [t for t in range(40, 60) if t % 5]
+    np.testing.assert_array_equal(values, rows[40:60, 1][~np.isnan(rows[40:60, 1])])
+
+
+def test_parse_tsv():
+    rows = parse_tsv(b"0.0\t4.2\r\n1.0\tNone\r\n2.0\tnan\r\n", 2)
+    np.testing.assert_array_equal(rows, [[0.0, 4.2], [1.0, np.nan], [2.0, np.nan]])
+
+
+def test_parse_tsv_skips_broken_lines():
+    # A line cut by a crash and a line with a word
+    rows = parse_tsv(b"0.0\t4.2\n1.0\n2.0\tx\n3.0\t4.3\n", 2, "data.txt")
+    np.testing.assert_array_equal(rows, [[0.0, 4.2], [3.0, 4.3]])
+
+
+def test_line_ends():
+    data = np.frombuffer(b"ab\ncd\n\nef", dtype=np.uint8)
+    assert line_ends(data, window=2).tolist() == [2, 5, 6]
+    assert line_ends(data[:0]).tolist() == []
+
+
+def test_data_writer_rows_and_blocks(tmp_path):
+    filename = str(tmp_path / "data.txt")
+    writer = DataWriter(filename)
+    writer.write_row(["time", "T", "Stable_since"])
+    writer.write_row([0.0, None, float("nan")])
+    writer.write_rows(np.array([[1.0, np.nan, np.nan], [2.0, 4.2, 1.5]]), ["None", "None", "nan"])
+    writer.write_rows(np.array([[3.0, np.nan, 2.5]]))
+    writer.close()
+
+    with open(filename) as f:
+        assert f.read().split("\n") == ["time\tT\tStable_since", "0.0\tNone\tnan", "1.0\tNone\tnan",
+                                         "2.0\t4.2\t1.5", "3.0\tNone\t2.5", ""]
+    assert writer.written_rows == 5
+
+
+class FailingWriter(DataWriter):
+    """ A data file on a disk that fails the first `failures` writes """
+
+    def __init__(self, filename: str, failures: int):
+        self.failures = failures
+        super().__init__(filename, flush_rows=1)
+
+    def _write(self, items: list):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("No space left on device")
+        super()._write(items)
+
+
+def test_data_writer_retries_on_close(tmp_path, caplog):
+    filename = str(tmp_path / "data.txt")
+    # The write of the row and the one of close() fail, the last attempt succeeds
+    writer = FailingWriter(filename, failures=2)
+    writer.write_row([1.0, 2.0])
+    writer.close()
+
+    with open(filename) as f:
+        assert f.read() == "1.0\t2.0\n"
+    assert writer.dropped_rows == 0
+
+    writer = FailingWriter(str(tmp_path / "lost.txt"), failures=10)
+    writer.write_row([1.0, 2.0])
+    writer.write_rows(np.zeros((3, 2)))
+    writer.close()
+    assert writer.dropped_rows == 4
+    assert "4 rows are lost" in caplog.text